@@ -0,0 +1,559 @@
+# Bitmask variant of the Norvig constraint engine in sudoku_generator.
+# Candidates live in a flat list: state[0:81] holds a 9-bit digit mask per square
+# (bit d set means digit d + 1 is still possible) and state[81:324] holds, for every
+# (unit, digit) pair, the number of squares in that unit where the digit can still go.
+# Squares are indexed 0..80 in the same order as sudoku_generator.squares (A1..I9).
+
+import unittest
+from itertools import combinations
+
+from budget import OutOfBudget
+
+N_SQUARES = 81
+N_UNITS = 27
+ALL_DIGITS = 0x1ff
+STATE_SIZE = N_SQUARES + N_UNITS * 9
+
+BIT = tuple(1 << d for d in range(9))
+POPCOUNT = tuple(bin(m).count('1') for m in range(512))
+LOWBIT = tuple((m & -m).bit_length() - 1 for m in range(512))
+DIGITS = tuple(tuple(d for d in range(9) if m >> d & 1) for m in range(512))
+DIGIT_STRINGS = tuple(''.join(chr(49 + d) for d in DIGITS[m]) for m in range(512))
+SPREAD = tuple(sum(1 << 4 * d for d in DIGITS[m]) for m in range(512))  # one 4-bit counter per digit
+
+UNITS = tuple([tuple(r * 9 + c for r in range(9)) for c in range(9)] +
+              [tuple(r * 9 + c for c in range(9)) for r in range(9)] +
+              [tuple(r * 9 + c for r in range(br, br + 3) for c in range(bc, bc + 3))
+               for br in (0, 3, 6) for bc in (0, 3, 6)])
+CELL_UNITS = tuple(tuple(u for u in range(N_UNITS) if s in UNITS[u]) for s in range(N_SQUARES))
+PEERS = tuple(tuple(sorted(set(sum((UNITS[u] for u in CELL_UNITS[s]), ())) - {s})) for s in range(N_SQUARES))
+CELL_COUNTS = tuple(tuple(N_SQUARES + u * 9 for u in CELL_UNITS[s]) for s in range(N_SQUARES))
+COUNT_UNITS = (None,) * N_SQUARES + tuple(UNITS[k // 9] for k in range(N_UNITS * 9))
+
+BOXES = UNITS[18:]
+LINES = UNITS[:18]
+# Every box/line intersection as (intersection squares, rest of the box, rest of the line).
+INTERSECTIONS = tuple((tuple(s for s in box if s in line), tuple(s for s in box if s not in line),
+                       tuple(s for s in line if s not in box))
+                      for box in BOXES for line in LINES if set(box) & set(line))
+
+# Propagation levels: each one adds techniques to those of the level below.
+SINGLES = 1  # naked and hidden singles (what propagate() does)
+SUBSETS = 2  # + naked and hidden pairs and triples
+LOCKED = 3  # + pointing pairs/triples and box-line reduction
+PROBING = 4  # + failed-literal probing: try a candidate, propagate, remove it on contradiction
+LEVELS = (SINGLES, SUBSETS, LOCKED, PROBING)
+
+_EMPTY_STATE = [ALL_DIGITS] * N_SQUARES + [9] * (N_UNITS * 9)
+
+
+def empty_state():
+    "Return a state in which every square can be any digit."
+    return _EMPTY_STATE[:]
+
+
+def grid_digits(grid):
+    "Convert grid into a list of 81 digit indices, with -1 for empties ('0' or '.')."
+    chars = [c for c in grid if c in '123456789' or c in '0.']
+    assert len(chars) == 81
+    return [ord(c) - 49 if c in '123456789' else -1 for c in chars]
+
+
+def parse_grid(grid):
+    """Convert grid to a candidate state, or return False if a contradiction is detected."""
+    ## Set up the givens and their peers directly; propagate() only handles the consequences.
+    setup = givens_state(grid)
+    if not setup or not propagate(*setup):
+        return False
+    return setup[0]
+
+
+def givens_state(grid):
+    """The state of grid with the givens and their peers set up, and the todo list of
+    removals still to propagate, or False if the givens contradict each other."""
+    given = grid_digits(grid)
+    used = [0] * N_UNITS
+    for s, d in enumerate(given):
+        if d >= 0:
+            bit = BIT[d]
+            for u in CELL_UNITS[s]:
+                if used[u] & bit:
+                    return False  # Contradiction: the same digit given twice in a unit
+                used[u] |= bit
+    state = [0] * STATE_SIZE
+    todo = []
+    for s, d in enumerate(given):
+        if d >= 0:
+            state[s] = BIT[d]
+            continue
+        u0, u1, u2 = CELL_UNITS[s]
+        m = ALL_DIGITS & ~(used[u0] | used[u1] | used[u2])
+        if not m:
+            return False
+        state[s] = m
+        if not m & (m - 1):
+            todo.extend((s2, m) for s2 in PEERS[s])
+    for u in range(N_UNITS):
+        total = sum(SPREAD[state[s]] for s in UNITS[u])
+        for d in range(9):
+            n = total >> 4 * d & 15
+            if not n:
+                return False
+            state[N_SQUARES + u * 9 + d] = n
+            if n == 1:
+                bit = BIT[d]
+                for s in UNITS[u]:
+                    if state[s] & bit:
+                        break
+                if state[s] != bit:
+                    todo.append((s, state[s] ^ bit))
+    return state, todo
+
+
+def assign(state, s, d):
+    """Eliminate all the other digits (except d) from state[s] and propagate.
+    Return True, or False if a contradiction is detected."""
+    return propagate(state, [(s, state[s] & ~BIT[d])])
+
+
+def eliminate(state, s, d):
+    """Eliminate digit d from state[s] and propagate.
+    Return True, or False if a contradiction is detected."""
+    return propagate(state, [(s, BIT[d])])
+
+
+def propagate(state, todo):
+    """Apply the pending (square, mask) removals in todo, and every removal they imply:
+    (1) if a square is reduced to one value, eliminate that value from the peers;
+    (2) if a unit is reduced to only one place for a value, put it there.
+    Return True, or False if a contradiction is detected."""
+    pop, push = todo.pop, todo.append
+    digits_of, bits, cell_counts, count_units, peers = DIGITS, BIT, CELL_COUNTS, COUNT_UNITS, PEERS
+    while todo:
+        s, rem = pop()
+        m = state[s]
+        rem &= m
+        if not rem:
+            continue  # Already eliminated
+        m ^= rem
+        if not m:
+            return False  # Contradiction: removed last value
+        state[s] = m
+        for d in digits_of[rem]:
+            for k in cell_counts[s]:
+                k += d
+                n = state[k] - 1
+                if n == 1:
+                    state[k] = 1
+                    bit = bits[d]
+                    for s2 in count_units[k]:
+                        if state[s2] & bit:
+                            break
+                    if state[s2] != bit:
+                        push((s2, state[s2] ^ bit))
+                elif n:
+                    state[k] = n
+                else:
+                    return False  # Contradiction: no place for this value
+        if not m & (m - 1):
+            for s2 in peers[s]:
+                if state[s2] & m:
+                    push((s2, m))
+    return True
+
+
+def propagate_trail(state, todo, trail):
+    """Like propagate(), but todo is a flat [square, mask, square, mask, ...] list and the
+    index and previous value of every entry written in state is appended to trail, so
+    the changes can be rolled back with undo(). todo is left empty either way."""
+    pop, push, record = todo.pop, todo.append, trail.append
+    digits_of, bits, cell_counts, count_units, peers = DIGITS, BIT, CELL_COUNTS, COUNT_UNITS, PEERS
+    while todo:
+        rem = pop()
+        s = pop()
+        m = state[s]
+        rem &= m
+        if not rem:
+            continue  # Already eliminated
+        if m == rem:
+            del todo[:]
+            return False  # Contradiction: removed last value
+        record(s)
+        record(m)
+        m ^= rem
+        state[s] = m
+        for d in digits_of[rem]:
+            for k in cell_counts[s]:
+                k += d
+                n = state[k]
+                if n == 2:
+                    record(k)
+                    record(n)
+                    state[k] = 1
+                    bit = bits[d]
+                    for s2 in count_units[k]:
+                        if state[s2] & bit:
+                            break
+                    if state[s2] != bit:
+                        push(s2)
+                        push(state[s2] ^ bit)
+                elif n > 1:
+                    record(k)
+                    record(n)
+                    state[k] = n - 1
+                else:
+                    del todo[:]
+                    return False  # Contradiction: no place for this value
+        if not m & (m - 1):
+            for s2 in peers[s]:
+                if state[s2] & m:
+                    push(s2)
+                    push(m)
+    return True
+
+
+def undo(state, trail, mark):
+    "Roll state back to the point where trail had length mark."
+    if len(trail) > mark:
+        changes = trail[mark:]
+        del trail[mark:]
+        for v, k in zip(changes[::-2], changes[-2::-2]):
+            state[k] = v
+
+
+def solved(state):
+    "True if every square of state has exactly one candidate."
+    return all(POPCOUNT[m] == 1 for m in state[:N_SQUARES])
+
+
+def choose(state):
+    "The unfilled square with the fewest possibilities (first one on ties), or -1 if solved."
+    best, s = 10, -1
+    for i in range(N_SQUARES):
+        n = POPCOUNT[state[i]]
+        if 1 < n < best:
+            best, s = n, i
+            if n == 2:
+                break
+    return s
+
+
+def check_level(level):
+    if level not in LEVELS:
+        raise ValueError('Unknown propagation level %r; expected one of %s' % (level, ', '.join(map(str, LEVELS))))
+
+
+def subset_removals(state, found):
+    """Append to found the removals implied by naked and hidden pairs and triples.
+    Return False if some unit has k squares or digits confined to fewer than k places."""
+    for unit in UNITS:
+        open_squares = [s for s in unit if state[s] & (state[s] - 1)]
+        if len(open_squares) < 3:
+            continue
+        ## Naked: k squares whose candidates together are only k digits; no other square takes them.
+        small = [s for s in open_squares if POPCOUNT[state[s]] <= 3]
+        for k in (2, 3):
+            for group in combinations(small, k):
+                union = 0
+                for s in group:
+                    union |= state[s]
+                n = POPCOUNT[union]
+                if n < k:
+                    return False
+                if n == k:
+                    found.extend((s, union) for s in open_squares if s not in group and state[s] & union)
+        ## Hidden: k digits whose places together are only k squares; those squares take nothing else.
+        places = [0] * 9
+        for i, s in enumerate(unit):
+            m = state[s]
+            if m & (m - 1):
+                for d in DIGITS[m]:
+                    places[d] |= 1 << i
+        few = [d for d in range(9) if 2 <= POPCOUNT[places[d]] <= 3]
+        for k in (2, 3):
+            for group in combinations(few, k):
+                where = keep = 0
+                for d in group:
+                    where |= places[d]
+                    keep |= BIT[d]
+                n = POPCOUNT[where]
+                if n < k:
+                    return False
+                if n == k:
+                    found.extend((unit[i], ~keep & ALL_DIGITS) for i in DIGITS[where] if state[unit[i]] & ~keep)
+    return True
+
+
+def locked_removals(state, found):
+    """Append to found the removals implied by locked candidates: a digit confined to one
+    box/line intersection within the box (pointing) or within the line (box-line reduction)."""
+    for inside, box_rest, line_rest in INTERSECTIONS:
+        m = state[inside[0]] | state[inside[1]] | state[inside[2]]
+        in_box = in_line = 0
+        for s in box_rest:
+            in_box |= state[s]
+        for s in line_rest:
+            in_line |= state[s]
+        pointing = m & ~in_box & in_line
+        if pointing:
+            found.extend((s, pointing) for s in line_rest if state[s] & pointing)
+        claiming = m & ~in_line & in_box
+        if claiming:
+            found.extend((s, claiming) for s in box_rest if state[s] & claiming)
+
+
+def probe_removals(state, found):
+    """Append to found every candidate whose assignment fails under singles propagation."""
+    for s in range(N_SQUARES):
+        m = state[s]
+        if m & (m - 1):
+            for d in DIGITS[m]:
+                if not propagate(state[:], [(s, m ^ BIT[d])]):
+                    found.append((s, BIT[d]))
+
+
+def strengthen(state, level, trail=None):
+    """Apply the techniques of propagation level above singles until none finds anything more.
+    With a trail, changes are recorded on it as in propagate_trail().
+    Return True, or False if a contradiction is detected."""
+    while level > SINGLES:
+        found = []
+        if not subset_removals(state, found):
+            return False
+        if level >= LOCKED:
+            locked_removals(state, found)
+        if not found and level >= PROBING:
+            probe_removals(state, found)
+        if not found:
+            return True
+        if trail is None:
+            ok = propagate(state, found)
+        else:
+            flat = []
+            for s, m in found:
+                flat += (s, m)
+            ok = propagate_trail(state, flat, trail)
+        if not ok:
+            return False
+    return True
+
+
+def search(state, level=SINGLES, budget=None):
+    """Using depth-first search and propagation at the given level, try all possible values.
+    With a budget.Budget, every node is charged to it (OutOfBudget is raised when it runs out)."""
+    if state is False:
+        return False  # Failed earlier
+    if budget is not None:
+        budget.spend()
+    if level > SINGLES and not strengthen(state, level):
+        return False
+    s = choose(state)
+    if s < 0:
+        return state  # Solved!
+    for d in DIGITS[state[s]]:
+        child = state[:]
+        if assign(child, s, d):
+            child = search(child, level, budget)
+            if child:
+                return child
+    return False
+
+
+def search_trail(state, level=SINGLES, budget=None):
+    """Depth-first search like search(), but iterative and in place: every change is
+    recorded on an undo trail and backtracking rolls state back to the node's mark.
+    Tries the same squares and digits in the same order, so it finds the same solution."""
+    for solution in solutions(state, level, budget):
+        return solution
+    return False
+
+
+def solutions(state, level=SINGLES, budget=None):
+    """Generate every solution of state, in search order, using the in-place trail search.
+    Each solution yielded is the working state itself; copy it to keep it.
+    With a budget.Budget, every node is charged to it (OutOfBudget is raised when it runs out)."""
+    if state is False:
+        return  # Failed earlier
+    if budget is not None:
+        budget.spend()
+    trail, todo = [], []
+    if level > SINGLES and not strengthen(state, level, trail):
+        return
+    frames = []  # flat [square, untried digits, trail mark, ...] per open node
+    push_frame, push_todo = frames.append, todo.append
+    s = choose(state)
+    while True:
+        if s < 0:
+            yield state  # Solved!
+        else:
+            push_frame(s)
+            push_frame(state[s])
+            push_frame(len(trail))
+        ## Move on to the next untried digit of the innermost open node.
+        while True:
+            if not frames:
+                return  # Every branch tried
+            untried = frames[-2]
+            undo(state, trail, frames[-1])
+            if not untried:
+                del frames[-3:]
+                continue
+            bit = untried & -untried
+            frames[-2] = untried ^ bit
+            if budget is not None:
+                budget.spend()
+            s = frames[-3]
+            push_todo(s)
+            push_todo(state[s] ^ bit)
+            if propagate_trail(state, todo, trail) and (level == SINGLES or strengthen(state, level, trail)):
+                break
+        s = choose(state)
+
+
+def count_solutions(state, limit=2, level=SINGLES, budget=None):
+    """Count the solutions of state, stopping as soon as limit of them are found (limit=None counts all).
+    If budget runs out, the OutOfBudget raised carries the count so far as partial."""
+    n = 0
+    try:
+        for _ in solutions(state, level, budget):
+            n += 1
+            if n == limit:
+                break
+    except OutOfBudget as e:
+        e.partial = n
+        raise
+    return n
+
+
+def solve(grid, mode='copy', level=SINGLES, budget=None):
+    """Solve grid; mode='copy' searches on copies of the state, mode='trail' in place with an undo trail.
+    level picks the propagation strength (one of LEVELS) used at every search node."""
+    check_level(level)
+    if mode == 'trail':
+        return search_trail(parse_grid(grid), level, budget)
+    return search(parse_grid(grid), level, budget)
+
+
+def to_string(state, blank='.'):
+    "Render the squares of state as an 81-char string, blank for undetermined squares."
+    return ''.join(chr(49 + LOWBIT[m]) if POPCOUNT[m] == 1 else blank for m in state[:N_SQUARES])
+
+
+def to_values(state, squares):
+    "Convert state into the {square: digits} dict used by sudoku_generator."
+    if state is False:
+        return False
+    return dict(zip(squares, [DIGIT_STRINGS[m] for m in state[:N_SQUARES]]))
+
+
+def from_values(values, squares):
+    "Convert a {square: digits} dict into a state (the place counts are recomputed)."
+    state = [sum(BIT[ord(c) - 49] for c in values[sq]) for sq in squares] + [0] * (N_UNITS * 9)
+    for u in range(N_UNITS):
+        for s in UNITS[u]:
+            for d in DIGITS[state[s]]:
+                state[N_SQUARES + u * 9 + d] += 1
+    return state
+
+
+class TestBitmaskEngine(unittest.TestCase):
+    easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+
+    def setUp(self):
+        pass
+
+    def test_tables(self):
+        self.assertEqual(len(UNITS), 27)
+        self.assertTrue(all(len(p) == 20 for p in PEERS))
+        self.assertTrue(all(len(u) == 3 for u in CELL_UNITS))
+        self.assertEqual(POPCOUNT[ALL_DIGITS], 9)
+        self.assertEqual(LOWBIT[0b101000], 3)
+        self.assertEqual(DIGITS[0b101], (0, 2))
+
+    def test_matches_dict_engine(self):
+        import sudoku_generator as sg
+        for grid in (self.easy, self.hard):
+            self.assertEqual(to_values(parse_grid(grid), sg.squares), sg.parse_grid(grid, engine='dict'))
+            self.assertEqual(to_values(solve(grid), sg.squares), sg.solve(grid, engine='dict'))
+        self.assertEqual(from_values(sg.parse_grid(self.hard, engine='dict'), sg.squares), parse_grid(self.hard))
+
+    def test_trail_matches_copy(self):
+        import sudoku_generator as sg
+        for grid in (self.easy, self.hard, '.' * 81):
+            self.assertEqual(solve(grid, 'trail')[:N_SQUARES], solve(grid)[:N_SQUARES])
+        self.assertEqual(sg.search(sg.parse_grid(self.hard, engine='dict'), mode='trail'),
+                         sg.solve(self.hard, engine='dict'))
+        self.assertFalse(solve('12345678.' + '........9' + '.' * 63, 'trail'))
+        self.assertRaises(ValueError, lambda: sg.solve(self.easy, mode='unknown'))
+
+    def test_count_solutions(self):
+        import sudoku_generator as sg
+        self.assertEqual(count_solutions(parse_grid(self.hard)), 1)
+        self.assertEqual(count_solutions(parse_grid('.' * 81), limit=5), 5)
+        solution = to_string(solve(self.easy))
+        self.assertEqual(count_solutions(parse_grid('.' * 9 + solution[9:]), limit=None), 1)
+        self.assertEqual(count_solutions(parse_grid('.' * 18 + solution[18:]), limit=None), 4)
+        self.assertEqual(count_solutions(parse_grid('.' * 18 + solution[18:]), limit=3), 3)
+        self.assertEqual(count_solutions(parse_grid('11' + '.' * 79)), 0)
+        for grid in (self.hard, '.' * 18 + solution[18:], '12345678.' + '........9' + '.' * 63):
+            self.assertEqual(sg.count_solutions(grid, engine='dict'), sg.count_solutions(grid, engine='bitmask'))
+
+    def test_levels(self):
+        import sudoku_generator as sg
+        solution = to_string(solve(self.hard))
+        for level in LEVELS:
+            self.assertEqual(to_string(solve(self.hard, level=level)), solution)
+            self.assertEqual(to_string(solve(self.hard, 'trail', level)), solution)
+        four = '.' * 18 + to_string(solve(self.easy))[18:]
+        self.assertEqual(count_solutions(parse_grid(four), None, PROBING), 4)
+        self.assertEqual(sg.solve(self.hard, engine='dict', level=LOCKED), sg.solve(self.hard, engine='dict'))
+        self.assertRaises(ValueError, lambda: solve(self.hard, level=5))
+        self.assertRaises(ValueError, lambda: sg.solve(self.hard, engine='dlx', level=SUBSETS))
+
+    def test_techniques(self):
+        state = empty_state()
+        state[0] = state[1] = 0b11  # naked pair {1, 2} in row A, column 1..2 and box 1
+        found = []
+        self.assertTrue(subset_removals(state, found))
+        self.assertIn((2, 0b11), found)
+        self.assertIn((9, 0b11), found)
+        state[2] = 0b11  # three squares, two digits
+        self.assertFalse(subset_removals(state, []))
+        state = empty_state()
+        for s in (9, 10, 11, 18, 19, 20):
+            state[s] &= ~BIT[0]  # in box 1, digit 1 only fits in row A
+        found = []
+        locked_removals(state, found)
+        self.assertIn((3, BIT[0]), found)
+        self.assertNotIn((1, BIT[0]), found)
+
+    def test_undo(self):
+        state = parse_grid(self.hard)
+        s = choose(state)
+        before, trail, todo = state[:], [], [s, state[s] & -state[s]]
+        propagate_trail(state, todo, trail)
+        self.assertNotEqual(state, before)
+        undo(state, trail, 0)
+        self.assertEqual(state, before)
+        self.assertEqual(trail, [])
+
+    def test_random_puzzle_matches_dict_engine(self):
+        import random
+        import sudoku_generator as sg
+        random.seed(7)
+        expected = sg.random_puzzle(50, engine='dict')
+        random.seed(7)
+        self.assertEqual(sg.random_puzzle(50, engine='bitmask'), expected)
+        self.assertRaises(ValueError, lambda: sg.solve(self.easy, engine='unknown'))
+
+    def test_contradiction(self):
+        self.assertFalse(parse_grid('11' + '.' * 79))
+        self.assertFalse(solve('12345678.' + '........9' + '.' * 63))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
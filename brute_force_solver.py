@@ -1,15 +1,43 @@
 import numpy as np
 import unittest
+import multiprocessing
+import os
+import queue
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 
 from sudoku_generator import *
+import bitmask_engine as bm
+from budget import BudgetExceeded
+from shared_arrays import SharedArray
 
 
-def brute_force_solve(board):
+def solve_string(board_string, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None, stats=None, portfolio=None):
+    """
+    Solves an 81-char board string with sudoku_generator.solve(), or by racing the strategies of portfolio.
+    :return: dict {square: digit}, False if the board has no solution, or budget.BudgetExceeded
+    """
+    if portfolio is None:
+        return solve(board_string, engine, max_nodes=max_nodes, deadline=deadline, stats=stats)
+    if stats is not None:
+        raise ValueError('SolveStats are not collected in portfolio mode')
+    solution = portfolio.solve(board_string, max_nodes=max_nodes, deadline=deadline)
+    return solution and dict(zip(squares, solution))
+
+
+def brute_force_solve(board, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None, stats=None, portfolio=None):
     """
     Solves a given board
-    :raises ValueError if board shape or dtype incorrect
+    :raises ValueError if board shape or dtype incorrect, or engine unknown
     :param board: np.ndarray of puzzle board, shape=(9,9) dtype='uint8' OR shape=(9,9,9) dtype='bool'
-    :return: np.ndarray of solved board, same shape and dtype as param board.
+    :param engine: str solver engine, one of sudoku_generator.ENGINES ('dlx' has the shortest tail on low-clue boards)
+    :param max_nodes: int cap on search nodes, or None
+    :param deadline: float seconds the solve may take, or None
+    :param stats: solve_stats.SolveStats to add the solve's counters to, or None ('dict' and 'bitmask' engines)
+    :param portfolio: portfolio.Portfolio to race its strategies on the board instead of using engine, or None
+    :return: np.ndarray of solved board, same shape and dtype as param board,
+             or budget.BudgetExceeded if max_nodes or deadline ran out first.
     """
     if board.shape == (9, 9, 9) and board.dtype == 'bool':
         categories = [[False, False, False, False, False, False, False, False, False],
@@ -34,7 +62,9 @@ def brute_force_solve(board):
         cols = '123456789'
 
         # Assume solvable
-        solution_dict = solve(board_string)
+        solution_dict = solve_string(board_string, engine, max_nodes, deadline, stats, portfolio)
+        if isinstance(solution_dict, BudgetExceeded):
+            return solution_dict
 
         solution_string = ""
 
@@ -78,7 +108,9 @@ def brute_force_solve(board):
         cols = '123456789'
 
         # Assume solvable
-        solution_dict = solve(board_string)
+        solution_dict = solve_string(board_string, engine, max_nodes, deadline, stats, portfolio)
+        if isinstance(solution_dict, BudgetExceeded):
+            return solution_dict
 
         solution_string = ""
 
@@ -91,6 +123,343 @@ def brute_force_solve(board):
         raise ValueError('Incorrect board formatting')
 
 
+# Unit membership as a (27, 81) 0/1 matrix, in the square order of sudoku_generator (A1..I9).
+# float32 so the per-unit sums below are single BLAS matrix products over the whole batch.
+UNIT_MATRIX = np.zeros((27, 81), dtype='float32')
+for _u, _unit in enumerate(bm.UNITS):
+    UNIT_MATRIX[_u, list(_unit)] = 1
+UNIT_MATRIX_T = np.ascontiguousarray(UNIT_MATRIX.T)
+
+
+def propagate_batch(candidates):
+    """
+    Runs naked- and hidden-single propagation on a batch of boards at once, in place.
+    Boards are laid out square-major, (81, n * 9), so that each rule is one matrix product
+    with the unit matrix for every board still changing.
+    :param candidates: np.ndarray shape=(N, 81, 9) dtype='bool', True where a digit is still possible
+    :return: np.ndarray shape=(N,) dtype='bool', True for boards where a contradiction was found
+    """
+    failed = np.zeros(len(candidates), dtype='bool')
+    active = np.arange(len(candidates))
+    while len(active):
+        n = len(active)
+        cand = np.ascontiguousarray(candidates[active].transpose(1, 0, 2))
+        count = cand.sum(axis=2, dtype='uint8')
+        flat = cand.reshape(81, n * 9)
+        fixed = (cand & (count == 1)[:, :, None]).reshape(81, n * 9).astype('float32')
+        # (1) A digit fixed in a square is removed from the square's peers.
+        fixed_in_units = UNIT_MATRIX @ fixed
+        flat &= (UNIT_MATRIX_T @ fixed_in_units) <= fixed * 3
+        # (2) A digit with a single place left in a unit goes there.
+        places = UNIT_MATRIX @ flat.astype('float32')
+        hidden = (((UNIT_MATRIX_T @ (places == 1).astype('float32')) > 0) & flat).reshape(81, n, 9)
+        np.copyto(cand, hidden, where=hidden.any(axis=2)[:, :, None])
+        new_count = cand.sum(axis=2, dtype='uint8')
+        bad = ((new_count == 0).any(axis=0) | (places.reshape(27, n, 9) == 0).any(axis=(0, 2)) |
+               (fixed_in_units.reshape(27, n, 9) > 1).any(axis=(0, 2)) | (hidden.sum(axis=2) > 1).any(axis=0))
+        candidates[active] = cand.transpose(1, 0, 2)
+        failed[active[bad]] = True
+        active = active[(new_count != count).any(axis=0) & ~bad]
+    return failed
+
+
+# Sharded propagation. propagate_batch() spends nearly all its time in NumPy matrix products,
+# reductions and copies over the whole batch, which release the GIL, so threads working on
+# contiguous slices of one candidates array run in parallel with no copies and no pickling.
+# Processes need the batch copied into shared memory and back, plus the pool's own overhead.
+MIN_SHARD = 256  # boards per shard below which a batch is not worth splitting
+EXECUTORS = ('auto', 'serial', 'threads', 'processes')
+
+
+def gil_enabled():
+    "False on a free-threaded CPython build running without the GIL."
+    return getattr(sys, '_is_gil_enabled', lambda: True)()
+
+
+def choose_executor(num_boards, workers):
+    """
+    The executor 'auto' picks for propagating num_boards over workers.
+    Shards under MIN_SHARD boards run serially, since the per-iteration Python work of
+    propagate_batch() then outweighs its NumPy work; larger ones go to threads, which share
+    the batch for free. Processes only pay off where NumPy keeps the GIL, which it does not
+    for the bool and float32 kernels here, so they are never picked automatically.
+    :param num_boards: int batch size
+    :param workers: int threads or processes available
+    :return: str 'serial' or 'threads'
+    """
+    if workers < 2 or num_boards < 2 * MIN_SHARD:
+        return 'serial'
+    return 'threads'
+
+
+def shard_bounds(num_boards, workers):
+    "Contiguous (start, stop) slices splitting num_boards into at most workers shards of at least MIN_SHARD."
+    shards = max(1, min(workers, num_boards // MIN_SHARD))
+    edges = np.linspace(0, num_boards, shards + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def propagate_shared(task):
+    "Process pool worker: propagate_batch() on slots start:stop of a SharedArray of candidates."
+    spec, start, stop = task
+    with SharedArray.attach(spec) as shared:
+        return propagate_batch(shared.array[start:stop])
+
+
+def propagate_shards(candidates, workers=None, executor='auto', pool=None):
+    """
+    Runs propagate_batch() on a batch split into contiguous shards, one per worker.
+    Threads work on views of candidates directly; processes on a shared memory copy of it.
+    :raises ValueError if executor is not one of EXECUTORS
+    :param candidates: np.ndarray shape=(N, 81, 9) dtype='bool', updated in place as by propagate_batch()
+    :param workers: int threads or processes, or None for one per CPU
+    :param executor: str 'threads', 'processes', 'serial', or 'auto' to let choose_executor() pick
+    :param pool: multiprocessing.Pool to reuse for 'processes', or None to start one for this call
+    :return: np.ndarray shape=(N,) dtype='bool', True for boards where a contradiction was found
+    """
+    if executor not in EXECUTORS:
+        raise ValueError('Unknown executor %r; expected one of %s' % (executor, ', '.join(EXECUTORS)))
+    workers = workers or os.cpu_count()
+    if executor == 'auto':
+        executor = choose_executor(len(candidates), workers)
+    bounds = shard_bounds(len(candidates), workers)
+    if executor == 'serial' or len(bounds) < 2:
+        return propagate_batch(candidates)
+    if executor == 'threads':
+        with ThreadPoolExecutor(len(bounds)) as threads:
+            return np.concatenate(list(threads.map(lambda b: propagate_batch(candidates[b[0]:b[1]]), bounds)))
+    with SharedArray(candidates.shape, candidates.dtype) as shared:
+        shared.array[:] = candidates
+        tasks = [(shared.spec, start, stop) for start, stop in bounds]
+        if pool is None:
+            with multiprocessing.Pool(len(bounds)) as pool:
+                failed = pool.map(propagate_shared, tasks)
+        else:
+            failed = pool.map(propagate_shared, tasks)
+        candidates[:] = shared.array
+    return np.concatenate(failed)
+
+
+def brute_force_solve_batch(boards, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None, stats=None,
+                            portfolio=None, workers=None, executor='auto'):
+    """
+    Solves a batch of boards: single propagation runs on the whole batch as NumPy operations,
+    and only boards it leaves unsolved go through the per-board search of engine.
+    :raises ValueError if boards shape or dtype incorrect, or some board has no solution
+    :param boards: np.ndarray of puzzle boards stacked on axis 0,
+                   shape=(N,9,9) dtype='uint8' OR shape=(N,9,9,9) dtype='bool'
+    :param engine: str solver engine for the boards propagation does not finish, one of sudoku_generator.ENGINES
+    :param max_nodes: int cap on search nodes per board, or None
+    :param deadline: float seconds the search of each board may take, or None
+    :param stats: solve_stats.SolveStats to add the counters of the per-board searches to, or None
+    :param portfolio: portfolio.Portfolio to race on the boards propagation does not finish, or None
+    :param workers: int threads or processes to shard the batch propagation over (see propagate_shards()),
+                    or None to propagate in this thread
+    :param executor: str how to run the shards, one of EXECUTORS
+    :return: np.ndarray of solved boards, same shape and dtype as param boards;
+             if some boards ran out of budget, a budget.BudgetExceeded (nodes and elapsed summed over them)
+             whose partial is (solved boards, indices of the boards left blank where propagation did not fill them)
+    """
+    if boards.ndim == 4 and boards.shape[1:] == (9, 9, 9) and boards.dtype == 'bool':
+        one_hot = True
+        clues = np.where(boards.any(axis=3), boards.argmax(axis=3) + 1, 0).reshape(-1, 81)
+    elif boards.ndim == 3 and boards.shape[1:] == (9, 9) and boards.dtype == 'uint8':
+        one_hot = False
+        clues = boards.reshape(-1, 81).astype('int64') - 48
+    else:
+        raise ValueError('Incorrect board formatting')
+
+    candidates = np.ones((len(boards), 81, 9), dtype='bool')
+    given = clues > 0
+    candidates[given] = np.arange(1, 10) == clues[given][:, None]
+    if workers is None:
+        failed = propagate_batch(candidates)
+    else:
+        failed = propagate_shards(candidates, workers, executor)
+
+    unsolved = np.flatnonzero(~failed & (candidates.sum(axis=2) != 1).any(axis=1))
+    exceeded = []
+    for i in unsolved:
+        fixed = candidates[i].sum(axis=1) == 1
+        board_string = ''.join(str(d) for d in np.where(fixed, candidates[i].argmax(axis=1) + 1, 0))
+        solution_dict = solve_string(board_string, engine, max_nodes, deadline, stats, portfolio)
+        if isinstance(solution_dict, BudgetExceeded):
+            candidates[i] &= fixed[:, None]
+            exceeded.append((i, solution_dict))
+            continue
+        if solution_dict is False:
+            failed[i] = True
+            continue
+        candidates[i] = np.arange(1, 10) == np.array([int(solution_dict[s]) for s in squares])[:, None]
+    if failed.any():
+        raise ValueError('Boards %s have no solution' % np.flatnonzero(failed).tolist())
+
+    if one_hot:
+        solutions = candidates.reshape(-1, 9, 9, 9)
+    else:
+        solutions = np.where(candidates.any(axis=2), candidates.argmax(axis=2) + 49, 48).astype('uint8').reshape(-1, 9, 9)
+    if exceeded:
+        return BudgetExceeded(exceeded[0][1].reason, sum(e.nodes for i, e in exceeded),
+                              sum(e.elapsed for i, e in exceeded), (solutions, [int(i) for i, e in exceeded]))
+    return solutions
+
+
+def board_to_string(board):
+    """
+    Converts a board to the 81-char string the engines read ('0' for blanks).
+    :raises ValueError if board is not an 81-char string, a (9,9) uint8 board or a (9,9,9) bool board
+    :param board: str, or np.ndarray shape=(9,9) dtype='uint8' OR shape=(9,9,9) dtype='bool'
+    :return: str
+    """
+    if isinstance(board, str):
+        chars = [c for c in board if c in '0123456789.']
+        if len(chars) != 81:
+            raise ValueError('Expected 81 cells in board string, but found %d' % len(chars))
+        return ''.join(chars)
+    if board.shape == (9, 9, 9) and board.dtype == 'bool':
+        return ''.join(map(str, np.where(board.any(axis=2), board.argmax(axis=2) + 1, 0).ravel()))
+    if board.shape == (9, 9) and board.dtype == 'uint8' and ((board >= 48) & (board <= 57)).all():
+        return board.tobytes().decode()
+    raise ValueError('Incorrect board formatting')
+
+
+def string_to_board(solution, like):
+    """
+    Converts an 81-char solution string to the format of the board it solves.
+    Failed solves (False or budget.BudgetExceeded) are passed through.
+    :param solution: str of 81 digits, False or budget.BudgetExceeded
+    :param like: the board, as given to board_to_string()
+    :return: str, or np.ndarray of the same shape and dtype as like
+    """
+    if not solution or isinstance(like, str):
+        return solution
+    solution_uint = np.frombuffer(solution.encode(), dtype='uint8').reshape(9, 9)
+    if like.dtype == 'bool':
+        return (solution_uint[:, :, None] - 49) == np.arange(9)
+    return solution_uint.copy()
+
+
+def solve_strings(task):
+    """
+    Pool worker for solve_many(): solves one chunk of board strings.
+    :param task: tuple (chunk index, list of board strings, engine, max_nodes, deadline)
+    :return: tuple (chunk index, list of solution strings, False for no solution, or budget.BudgetExceeded)
+    """
+    index, board_strings, engine, max_nodes, deadline = task
+    solutions = []
+    for board_string in board_strings:
+        solution_dict = solve(board_string, engine, max_nodes=max_nodes, deadline=deadline)
+        if solution_dict and not isinstance(solution_dict, BudgetExceeded):
+            solution_dict = ''.join(solution_dict[s] for s in squares)
+        solutions.append(solution_dict)
+    return index, solutions
+
+
+def solve_many(boards, workers=None, chunk_size=256, ordered=True, engine=DEFAULT_ENGINE, max_nodes=None,
+               deadline=None, in_flight=None):
+    """
+    Solves a stream of boards, yielding each solution as it is ready.
+    Boards are read lazily in chunks of chunk_size and at most in_flight chunks are out at once,
+    solving or waiting to be yielded, so memory use does not grow with the length of the stream.
+    :raises ValueError if a board is malformed (see board_to_string()), or engine unknown
+    :param boards: iterable of boards: 81-char strings, shape=(9,9) dtype='uint8' or shape=(9,9,9) dtype='bool'
+    :param workers: int number of worker processes, or None to solve in this process
+    :param chunk_size: int boards per task sent to a worker
+    :param ordered: bool, if true yield solutions in input order (holding early chunks in a reorder buffer);
+                    if false yield each chunk as soon as it is solved
+    :param engine: str solver engine, one of sudoku_generator.ENGINES
+    :param max_nodes: int cap on search nodes per board, or None
+    :param deadline: float seconds allowed per board, or None
+    :param in_flight: int most chunks out at once; 2 * workers if None
+    :return: generator of (board, solution) pairs, solution in the format of board, False if it has no
+             solution, or budget.BudgetExceeded
+    """
+    check_engine(engine)
+    boards = iter(boards)
+    if workers is None or workers < 2:
+        for board in boards:
+            index, solutions = solve_strings((0, [board_to_string(board)], engine, max_nodes, deadline))
+            yield board, string_to_board(solutions[0], board)
+        return
+
+    in_flight = in_flight or 2 * workers
+    results = queue.Queue()
+    pending = {}  # chunk index -> its boards, until they are yielded
+    solved = {}  # reorder buffer: chunk index -> solutions, in ordered mode
+    submitted = next_index = 0
+    exhausted = False
+    pool = multiprocessing.Pool(workers)
+    try:
+        while True:
+            while not exhausted and len(pending) < in_flight:
+                chunk = list(islice(boards, chunk_size))
+                if not chunk:
+                    exhausted = True
+                    break
+                task = (submitted, [board_to_string(board) for board in chunk], engine, max_nodes, deadline)
+                pending[submitted] = chunk
+                pool.apply_async(solve_strings, (task,), callback=results.put, error_callback=results.put)
+                submitted += 1
+            if not pending:
+                return
+            result = results.get()
+            if isinstance(result, BaseException):
+                raise result
+            index, solutions = result
+            solved[index] = solutions
+            ready = [index] if not ordered else []
+            while ordered and next_index in solved:
+                ready.append(next_index)
+                next_index += 1
+            for index in ready:
+                for board, solution in zip(pending.pop(index), solved.pop(index)):
+                    yield board, string_to_board(solution, board)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def solve_lines(lines, out, err, workers=None, chunk_size=256, ordered=True, engine=DEFAULT_ENGINE, max_nodes=None,
+                deadline=None):
+    """
+    Solves puzzles read one per line, writing one line per puzzle to out: its solution, or the puzzle itself as
+    read if it has no solution or ran out of budget, so that output lines stay in step with the puzzles (and in
+    unordered mode show which puzzle failed).  Those puzzles, and lines that are not 81 digits ('0' or '.' for
+    blanks), are reported to err, and malformed lines are skipped, so a bad line never stops the stream.
+    Blank lines are ignored.
+    :param lines: iterable of str, e.g. an open file
+    :param out: file to write solutions to
+    :param err: file to write reports of malformed lines and unsolved puzzles to
+    :param workers, chunk_size, ordered, engine, max_nodes, deadline: as for solve_many()
+    :return: dict of counts: 'puzzles' read, 'solved', 'unsolved' and 'malformed'
+    """
+    counts = dict(puzzles=0, solved=0, unsolved=0, malformed=0)
+
+    def puzzles():
+        for line_number, line in enumerate(lines, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if len(line) != 81 or line.strip('0123456789.'):
+                counts['malformed'] += 1
+                err.write('line %d: malformed puzzle %r\n' % (line_number, line[:100]))
+                continue
+            counts['puzzles'] += 1
+            yield line
+
+    for puzzle, solution in solve_many(puzzles(), workers=workers, chunk_size=chunk_size, ordered=ordered,
+                                       engine=engine, max_nodes=max_nodes, deadline=deadline):
+        if solution:
+            counts['solved'] += 1
+            out.write(solution + '\n')
+        else:
+            counts['unsolved'] += 1
+            reason = 'no solution' if solution is False else 'out of budget (%s)' % solution.reason
+            err.write('%s: %s\n' % (reason, puzzle))
+            out.write(puzzle + '\n')
+    return counts
+
+
 class TestBruteForceSolver(unittest.TestCase):
     def setUp(self):
         pass
@@ -112,6 +481,106 @@ class TestBruteForceSolver(unittest.TestCase):
         self.assertEqual(test_result_one_hot.dtype, 'bool')
         np.testing.assert_array_equal(test_result_one_hot, test_board_one_hot[1])
 
+        for engine in ENGINES:
+            np.testing.assert_array_equal(brute_force_solve(test_board_int[0], engine=engine), test_board_int[1])
+            np.testing.assert_array_equal(brute_force_solve(test_board_one_hot[0], engine=engine),
+                                          test_board_one_hot[1])
+        self.assertRaises(ValueError, lambda: brute_force_solve(test_board_int[0], engine='unknown'))
+
+    def test_brute_force_solve_batch(self):
+        self.assertRaises(ValueError, lambda: brute_force_solve_batch(np.zeros((2, 9, 9), dtype='int64')))
+        from make_data import make_boards, make_one_hot
+
+        test_boards = make_boards(6, 30)
+        hard = np.frombuffer(b'4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+                             .replace(b'.', b'0'), dtype='uint8').reshape(1, 9, 9)
+        test_boards_int = np.concatenate([test_boards[:, 0], hard])
+        test_result_int = brute_force_solve_batch(test_boards_int)
+        self.assertEqual(test_result_int.shape, (7, 9, 9))
+        self.assertEqual(test_result_int.dtype, 'uint8')
+        np.testing.assert_array_equal(test_result_int[:6], test_boards[:, 1])
+        np.testing.assert_array_equal(test_result_int[6], brute_force_solve(hard[0]))
+
+        test_boards_one_hot = np.array([make_one_hot(ref_board=b) for b in test_boards])
+        test_result_one_hot = brute_force_solve_batch(test_boards_one_hot[:, 0])
+        self.assertEqual(test_result_one_hot.shape, (6, 9, 9, 9))
+        self.assertEqual(test_result_one_hot.dtype, 'bool')
+        np.testing.assert_array_equal(test_result_one_hot, test_boards_one_hot[:, 1])
+
+        broken = test_boards_int.copy()
+        broken[2, 0, :2] = 49
+        self.assertRaises(ValueError, lambda: brute_force_solve_batch(broken))
+
+    def test_propagate_shards(self):
+        from make_data import make_boards
+        test_boards = np.tile(make_boards(10, 25)[:, 0], (70, 1, 1))
+        test_boards[5, 0, :2] = 49
+        clues = test_boards.reshape(-1, 81).astype('int64') - 48
+        candidates = np.ones((len(test_boards), 81, 9), dtype='bool')
+        candidates[clues > 0] = np.arange(1, 10) == clues[clues > 0][:, None]
+        expected = candidates.copy()
+        expected_failed = propagate_batch(expected)
+        self.assertEqual(np.flatnonzero(expected_failed).tolist(), [5])
+        self.assertEqual(choose_executor(len(candidates), 2), 'threads')
+        self.assertEqual(choose_executor(100, 8), 'serial')
+        for executor in EXECUTORS:
+            sharded = candidates.copy()
+            np.testing.assert_array_equal(propagate_shards(sharded, 2, executor), expected_failed)
+            np.testing.assert_array_equal(sharded, expected)
+        self.assertRaises(ValueError, lambda: propagate_shards(candidates, 2, 'fibers'))
+        test_boards[5] = test_boards[4]
+        np.testing.assert_array_equal(brute_force_solve_batch(test_boards, workers=2, executor='threads'),
+                                      brute_force_solve_batch(test_boards))
+
+    def test_solve_many(self):
+        from make_data import make_boards, make_one_hot
+        test_boards = make_boards(12, 30)
+        strings = [board.tobytes().decode() for board in test_boards[:, 0]]
+        expected = [board.tobytes().decode() for board in test_boards[:, 1]]
+        mixed = strings[:4] + list(test_boards[4:8, 0]) + [make_one_hot(ref_board=board)[0] for board in test_boards[8:]]
+        for workers in (None, 2):
+            results = list(solve_many(mixed, workers=workers, chunk_size=3))
+            self.assertEqual([board_to_string(board) for board, solution in results], strings)
+            self.assertEqual([board_to_string(solution) for board, solution in results], expected)
+            self.assertEqual([type(board) for board, solution in results], [type(solution) for board, solution in results])
+        unordered = list(solve_many(strings, workers=2, chunk_size=2, ordered=False))
+        self.assertEqual(sorted(solution for board, solution in unordered), sorted(expected))
+        self.assertEqual([solution for board, solution in solve_many(['11' + '0' * 79], workers=2)], [False])
+        self.assertRaises(ValueError, lambda: list(solve_many(['123'])))
+
+        pulled = []
+
+        def stream():
+            while True:
+                pulled.append(1)
+                yield strings[len(pulled) % len(strings)]
+
+        solving = solve_many(stream(), workers=2, chunk_size=4, in_flight=3)
+        for _ in range(20):
+            next(solving)
+        solving.close()
+        self.assertLessEqual(len(pulled), 20 + 3 * 4 + 4)
+
+    def test_solve_lines(self):
+        import io
+        easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+        hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+        lines = io.StringIO('\n'.join([easy, 'not a puzzle', '', hard, '11' + '0' * 79, easy[:80]]) + '\n')
+        out, err = io.StringIO(), io.StringIO()
+        counts = solve_lines(lines, out, err, workers=2, chunk_size=2)
+        self.assertEqual(counts, dict(puzzles=3, solved=2, unsolved=1, malformed=2))
+        self.assertEqual(out.getvalue().split(), [dlx.solve(easy), dlx.solve(hard), '11' + '0' * 79])
+        self.assertEqual(len(err.getvalue().splitlines()), 3)
+        self.assertIn('line 2: malformed', err.getvalue())
+
+        ## Puzzles that run out of budget keep their place too, in either mode.
+        for ordered in (True, False):
+            lines, out, err = io.StringIO('\n'.join([easy, hard, easy]) + '\n'), io.StringIO(), io.StringIO()
+            counts = solve_lines(lines, out, err, workers=2, chunk_size=1, ordered=ordered, max_nodes=5)
+            self.assertEqual(counts, dict(puzzles=3, solved=2, unsolved=1, malformed=0))
+            self.assertEqual(sorted(out.getvalue().split()), sorted([dlx.solve(easy)] * 2 + [hard]))
+            self.assertIn('out of budget', err.getvalue())
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,142 @@
+# Search budgets: bound a solve or generate call by search nodes and/or wall-clock time.
+# Engines take a Budget and call spend() once per search node; when it runs out, spend() raises
+# OutOfBudget. The public entry points (sudoku_generator.solve, brute_force_solve, make_board, ...)
+# take max_nodes and deadline instead, catch OutOfBudget and return a falsy BudgetExceeded, so a
+# batch job or pool worker gets a result back for a stalled board and moves on to the next one.
+
+import time
+import unittest
+
+CHECK_EVERY = 64  # search nodes between reads of the clock
+
+
+class OutOfBudget(Exception):
+    """Raised inside a search when its Budget runs out. partial is set on the way out
+    by calls that had something to report, e.g. the solutions counted so far."""
+
+    def __init__(self, reason):
+        Exception.__init__(self, reason)
+        self.reason = reason
+        self.partial = None
+
+
+class BudgetExceeded(object):
+    """What a budgeted call returns instead of its result when the budget ran out.
+    It is falsy, like a failed solve, and carries the reason ('nodes', 'deadline' or 'cancelled'),
+    the nodes searched, the seconds elapsed and partial, what was found so far (or None)."""
+
+    def __init__(self, reason, nodes, elapsed, partial=None):
+        self.reason = reason
+        self.nodes = nodes
+        self.elapsed = elapsed
+        self.partial = partial
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return 'BudgetExceeded(%r, nodes=%d, elapsed=%.3f)' % (self.reason, self.nodes, self.elapsed)
+
+
+class Budget(object):
+    """Allowance for one call: at most max_nodes search nodes, and at most deadline seconds
+    from when the Budget is made. Either may be None for no limit. cancel, if given, is a
+    callable polled along with the clock; the call stops ('cancelled') once it returns True."""
+
+    def __init__(self, max_nodes=None, deadline=None, cancel=None):
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.cancel = cancel
+        self.nodes = 0
+        self.started = time.time()
+        self.stop_at = None if deadline is None else self.started + deadline
+        self.next_check = 0  # the first spend() checks
+
+    def spend(self):
+        "Count one search node; raise OutOfBudget if that goes over the budget."
+        self.nodes += 1
+        if self.nodes >= self.next_check:
+            self.check()
+
+    def check(self):
+        if self.max_nodes is not None and self.nodes > self.max_nodes:
+            raise OutOfBudget('nodes')
+        if self.stop_at is not None and time.time() >= self.stop_at:
+            raise OutOfBudget('deadline')
+        if self.cancel is not None and self.cancel():
+            raise OutOfBudget('cancelled')
+        step = CHECK_EVERY if self.stop_at is not None or self.cancel is not None else float('inf')
+        if self.max_nodes is not None:
+            step = min(step, self.max_nodes + 1 - self.nodes)
+        self.next_check = self.nodes + step
+
+    def exceeded(self, error):
+        "The BudgetExceeded result for an OutOfBudget raised by this budget."
+        return BudgetExceeded(error.reason, self.nodes, time.time() - self.started, error.partial)
+
+
+def make_budget(max_nodes=None, deadline=None):
+    "A Budget for the given limits, or None when there are none (so engines skip the checks)."
+    if max_nodes is None and deadline is None:
+        return None
+    return Budget(max_nodes, deadline)
+
+
+class TestBudget(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_nodes(self):
+        budget = Budget(max_nodes=100)
+        for _ in range(100):
+            budget.spend()
+        with self.assertRaises(OutOfBudget) as caught:
+            budget.spend()
+        result = budget.exceeded(caught.exception)
+        self.assertFalse(result)
+        self.assertEqual((result.reason, result.nodes), ('nodes', 101))
+        self.assertIsNone(make_budget())
+
+    def test_deadline(self):
+        budget = Budget(deadline=0.01)
+        with self.assertRaises(OutOfBudget) as caught:
+            while True:
+                budget.spend()
+        self.assertEqual(caught.exception.reason, 'deadline')
+        self.assertGreaterEqual(budget.exceeded(caught.exception).elapsed, 0.01)
+        flag = []
+        budget = Budget(cancel=lambda: bool(flag))
+        for _ in range(1000):
+            budget.spend()
+        flag.append(True)
+        with self.assertRaises(OutOfBudget) as caught:
+            while True:
+                budget.spend()
+        self.assertEqual(caught.exception.reason, 'cancelled')
+        self.assertLessEqual(budget.nodes, 1000 + CHECK_EVERY)
+
+    def test_engines(self):
+        import sudoku_generator as sg
+        import brute_force_solver as bfs
+        import numpy as np
+        pathological = '.....6....59.....82....8....45........3........6..3.54...325..6..................'
+        for engine in sg.ENGINES:
+            result = sg.solve(pathological, engine=engine, max_nodes=50)
+            if engine == 'dict' or engine == 'bitmask':
+                self.assertIsInstance(result, BudgetExceeded)
+                self.assertEqual(result.nodes, 51)
+            counted = sg.count_solutions('.' * 81, limit=None, engine=engine, max_nodes=1000)
+            self.assertIsInstance(counted, BudgetExceeded)
+            self.assertGreater(counted.partial, 0)
+        self.assertIsInstance(sg.solve(pathological, mode='trail', deadline=0.05), BudgetExceeded)
+        self.assertEqual(sg.solve(pathological, engine='dlx', max_nodes=100000), sg.solve(pathological, engine='dlx'))
+        board = np.frombuffer(pathological.replace('.', '0').encode(), dtype='uint8').reshape(9, 9)
+        self.assertIsInstance(bfs.brute_force_solve(board, engine='bitmask', deadline=0.05), BudgetExceeded)
+        self.assertIsInstance(sg.random_puzzle(17, max_nodes=20), BudgetExceeded)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,403 @@
+# Conflict-driven clause learning (CDCL) solver for sudoku.
+# Variable v = square * 9 + digit is true when the square holds the digit; literal 2v is v and
+# 2v + 1 is its negation. Every square takes at least one digit and every digit goes somewhere in
+# every unit (324 long clauses); no square or unit holds two of the same (binary clauses, which are
+# stored as implication lists). On a conflict the solver learns the first-UIP nogood clause and
+# backjumps to the level where that clause becomes unit, restarts on a Luby schedule, keeps its
+# learned clauses across restarts and evicts the least active ones when the database is full.
+# The clause structures are built once per process; learned clauses are dropped between puzzles.
+
+import unittest
+from itertools import combinations
+
+import bitmask_engine as bm
+from budget import OutOfBudget
+
+N_VARS = 729
+TRUE, UNSET, FALSE = 1, 0, -1
+
+
+def luby(i):
+    "The i-th term (from 0) of the Luby sequence 1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8, ..."
+    size, seq = 1, 0
+    while size < i + 1:
+        seq += 1
+        size = 2 * size + 1
+    while size - 1 != i:
+        size = (size - 1) >> 1
+        seq -= 1
+        i %= size
+    return 1 << seq
+
+
+class SudokuCDCL(object):
+    """CDCL solver over the 729 (square, digit) variables of a 9x9 sudoku.
+    restart_base conflicts times the Luby sequence sets the restart schedule; max_learnts caps
+    the learned-clause database; var_decay and clause_decay set how fast activities fade."""
+
+    def __init__(self, restart_base=32, max_learnts=1000, var_decay=0.95, clause_decay=0.999):
+        self.restart_base = restart_base
+        self.max_learnts = max_learnts
+        self.var_decay = var_decay
+        self.clause_decay = clause_decay
+        self.implies = [[] for _ in range(2 * N_VARS)]  # literal -> [(implied literal, reason clause)]
+        self.clauses = []
+        groups = ([[s * 9 + d for d in range(9)] for s in range(bm.N_SQUARES)] +
+                  [[s * 9 + d for s in unit] for unit in bm.UNITS for d in range(9)])
+        pairs = set()
+        for group in groups:
+            self.clauses.append([2 * v for v in group])
+            pairs.update(combinations(group, 2))
+        for a, b in sorted(pairs):
+            self.implies[2 * a].append((2 * b + 1, [2 * b + 1, 2 * a + 1]))
+            self.implies[2 * b].append((2 * a + 1, [2 * a + 1, 2 * b + 1]))
+        self.busy = False
+
+    def reset(self):
+        "Clear the assignment and the learned clauses, and re-watch the problem clauses."
+        self.value = [UNSET] * (2 * N_VARS)
+        self.level = [0] * N_VARS
+        self.reason = [None] * N_VARS
+        self.activity = [0.0] * N_VARS
+        self.var_inc = 1.0
+        self.cla_inc = 1.0
+        self.trail = []
+        self.trail_lim = []
+        self.qhead = 0
+        self.learnts = []
+        self.cla_activity = {}
+        self.watches = [[] for _ in range(2 * N_VARS)]
+        for c in self.clauses:
+            self.watches[c[0]].append(c)
+            self.watches[c[1]].append(c)
+        self.conflicts = self.decisions = self.restarts = self.learned = self.evicted = 0
+
+    def enqueue(self, lit, reason):
+        value = self.value
+        value[lit], value[lit ^ 1] = TRUE, FALSE
+        self.level[lit >> 1] = len(self.trail_lim)
+        self.reason[lit >> 1] = reason
+        self.trail.append(lit)
+
+    def propagate(self):
+        "Propagate the pending trail; return a conflicting clause, or None."
+        value, level, reason, trail, watches, implies = (self.value, self.level, self.reason, self.trail,
+                                                          self.watches, self.implies)
+        push = trail.append
+        while self.qhead < len(trail):
+            p = trail[self.qhead]
+            self.qhead += 1
+            lvl = len(self.trail_lim)
+            for q, r in implies[p]:
+                vq = value[q]
+                if vq == TRUE:
+                    continue
+                if vq == FALSE:
+                    self.qhead = len(trail)
+                    return r
+                value[q], value[q ^ 1] = TRUE, FALSE
+                level[q >> 1], reason[q >> 1] = lvl, r
+                push(q)
+            false_lit = p ^ 1
+            ws = watches[false_lit]
+            i = j = 0
+            n = len(ws)
+            while i < n:
+                c = ws[i]
+                i += 1
+                if not c:
+                    continue  # Evicted learned clause
+                if c[0] == false_lit:
+                    c[0], c[1] = c[1], false_lit
+                first = c[0]
+                if value[first] == TRUE:
+                    ws[j] = c
+                    j += 1
+                    continue
+                for k in range(2, len(c)):
+                    if value[c[k]] != FALSE:
+                        c[1], c[k] = c[k], false_lit
+                        watches[c[1]].append(c)
+                        break
+                else:
+                    ws[j] = c
+                    j += 1
+                    if value[first] == FALSE:
+                        while i < n:
+                            ws[j] = ws[i]
+                            j += 1
+                            i += 1
+                        del ws[j:]
+                        self.qhead = len(trail)
+                        return c
+                    value[first], value[first ^ 1] = TRUE, FALSE
+                    level[first >> 1], reason[first >> 1] = lvl, c
+                    push(first)
+            del ws[j:]
+        return None
+
+    def analyze(self, confl):
+        """First-UIP conflict analysis: return the learned clause (asserting literal first,
+        the literal of the backjump level second) and the level to backjump to."""
+        level, reason, trail, activity = self.level, self.reason, self.trail, self.activity
+        current = len(self.trail_lim)
+        seen = set()
+        learnt = [None]
+        counter = 0
+        p = None
+        idx = len(trail) - 1
+        clause = confl
+        while True:
+            if id(clause) in self.cla_activity:
+                self.bump_clause(clause)
+            for q in (clause if p is None else clause[1:]):
+                v = q >> 1
+                if v not in seen and level[v] > 0:
+                    seen.add(v)
+                    activity[v] += self.var_inc
+                    if activity[v] > 1e100:
+                        self.rescale_vars()
+                    if level[v] == current:
+                        counter += 1
+                    else:
+                        learnt.append(q)
+            while trail[idx] >> 1 not in seen:
+                idx -= 1
+            p = trail[idx]
+            idx -= 1
+            seen.discard(p >> 1)
+            counter -= 1
+            if not counter:
+                break
+            clause = reason[p >> 1]
+        learnt[0] = p ^ 1
+        if len(learnt) == 1:
+            return learnt, 0
+        top = max(range(1, len(learnt)), key=lambda i: level[learnt[i] >> 1])
+        learnt[1], learnt[top] = learnt[top], learnt[1]
+        return learnt, level[learnt[1] >> 1]
+
+    def rescale_vars(self):
+        self.activity[:] = [a * 1e-100 for a in self.activity]
+        self.var_inc *= 1e-100
+
+    def bump_clause(self, clause):
+        key = id(clause)
+        self.cla_activity[key] += self.cla_inc
+        if self.cla_activity[key] > 1e20:
+            for k in self.cla_activity:
+                self.cla_activity[k] *= 1e-20
+            self.cla_inc *= 1e-20
+
+    def cancel_until(self, lvl):
+        "Undo every assignment above decision level lvl."
+        if len(self.trail_lim) <= lvl:
+            return
+        value, reason, trail = self.value, self.reason, self.trail
+        start = self.trail_lim[lvl]
+        for lit in trail[start:]:
+            value[lit] = value[lit ^ 1] = UNSET
+            reason[lit >> 1] = None
+        del trail[start:]
+        del self.trail_lim[lvl:]
+        self.qhead = len(trail)
+
+    def reduce_db(self):
+        "Evict the less active half of the learned clauses, keeping binary and reason clauses."
+        reason, value = self.reason, self.value
+        act = self.cla_activity
+        self.learnts.sort(key=lambda c: act[id(c)])
+        keep = []
+        half = len(self.learnts) // 2
+        for i, c in enumerate(self.learnts):
+            locked = reason[c[0] >> 1] is c and value[c[0]] == TRUE
+            if i < half and len(c) > 2 and not locked:
+                del act[id(c)]
+                del c[:]  # Watch lists drop emptied clauses lazily
+                self.evicted += 1
+            else:
+                keep.append(c)
+        self.learnts = keep
+
+    def add_clause(self, lits):
+        "Add a problem clause at level 0; return False if that makes the puzzle unsatisfiable."
+        value = self.value
+        if any(value[q] == TRUE for q in lits):
+            return True
+        lits = [q for q in lits if value[q] != FALSE]
+        if not lits:
+            return False
+        if len(lits) == 1:
+            self.enqueue(lits[0], None)
+            return True
+        self.watches[lits[0]].append(lits)
+        self.watches[lits[1]].append(lits)
+        return True
+
+    def pick_branch(self):
+        "The unassigned variable with the highest activity (lowest index on ties), or -1."
+        value, activity = self.value, self.activity
+        best, v = -1.0, -1
+        for u in range(N_VARS):
+            if value[2 * u] == UNSET and activity[u] > best:
+                best, v = activity[u], u
+        return v
+
+    def solutions(self, grid, budget=None):
+        """Generate the solutions of grid as 81-char digit strings. After each solution a
+        clause blocking it is added, so the search continues with its learned clauses.
+        With a budget.Budget, every decision and conflict is charged to it (OutOfBudget is raised when it runs out).
+        Only one generator may run on a solver at a time."""
+        if self.busy:
+            raise RuntimeError('This CDCL solver is already in use by an unfinished solutions() generator')
+        self.busy = True
+        try:
+            self.reset()
+            given = bm.grid_digits(grid)
+            for s, d in enumerate(given):
+                if d >= 0 and not self.add_clause([2 * (s * 9 + d)]):
+                    return
+            if self.propagate() is not None:
+                return
+            restart_at = self.restart_base * luby(0)
+            while True:
+                confl = self.propagate()
+                if confl is not None:
+                    self.conflicts += 1
+                    if budget is not None:
+                        budget.spend()
+                    if not self.trail_lim:
+                        return  # Conflict without decisions: no (more) solutions
+                    learnt, back = self.analyze(confl)
+                    self.cancel_until(back)
+                    if len(learnt) == 1:
+                        self.enqueue(learnt[0], None)
+                    else:
+                        self.watches[learnt[0]].append(learnt)
+                        self.watches[learnt[1]].append(learnt)
+                        self.learnts.append(learnt)
+                        self.cla_activity[id(learnt)] = 0.0
+                        self.bump_clause(learnt)
+                        self.enqueue(learnt[0], learnt)
+                    self.learned += 1
+                    self.var_inc /= self.var_decay
+                    self.cla_inc /= self.clause_decay
+                    continue
+                if self.conflicts >= restart_at:
+                    self.restarts += 1
+                    restart_at = self.conflicts + self.restart_base * luby(self.restarts)
+                    self.cancel_until(0)
+                    continue
+                if len(self.learnts) >= self.max_learnts:
+                    self.reduce_db()
+                v = self.pick_branch()
+                if v < 0:
+                    solution = [0] * bm.N_SQUARES
+                    for lit in self.trail:
+                        if not lit & 1:
+                            s, d = divmod(lit >> 1, 9)
+                            solution[s] = d
+                    yield ''.join(chr(49 + d) for d in solution)
+                    blocking = [2 * (s * 9 + solution[s]) + 1 for s in range(bm.N_SQUARES) if given[s] < 0]
+                    self.cancel_until(0)
+                    if not self.add_clause(blocking):
+                        return
+                    continue
+                self.decisions += 1
+                if budget is not None:
+                    budget.spend()
+                self.trail_lim.append(len(self.trail))
+                self.enqueue(2 * v, None)
+        finally:
+            self.busy = False
+
+    def solve(self, grid, budget=None):
+        "Return the first solution of grid as an 81-char string, or False if it has none."
+        for solution in self.solutions(grid, budget):
+            return solution
+        return False
+
+    def count_solutions(self, grid, limit=2, budget=None):
+        """Count the solutions of grid, stopping as soon as limit of them are found (limit=None counts all).
+        If budget runs out, the OutOfBudget raised carries the count so far as partial."""
+        n = 0
+        try:
+            for _ in self.solutions(grid, budget):
+                n += 1
+                if n == limit:
+                    break
+        except OutOfBudget as e:
+            e.partial = n
+            raise
+        return n
+
+
+_solver = SudokuCDCL()
+
+
+def solutions(grid, budget=None):
+    "Generate every solution of grid as an 81-char string, using the shared solver."
+    return _solver.solutions(grid, budget)
+
+
+def solve(grid, budget=None):
+    return _solver.solve(grid, budget)
+
+
+def count_solutions(grid, limit=2, budget=None):
+    return _solver.count_solutions(grid, limit, budget)
+
+
+class TestCDCLEngine(unittest.TestCase):
+    easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+
+    def setUp(self):
+        pass
+
+    def test_luby(self):
+        self.assertEqual([luby(i) for i in range(15)], [1, 1, 2, 1, 1, 2, 4, 1, 1, 2, 1, 1, 2, 4, 8])
+
+    def test_solve(self):
+        import dlx_engine as dlx
+        for grid in (self.easy, self.hard):
+            self.assertEqual(solve(grid), dlx.solve(grid))
+        self.assertFalse(solve('11' + '.' * 79))
+        self.assertFalse(solve('12345678.' + '........9' + '.' * 63))
+
+    def test_count_solutions(self):
+        solution = solve(self.easy)
+        self.assertEqual(count_solutions(self.hard), 1)
+        self.assertEqual(count_solutions('.' * 18 + solution[18:], limit=None), 4)
+        self.assertEqual(count_solutions('.' * 27 + solution[27:], limit=None), 168)
+        self.assertEqual(count_solutions('.' * 81, limit=20), 20)
+
+    def test_generator_engine(self):
+        import sudoku_generator as sg
+        pathological = '.....6....59.....82....8....45........3........6..3.54...325..6..................'
+        self.assertEqual(sg.solve(self.hard, engine='cdcl'), sg.solve(self.hard, engine='dlx'))
+        self.assertEqual(sg.count_solutions(pathological, engine='cdcl'), 2)  # Not a proper puzzle
+        self.assertRaises(ValueError, lambda: sg.parse_grid(self.hard, engine='cdcl'))
+        self.assertRaises(ValueError, lambda: sg.solve(self.hard, engine='cdcl', level=2))
+        import random
+        from unittest import mock
+        random.seed(5)
+        with mock.patch.object(SudokuCDCL, 'count_solutions', autospec=True,
+                               side_effect=SudokuCDCL.count_solutions) as called:
+            puzzle = sg.random_puzzle(30, engine='cdcl')
+        self.assertGreaterEqual(called.call_count, 51)
+        self.assertEqual(sg.count_solutions(puzzle, limit=None, engine='bitmask'), 1)
+
+    def test_learning(self):
+        solver = SudokuCDCL(restart_base=4, max_learnts=20)
+        self.assertEqual(solver.solve(self.hard), solve(self.hard))
+        self.assertGreater(solver.learned, 0)
+        self.assertGreater(solver.restarts, 0)
+        self.assertLessEqual(len(solver.learnts), 20)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
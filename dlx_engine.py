@@ -0,0 +1,266 @@
+# Dancing Links (Knuth's Algorithm X) exact-cover solver for sudoku.
+# The 729 candidate rows (square, digit) cover 4 of the 324 constraint columns each:
+# the square is filled, and the digit appears once in the square's row, column and box.
+# The link structure is built once per process and restored before each puzzle.
+
+import unittest
+
+from budget import OutOfBudget
+
+N_COLUMNS = 324
+N_ROWS = 729
+
+
+def row_columns(r):
+    "The four constraint columns (1-based header indices) covered by candidate row r = square * 9 + digit."
+    s, d = divmod(r, 9)
+    row, col = divmod(s, 9)
+    box = (row // 3) * 3 + col // 3
+    return (1 + s, 1 + 81 + row * 9 + d, 1 + 162 + col * 9 + d, 1 + 243 + box * 9 + d)
+
+
+class SudokuDLX(object):
+    """Toroidal doubly linked exact-cover matrix for 9x9 sudoku, stored in flat lists.
+    Node 0 is the root, nodes 1..324 the column headers and the rest four nodes per candidate row."""
+
+    def __init__(self):
+        n = 1 + N_COLUMNS + 4 * N_ROWS
+        L, R, U, D = [0] * n, [0] * n, list(range(n)), list(range(n))
+        C, ROW, S = [0] * n, [-1] * n, [0] * (1 + N_COLUMNS)
+        for c in range(1 + N_COLUMNS):
+            L[c], R[c], C[c] = c - 1, c + 1, c
+        L[0], R[N_COLUMNS] = N_COLUMNS, 0
+        self.row_nodes = []
+        node = 1 + N_COLUMNS
+        for r in range(N_ROWS):
+            first = node
+            for c in row_columns(r):
+                C[node], ROW[node] = c, r
+                U[node], D[node] = U[c], c
+                D[U[c]] = node
+                U[c] = node
+                S[c] += 1
+                L[node], R[node] = node - 1, node + 1
+                node += 1
+            L[first], R[node - 1] = node - 1, first
+            self.row_nodes.append(first)
+        self.L, self.R, self.U, self.D, self.C, self.ROW, self.S = L, R, U, D, C, ROW, S
+        self.initial = (L[:], R[:], U[:], D[:], S[:])
+        self.dirty = False
+        self.busy = False
+
+    def reset(self):
+        "Restore every link to its freshly built state."
+        L0, R0, U0, D0, S0 = self.initial
+        self.L[:], self.R[:], self.U[:], self.D[:], self.S[:] = L0, R0, U0, D0, S0
+        self.dirty = False
+
+    def cover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        R[L[c]], L[R[c]] = R[c], L[c]
+        i = D[c]
+        while i != c:
+            j = R[i]
+            while j != i:
+                U[D[j]], D[U[j]] = U[j], D[j]
+                S[C[j]] -= 1
+                j = R[j]
+            i = D[i]
+
+    def uncover(self, c):
+        L, R, U, D, C, S = self.L, self.R, self.U, self.D, self.C, self.S
+        i = U[c]
+        while i != c:
+            j = L[i]
+            while j != i:
+                S[C[j]] += 1
+                U[D[j]] = D[U[j]] = j
+                j = L[j]
+            i = U[i]
+        R[L[c]] = L[R[c]] = c
+
+    def solutions(self, grid, budget=None):
+        """Generate the solutions of grid as 81-char digit strings.
+        With a budget.Budget, every node is charged to it (OutOfBudget is raised when it runs out).
+        Only one generator may run on a matrix at a time."""
+        if self.busy:
+            raise RuntimeError('This DLX matrix is already in use by an unfinished solutions() generator')
+        chars = [c for c in grid if c in '123456789' or c in '0.']
+        assert len(chars) == 81
+        if self.dirty:
+            self.reset()
+        self.busy = self.dirty = True
+        try:
+            L, R, D, C, ROW, S = self.L, self.R, self.D, self.C, self.ROW, self.S
+            cover, uncover = self.cover, self.uncover
+            covered = bytearray(1 + N_COLUMNS)
+            givens = []
+            for s, ch in enumerate(chars):
+                if ch in '0.':
+                    continue
+                node = self.row_nodes[s * 9 + ord(ch) - 49]
+                j = node
+                while True:
+                    if covered[C[j]]:
+                        return  # Contradiction: the given clashes with an earlier one
+                    j = R[j]
+                    if j == node:
+                        break
+                while True:
+                    covered[C[j]] = 1
+                    cover(C[j])
+                    j = R[j]
+                    if j == node:
+                        break
+                givens.append(node)
+            solution = chars[:]
+            stack = []  # chosen row node per level
+            while True:
+                ## Forward: pick the column with the fewest rows, or report a solution.
+                if R[0] == 0:
+                    for node in stack:
+                        s, d = divmod(ROW[node], 9)
+                        solution[s] = chr(49 + d)
+                    yield ''.join(solution)
+                    r = None
+                else:
+                    c, best = 0, N_ROWS + 1
+                    j = R[0]
+                    while j:
+                        if S[j] < best:
+                            c, best = j, S[j]
+                            if best < 2:
+                                break
+                        j = R[j]
+                    if best:
+                        cover(c)
+                        r = D[c]
+                    else:
+                        r = None  # Dead end: a constraint no row can satisfy
+                ## Backtrack until there is a row to try.
+                while r is None or r == C[r]:
+                    if r is not None:
+                        uncover(C[r])
+                    if not stack:
+                        for node in reversed(givens):
+                            j = L[node]
+                            while True:
+                                uncover(C[j])
+                                if j == node:
+                                    break
+                                j = L[j]
+                        self.dirty = False
+                        return
+                    r = stack.pop()
+                    j = L[r]
+                    while j != r:
+                        uncover(C[j])
+                        j = L[j]
+                    r = D[r]
+                if budget is not None:
+                    budget.spend()
+                stack.append(r)
+                j = R[r]
+                while j != r:
+                    cover(C[j])
+                    j = R[j]
+        finally:
+            self.busy = False
+
+    def solve(self, grid, budget=None):
+        "Return the first solution of grid as an 81-char string, or False if it has none."
+        for solution in self.solutions(grid, budget):
+            return solution
+        return False
+
+    def count_solutions(self, grid, limit=2, budget=None):
+        """Count the solutions of grid, stopping as soon as limit of them are found (limit=None counts all).
+        If budget runs out, the OutOfBudget raised carries the count so far as partial."""
+        n = 0
+        try:
+            for _ in self.solutions(grid, budget):
+                n += 1
+                if n == limit:
+                    break
+        except OutOfBudget as e:
+            e.partial = n
+            raise
+        return n
+
+
+_matrix = SudokuDLX()
+
+
+def solutions(grid, budget=None):
+    "Generate every solution of grid as an 81-char string, using the shared matrix."
+    return _matrix.solutions(grid, budget)
+
+
+def solve(grid, budget=None):
+    return _matrix.solve(grid, budget)
+
+
+def count_solutions(grid, limit=2, budget=None):
+    return _matrix.count_solutions(grid, limit, budget)
+
+
+class TestDLXEngine(unittest.TestCase):
+    easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+
+    def setUp(self):
+        pass
+
+    def test_solve(self):
+        import bitmask_engine as bm
+        for grid in (self.easy, self.hard):
+            self.assertEqual(solve(grid), bm.to_string(bm.solve(grid)))
+        self.assertFalse(solve('11' + '.' * 79))
+        self.assertFalse(solve('12345678.' + '........9' + '.' * 63))
+
+    def test_count_and_enumerate(self):
+        solution = solve(self.easy)
+        self.assertEqual(count_solutions(self.hard), 1)
+        self.assertEqual(count_solutions('.' * 18 + solution[18:], limit=None), 4)
+        self.assertEqual(count_solutions('.' * 18 + solution[18:], limit=3), 3)
+        self.assertEqual(count_solutions('.' * 81, limit=50), 50)
+        found = list(solutions('.' * 18 + solution[18:]))
+        self.assertEqual(len(set(found)), 4)
+        self.assertIn(solution, found)
+
+    def test_generator_engine(self):
+        import random
+        import sudoku_generator as sg
+        self.assertEqual(sg.solve(self.hard, engine='dlx'), sg.solve(self.hard, engine='bitmask'))
+        self.assertRaises(ValueError, lambda: sg.parse_grid(self.hard, engine='dlx'))
+        from unittest import mock
+        random.seed(3)
+        ## The uniqueness checks must run on DLX, with repair (23 clues) or without (30).
+        for num_clues in (30, 23):
+            with mock.patch.object(SudokuDLX, 'solutions', autospec=True, side_effect=SudokuDLX.solutions) as called:
+                puzzle = sg.random_puzzle(num_clues, engine='dlx')
+            self.assertGreaterEqual(called.call_count, 81 - num_clues)
+            self.assertEqual(81 - puzzle.count('0'), num_clues)
+            self.assertEqual(sg.count_solutions(puzzle, limit=None, engine='bitmask'), 1)
+
+    def test_matrix_is_restored(self):
+        matrix = SudokuDLX()
+        initial = matrix.initial
+        self.assertEqual(matrix.count_solutions(self.hard, limit=None), 1)
+        self.assertFalse(matrix.dirty)
+        self.assertEqual((matrix.L, matrix.R, matrix.U, matrix.D, matrix.S), initial)
+        matrix.solve('.' * 81)  # stops early, leaving links to be reset by the next call
+        self.assertTrue(matrix.dirty)
+        self.assertEqual(matrix.solve(self.easy), solve(self.easy))
+        running = matrix.solutions(self.easy)
+        next(running)
+        self.assertRaises(RuntimeError, lambda: next(matrix.solutions(self.easy)))
+        running.close()
+        self.assertEqual(matrix.solve(self.hard), solve(self.hard))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,161 @@
+# A bank of solved grids, and samplers that turn it into fresh grids cheaply.
+# Building a full grid by random assignment (sudoku_generator.random_board()) takes over a
+# millisecond; instead, a few thousand are built once and saved as a .npy file of 81-byte
+# ASCII rows, which is memory-mapped when read. Fresh grids are drawn from it by applying
+# random validity-preserving transforms to a random bank grid: relabelling the digits,
+# permuting the rows within each band and the bands themselves, the same for columns and
+# stacks, and transposing. Each bank grid has up to 9! * 6^8 * 2 (about 1.2e12) variants.
+
+import functools
+import itertools
+import random
+import unittest
+
+import numpy as np
+
+
+def build_bank(path, size, seed=None):
+    """Build size distinct grids with random_board() and save them to path as a (size, 81) uint8 array
+    of ASCII digits, the format of make_board() solutions.
+    :return: the bank, memory-mapped from path"""
+    from sudoku_generator import random_board
+    state = random.getstate()
+    random.seed(seed)
+    try:
+        grids = set()
+        while len(grids) < size:
+            grids.add(random_board('bitmask'))
+    finally:
+        random.setstate(state)
+    bank = np.frombuffer(''.join(sorted(grids)).encode(), dtype='uint8').reshape(size, 81)
+    np.save(path, bank)
+    open_bank.cache_clear()
+    return open_bank(path)
+
+
+@functools.lru_cache(maxsize=None)
+def open_bank(path):
+    "The bank saved at path, memory-mapped read-only; opened once per process."
+    bank = np.load(path, mmap_mode='r')
+    if bank.ndim != 2 or bank.shape[1] != 81 or bank.dtype != np.uint8:
+        raise ValueError('%s does not hold a grid bank: expected a (grids, 81) uint8 array, found %s %s.'
+                         % (path, bank.shape, bank.dtype))
+    return bank
+
+
+# The 1296 orders of 9 rows (or columns) that keep each band together: bands in any order, rows within each in any order.
+LINE_ORDERS = np.array([[3 * b + i for b, within in zip(bands, withins) for i in within]
+                        for bands in itertools.permutations(range(3))
+                        for withins in itertools.product(itertools.permutations(range(3)), repeat=3)], dtype='intp')
+CHUNK = 2048  # grids sample_grids() transforms at a time, so its temporaries stay in cache
+
+
+@functools.lru_cache(maxsize=None)
+def labellings():
+    "All 9! relabellings of the ASCII digits, as a (362880, 9) uint8 array: drawing a row is cheaper than a shuffle."
+    digits = itertools.permutations(range(49, 58))
+    return np.fromiter(itertools.chain.from_iterable(digits), dtype='uint8').reshape(-1, 9)
+
+
+def sample_grids(bank, n, rng=None):
+    """n fresh grids, each a randomly transformed random grid of bank, drawn in vectorized chunks.
+    Rows and columns move as 9-byte records, so of the 81 cells only the relabelling indexes each one.
+    :param bank: (grids, 81) uint8 array from open_bank(), or the path of one
+    :param rng: np.random.Generator, or None for a new one seeded from the random module
+    :return: (n, 9, 9) uint8 array of ASCII digits"""
+    if isinstance(bank, str):
+        bank = open_bank(bank)
+    if rng is None:
+        rng = np.random.default_rng(random.getrandbits(64))
+    lines = np.ascontiguousarray(bank).view('V9')
+    labels = labellings()
+    out = np.empty((n, 9, 9), dtype='uint8')
+    for start in range(0, n, CHUNK):
+        m = min(CHUNK, n - start)
+        rows = LINE_ORDERS[rng.integers(len(LINE_ORDERS), size=m)]
+        cols = LINE_ORDERS[rng.integers(len(LINE_ORDERS), size=m)]
+        grids = lines[rng.integers(len(bank), size=m)[:, None], rows].view('uint8').reshape(m, 9, 9)
+        ## Permute the columns as the rows of the transpose; half the grids are then transposed back.
+        grids = np.ascontiguousarray(grids.transpose(0, 2, 1)).view('V9').reshape(m, 9)
+        grids = grids[np.arange(m)[:, None], cols].view('uint8').reshape(m, 9, 9)
+        back = rng.random(m) < 0.5
+        grids[back] = grids[back].transpose(0, 2, 1)
+        relabel = labels[rng.integers(len(labels), size=m)].reshape(-1)
+        out[start:start + m] = relabel[(np.arange(m, dtype='int32') * 9 - 49)[:, None, None] + grids]
+    return out
+
+
+def shuffled_lines():
+    "A random order of range(9) that keeps each band together."
+    bands = random.sample(range(3), 3)
+    return [3 * b + i for b in bands for i in random.sample(range(3), 3)]
+
+
+def sample_grid(bank):
+    """One fresh grid, transformed like those of sample_grids() but with the random module, so it
+    follows random.seed() and costs no numpy overhead for a single grid. Returns an 81-char string."""
+    if isinstance(bank, str):
+        bank = open_bank(bank)
+    grid = bank[random.randrange(len(bank))].tobytes().decode()
+    rows, cols = shuffled_lines(), shuffled_lines()
+    if random.random() < 0.5:
+        grid = ''.join([grid[9 * r + c] for c in cols for r in rows])  # transposed
+    else:
+        grid = ''.join([grid[9 * r + c] for r in rows for c in cols])
+    return grid.translate(str.maketrans('123456789', ''.join(random.sample('123456789', 9))))
+
+
+def valid_grids(grids):
+    "Whether each of the (n, 9, 9) grids has every digit once in each row, column and box."
+    grids = np.asarray(grids).reshape(-1, 9, 9)
+    boxes = grids.reshape(-1, 3, 3, 3, 3).swapaxes(2, 3).reshape(-1, 9, 9)
+    full = [np.sort(units, axis=2) == np.arange(49, 58) for units in (grids, grids.swapaxes(1, 2), boxes)]
+    return np.all([f.all(axis=(1, 2)) for f in full], axis=0)
+
+
+class TestGridBank(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_bank(self):
+        import os
+        import tempfile
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'grids.npy')
+            bank = build_bank(path, 20, seed=1)
+            self.assertEqual(bank.shape, (20, 81))
+            self.assertIsInstance(bank, np.memmap)
+            self.assertTrue(valid_grids(bank).all())
+            self.assertEqual(len(set(bank.tobytes()[i:i + 81] for i in range(0, 20 * 81, 81))), 20)
+            self.assertTrue((build_bank(os.path.join(tmp, 'again.npy'), 20, seed=1) == bank).all())
+            np.save(os.path.join(tmp, 'bad.npy'), np.zeros((3, 9, 9), dtype='uint8'))
+            self.assertRaises(ValueError, lambda: open_bank(os.path.join(tmp, 'bad.npy')))
+
+            grids = sample_grids(path, 1000, np.random.default_rng(2))
+            self.assertEqual((grids.shape, grids.dtype), ((1000, 9, 9), np.uint8))
+            self.assertTrue(valid_grids(grids).all())
+            self.assertEqual(len(set(g.tobytes() for g in grids)), 1000)
+
+            random.seed(3)
+            grid = sample_grid(path)
+            self.assertTrue(valid_grids(np.frombuffer(grid.encode(), dtype='uint8')).all())
+            random.seed(3)
+            self.assertEqual(sample_grid(path), grid)
+            swapped = grid[1] + grid[0] + grid[2:]
+            self.assertFalse(valid_grids(np.frombuffer(swapped.encode(), dtype='uint8'))[0])
+
+            from make_data import make_board
+            import dlx_engine as dlx
+            board = make_board(30, bank=path)
+            self.assertEqual(81 - board[0].tobytes().count(b'0'), 30)
+            self.assertEqual(board[1].tobytes().decode(), dlx.solve(board[0].tobytes().decode()))
+            board = make_board(24, minimal=True, bank=path)
+            self.assertEqual(dlx.count_solutions(board[0].tobytes().decode()), 1)
+            open_bank.cache_clear()
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
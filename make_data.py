@@ -1,8 +1,11 @@
 import os
-from itertools import  groupby
+import queue
+import random
+import multiprocessing
 import h5py
-from time import sleep
 from sudoku_generator import *
+from budget import BudgetExceeded
+from shared_arrays import SharedArray
 
 import unittest
 import numpy as np
@@ -16,50 +19,73 @@ class GenerationLimit(Exception):
     pass
 
 
-def make_board(num_clues, single_solution=True):
+BUDGET_TRIES = 20  # boards in a row that may run out of max_nodes or deadline before their group is given up
+
+
+def check_budget_tries(failures, num_clues, found):
+    """
+    :raises GenerationLimit once failures boards in a row have run out of budget
+    :param found: budget.BudgetExceeded of the last of them
+    """
+    if failures >= BUDGET_TRIES:
+        raise GenerationLimit('%d boards in a row with %d clues ran out of budget (%s).'
+                              % (failures, num_clues, found.reason))
+
+
+def make_board(num_clues, single_solution=True, max_nodes=None, deadline=None, minimal=False, bank=None):
     """
     Makes a sudoku board with num_clues.
     :raises TheoreticalLimit if 81 < num_clues < 17
     :param num_clues: int number of clues
+    :param single_solution: bool, if true the board is dug so that it keeps exactly one solution
+    :param minimal: bool, if true the board is also minimal: no clue can be removed and leave it one solution
+    :param bank: str path of a grid_bank.build_bank() file to draw full grids from, or None to build each one
+    :param max_nodes: int cap on search nodes for generating the board, or None
+    :param deadline: float seconds allowed for generating the board, or None
     :return: np.ndarray shape=(2,) where
             [0] is np.ndarray of shape=(9, 9), dtype='uint8', containing board
             [1] is np.ndarray of shape=(9, 9), dtype='uint8', containing solution
+            or budget.BudgetExceeded if max_nodes or deadline ran out first
     """
     if not 16 < num_clues < 82:
         raise TheoreticalLimit("17-81 is the theoretical range of clues, but %s were given." % num_clues)
 
-    rows = 'ABCDEFGHI'
-    cols = '123456789'
-
-    board_string = random_puzzle(num_clues, single_solution)
-    solution_dict = solve(board_string)
+    puzzle = random_puzzle_and_solution(num_clues, single_solution, max_nodes=max_nodes, deadline=deadline,
+                                        minimal=minimal, bank=bank)
+    if isinstance(puzzle, BudgetExceeded):
+        return puzzle
+    board_string, solution_string = puzzle
 
-    solution_string = ""
-
-    for r in rows:
-        solution_string += (''.join(solution_dict[r + c] for c in cols))
-
-    board_uint = np.fromstring(board_string, dtype='uint8').reshape(9, 9)
-    solution_uint = np.fromstring(solution_string, dtype='uint8').reshape(9, 9)
+    board_uint = np.frombuffer(board_string.encode(), dtype='uint8').reshape(9, 9)
+    solution_uint = np.frombuffer(solution_string.encode(), dtype='uint8').reshape(9, 9)
 
     return np.array([board_uint, solution_uint], dtype='uint8')
 
 
-def make_one_hot(ref_board=None, num_clues=None, single_solution=True):
+def make_one_hot(ref_board=None, num_clues=None, single_solution=True, max_nodes=None, deadline=None, minimal=False,
+                 bank=None):
     """
     Converts an existing ref_board, or a new ref_board with num_clues, to a one_hot representation.
     :raises ValueError if both ref_board and num_clues are not specified
     :param ref_board: np.ndarray of shape,dtype returned from make_board()
     :param num_clues: int number of clues
+    :param minimal: bool, if true make a minimal board (see make_board())
+    :param bank: str path of a grid bank for make_board(), or None
+    :param max_nodes: int cap on search nodes for make_board(), or None
+    :param deadline: float seconds allowed for make_board(), or None
     :return: np.ndarray shape=(2,) where
             [0] is np.ndarray of shape=(9, 9, 9), dtype='bool', containing board
             [1] is np.ndarray of shape=(9, 9, 9), dtype='bool', containing solution
             where each "cell" is a one_hot vector dim=9
+            or budget.BudgetExceeded if make_board() ran out of budget
     """
     if ref_board is None and num_clues is None:
         raise ValueError("Must specifiy ref_board or num_clues")
     elif num_clues is not None:
-        ref_board = make_board(num_clues=num_clues, single_solution=single_solution)
+        ref_board = make_board(num_clues=num_clues, single_solution=single_solution, max_nodes=max_nodes,
+                               deadline=deadline, minimal=minimal, bank=bank)
+        if isinstance(ref_board, BudgetExceeded):
+            return ref_board
     onehots = {48: [0, 0, 0, 0, 0, 0, 0, 0, 0],
                49: [1, 0, 0, 0, 0, 0, 0, 0, 0],
                50: [0, 1, 0, 0, 0, 0, 0, 0, 0],
@@ -92,43 +118,287 @@ def make_one_hot(ref_board=None, num_clues=None, single_solution=True):
     return np.array([bool_board, bool_solution], dtype=np.bool)
 
 
-def make_boards(num_boards, num_clues, one_hot=False, single_solution=True):
+def worker_seeds(seed, workers):
+    """
+    Derives independent random streams from one master seed, one per worker.
+    :param seed: int or sequence of ints master seed
+    :param workers: int number of streams
+    :return: list of int seeds for random.seed()
+    """
+    return [int(stream.generate_state(1)[0]) for stream in np.random.SeedSequence(seed).spawn(workers)]
+
+
+def make_boards_share(task):
+    """
+    Pool worker: makes one worker's share of make_boards() with its own seeded random stream,
+    and writes it into its slots of the shared output array.
+    :param task: tuple (num_boards, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank, seed,
+                        spec of the SharedArray to write to, first slot)
+    :return: int number of boards written
+    """
+    num_boards, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank, seed, spec, start = task
+    random.seed(seed)
+    boards = make_boards(num_boards, num_clues, one_hot=one_hot, single_solution=single_solution, max_nodes=max_nodes,
+                         deadline=deadline, minimal=minimal, bank=bank)
+    with SharedArray.attach(spec) as shared:
+        shared.array[:, start:start + num_boards] = boards.swapaxes(0, 1)
+    return num_boards
+
+
+def make_slots(task):
+    """
+    Pool worker: makes the boards for slots start:stop of a shared output array, each from its own
+    random stream of seed keyed by its slot, so a board does not depend on how slots are split into tasks.
+    :param task: tuple (start, stop, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank,
+                        list of ints seed, spec of the SharedArray to write to)
+    :return: int number of boards written
+    """
+    start, stop, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank, seed, spec = task
+    with SharedArray.attach(spec) as shared:
+        for slot in range(start, stop):
+            random.seed(worker_seeds(seed + [slot], 1)[0])
+            shared.array[:, slot] = make_boards(1, num_clues, one_hot=one_hot, single_solution=single_solution,
+                                                max_nodes=max_nodes, deadline=deadline, minimal=minimal,
+                                                bank=bank)[0]
+    return stop - start
+
+
+def board_layout(one_hot):
+    """
+    :return: (shape of one board, dtype) for make_board() boards, or make_one_hot() boards if one_hot
+    """
+    if one_hot:
+        return (9, 9, 9), 'bool'
+    return (9, 9), 'uint8'
+
+
+def make_boards(num_boards, num_clues, one_hot=False, single_solution=True, max_nodes=None, deadline=None,
+                workers=None, seed=None, pool=None, out=None, minimal=False, bank=None):
     """
     Make num_boards each with num_clues.  If one_hot, return as one_hot boards.
     :raises TheoreticalLimit if not possible to make num_boards with num_clues
+    :raises GenerationLimit if BUDGET_TRIES boards in a row run out of max_nodes or deadline
     :param num_boards: int number of boards to make
     :param num_clues: int number of clues per board
+    :param max_nodes: int cap on search nodes per board; a board that runs out is dropped and another one made,
+                      up to BUDGET_TRIES in a row
+    :param deadline: float seconds allowed per board; a board that runs out is dropped and another one made
+    :param workers: int number of processes to split the boards over, or None to make them in this process
+    :param seed: int or sequence of ints master seed; each worker's share is made from its own stream of it,
+                 so the same seed and workers give the same boards.  None draws one from the random module.
+    :param pool: multiprocessing.Pool with workers processes to reuse, or None to start one for this call
+    :param out: shared_arrays.SharedArray of shape (2, num_boards) + board shape to make the boards in, or None.
+                Workers write their slots directly; out.array[0] holds the boards and out.array[1] the solutions,
+                each contiguous so they can go to the HDF5 writer as they are.
+    :param minimal: bool, if true make minimal boards (see make_board())
+    :param bank: str path of a grid bank to draw full grids from (see make_board()), or None
     :return: np.ndarray shape=(num_boards, 2) where
             [0] is return of make_board() if not one_hot, or make_one_hot() if one_hot
             if one_hot dtype='bool; else dtype='uint8'
+            boards come back in the order of the workers' shares, whatever order the workers finish in
+            with out, a view of out.array
     """
     if num_clues < 17:
         raise TheoreticalLimit("17 is the theoretical minimum number of clues, but %s were given." % num_clues)
 
+    elif workers is not None and workers > 1 and num_boards > 0:
+        if seed is None:
+            seed = random.getrandbits(64)
+        board_shape, dtype = board_layout(one_hot)
+        shared = out if out is not None else SharedArray((2, num_boards) + board_shape, dtype)
+        tasks, start = [], 0
+        for w, worker_seed in enumerate(worker_seeds(seed, workers)):
+            count = num_boards // workers + (w < num_boards % workers)
+            if count:
+                tasks.append((count, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank,
+                              worker_seed, shared.spec, start))
+            start += count
+        try:
+            if pool is None:
+                with multiprocessing.Pool(workers) as pool:
+                    pool.map(make_boards_share, tasks, chunksize=1)
+            else:
+                pool.map(make_boards_share, tasks, chunksize=1)
+            if out is not None:
+                return out.array.swapaxes(0, 1)
+            return np.array(shared.array.swapaxes(0, 1))
+        finally:
+            if out is None:
+                shared.close()
+
     else:
-        boards = []
-        for i in range(0, num_boards):
+        if seed is not None:
+            random.seed(worker_seeds(seed, 1)[0])
+        boards, failures = [], 0
+        while len(boards) < num_boards:
             if one_hot:
-                boards.append(make_one_hot(num_clues=num_clues, single_solution=single_solution))
+                board = make_one_hot(num_clues=num_clues, single_solution=single_solution, max_nodes=max_nodes,
+                                     deadline=deadline, minimal=minimal, bank=bank)
+            else:
+                board = make_board(num_clues=num_clues, single_solution=single_solution, max_nodes=max_nodes,
+                                   deadline=deadline, minimal=minimal, bank=bank)
+            if isinstance(board, BudgetExceeded):
+                failures += 1
+                check_budget_tries(failures, num_clues, board)
             else:
-                boards.append(make_board(num_clues=num_clues, single_solution=single_solution))
+                failures = 0
+                boards.append(board)
         if one_hot:
-            return np.array(boards, dtype=np.bool)
+            boards = np.array(boards, dtype=np.bool)
         else:
-            return np.array(boards, dtype='uint8')
+            boards = np.array(boards, dtype='uint8')
+        if out is not None:
+            if num_boards:
+                out.array.swapaxes(0, 1)[:] = boards
+            return out.array.swapaxes(0, 1)
+        return boards
+
+
+MASK_BYTES = 11  # an 81-bit clue mask, packed
+
+
+def clue_masks(puzzles):
+    """
+    :param puzzles: list of 81-char puzzle strings, with '0' for blanks
+    :return: np.ndarray shape=(N, MASK_BYTES) dtype='uint8' of packed bits, set for each clue
+    """
+    boards = np.frombuffer(''.join(puzzles).encode(), dtype='uint8').reshape(-1, 81)
+    return np.packbits(boards != 48, axis=1)
+
+
+def unmask_boards(grids, masks, one_hot=False):
+    """
+    Rebuilds dense boards from their solution grids and clue masks.
+    :param grids: np.ndarray shape=(N, 81) dtype='uint8' of solutions, one per board
+    :param masks: np.ndarray shape=(N, MASK_BYTES) dtype='uint8' from clue_masks()
+    :param one_hot: bool, if true return one_hot boards as make_one_hot() does
+    :return: tuple (boards, solutions), each np.ndarray shape=(N,) + board_layout(one_hot)[0]
+    """
+    grids = np.asarray(grids, dtype='uint8').reshape(-1, 9, 9)
+    clues = np.unpackbits(masks, axis=1, count=81).reshape(-1, 9, 9).view('bool')
+    boards = np.where(clues, grids, np.uint8(48))
+    if one_hot:
+        digits = np.arange(49, 58, dtype='uint8')
+        return boards[..., None] == digits, grids[..., None] == digits
+    return boards, grids
+
+
+def make_grid_slots(task):
+    """
+    Pool worker: digs the puzzles of grid slots start:stop with grid_puzzles(), each slot from its own random
+    stream of seed, so its puzzles do not depend on how slots are split into tasks.  A slot that runs out of
+    budget goes on to another grid, up to BUDGET_TRIES in a row.
+    :raises GenerationLimit if BUDGET_TRIES grids in a row run out of budget
+    :param task: tuple (start, stop, num_clues, per_grid, single_solution, max_nodes, deadline, bank,
+                        list of ints seed)
+    :return: list of (list of puzzles, solution), one per slot
+    """
+    start, stop, num_clues, per_grid, single_solution, max_nodes, deadline, bank, seed = task
+    made = []
+    for slot in range(start, stop):
+        random.seed(worker_seeds(seed + [slot], 1)[0])
+        found, failures = grid_puzzles(num_clues, per_grid, single_solution, max_nodes, deadline, bank), 0
+        while isinstance(found, BudgetExceeded):
+            failures += 1
+            check_budget_tries(failures, num_clues, found)
+            found = grid_puzzles(num_clues, per_grid, single_solution, max_nodes, deadline, bank)
+        made.append(found)
+    return made
+
+
+def make_masked(num_boards, num_clues, per_grid, single_solution=True, max_nodes=None, deadline=None, bank=None,
+                seed=None, pool=None, workers=None):
+    """
+    Make num_boards different puzzles with num_clues, up to per_grid of them dug from each full grid.
+    Grids are made in rounds of slots until there are enough puzzles; slots are numbered on across rounds
+    and each draws from its own stream of seed, so the puzzles do not depend on workers.
+    :param num_boards: int number of boards to make
+    :param num_clues: int number of clues per board
+    :param per_grid: int most puzzles dug from one grid
+    :param max_nodes: int cap on search nodes per grid (see grid_puzzles()), or None
+    :param deadline: float seconds allowed per grid, or None
+    :param bank: str path of a grid bank to draw full grids from (see make_board()), or None
+    :param seed: list of ints master seed, or None to draw one from the random module
+    :param pool: multiprocessing.Pool with workers processes to make the grids on, or None to make them here
+    :return: tuple (np.ndarray shape=(G, 81) dtype='uint8' of the distinct solution grids,
+                    np.ndarray shape=(num_boards,) dtype='uint32' of each board's row in them,
+                    np.ndarray shape=(num_boards, MASK_BYTES) dtype='uint8' of each board's clue mask)
+    """
+    if num_clues < 17:
+        raise TheoreticalLimit("17 is the theoretical minimum number of clues, but %s were given." % num_clues)
+    if seed is None:
+        seed = [random.getrandbits(64)]
+    grids, ids, puzzles, seen = {}, [], [], set()
+    slot = 0
+    while len(puzzles) < num_boards:
+        count = -(-(num_boards - len(puzzles)) // per_grid)
+        pieces = 1 if pool is None else min(count, TASKS_PER_WORKER * workers)
+        tasks = [(slot + count * i // pieces, slot + count * (i + 1) // pieces, num_clues, per_grid, single_solution,
+                  max_nodes, deadline, bank, list(seed)) for i in range(pieces)]
+        slot += count
+        made = map(make_grid_slots, tasks) if pool is None else pool.map(make_grid_slots, tasks, chunksize=1)
+        for found, solution in (f for task in made for f in task):
+            for puzzle in found:
+                if puzzle in seen or len(puzzles) == num_boards:
+                    continue
+                seen.add(puzzle)
+                puzzles.append(puzzle)
+                ids.append(grids.setdefault(solution, len(grids)))
+    solutions = np.frombuffer(''.join(grids).encode(), dtype='uint8').reshape(-1, 81)
+    return solutions, np.array(ids, dtype='uint32'), clue_masks(puzzles).reshape(-1, MASK_BYTES)
+
+
+def parse_shard(shard):
+    """
+    :raises ValueError if shard is not a valid (i, N) pair or 'i/N' string
+    :param shard: tuple (i, N) or str 'i/N', for shard i of N, 0 <= i < N
+    :return: tuple (i, N) of ints
+    """
+    try:
+        i, n = (int(part) for part in (shard.split('/') if isinstance(shard, str) else shard))
+    except (TypeError, ValueError):
+        raise ValueError('A shard is given as i/N, but %r was given.' % (shard,))
+    if not 0 <= i < n:
+        raise ValueError('Shard i/N needs 0 <= i < N, but %s/%s was given.' % (i, n))
+    return i, n
+
+
+def shard_size(num_boards, shard):
+    """
+    :return: int number of the num_boards per num_clues that shard (i, N) makes; shards differ by at most one
+    """
+    i, n = shard
+    return num_boards // n + (i < num_boards % n)
 
 
 def make_dataset(num_boards, clues_enum, one_hot=False, name=None, dest=None, single_solution=True,
-                 include_solutions=True):
+                 include_solutions=True, max_nodes=None, deadline=None, workers=None, seed=None, shard=None,
+                 minimal=False, bank=None, per_grid=None):
     """
     Creates an hdf5 file with num_boards per num_clues in clues_enum and saves it file name at dest
-    :param num_boards: int number of boards per num_clues
-    :param clues_enum: enumerable whose entries are num_clues
+    :param num_boards: int number of boards per num_clues, or dict {num_clues: number of boards}
+    :param clues_enum: enumerable whose entries are num_clues; may be None if num_boards is a dict
     :param one_hot: bool, if true make one_hot boards
     :param name: str filename to save to; call name_dataset() if None
     :param dest: str path to save to; use working directory if None
     :param single_solution: bool, if true use only puzzles with a single solution
     :param include_solutions: bool, if true save solutions; if false, leave solutions tables empty
+    :param max_nodes: int cap on search nodes per board (see make_boards()), or None
+    :param deadline: float seconds allowed per board (see make_boards()), or None
+    :param workers: int number of processes to make boards with; one pool makes every num_clues group at once,
+                    the most expensive groups first, split into small tasks (see make_groups()), and saves each
+                    group as soon as it is done; None or 1 runs the same tasks in this process
+    :param seed: int master seed; each board is made from its own stream of it, keyed by its num_clues and slot,
+                 so the same seed makes the same boards whatever the workers
+    :param shard: (i, N) or 'i/N' to make only shard i of N of the dataset, e.g. on one of N machines:
+                  its share of num_boards per num_clues, from its own streams of seed (which is then required),
+                  into its own file named with shard_name().  merge_shards() puts the shard files together.
+    :param minimal: bool, if true use only minimal puzzles, which no clue can be removed from without losing the
+                    single solution; every num_clues must then be one of MINIMAL_CLUES
+    :param bank: str path of a grid_bank.build_bank() file to draw full grids from, or None to build each one
+    :param per_grid: int K to dig up to K different puzzles from each full grid, and save each board as the row
+                     of its grid in solutions/<num_clues> and a clue mask instead of dense arrays; read them
+                     back with read_boards() or iter_boards().  None saves dense boards.
     :return: True if successful
 
     HDF5 Structure:
@@ -140,9 +410,23 @@ def make_dataset(num_boards, clues_enum, one_hot=False, name=None, dest=None, si
             grp: num_clues
                 dset: n rows for n boards (empty dset if include_solutions==False)
 
+    HDF5 Structure with per_grid (attrs layout='masked', one_hot, per_grid):
+    filename.hdf5
+        grp: solutions
+            grp: num_clues
+                dset: G rows of 81 uint8 ASCII digits for the G distinct grids (kept even if not
+                      include_solutions, as the boards are rebuilt from them)
+        grp: grid_ids
+            grp: num_clues
+                dset: n uint32 rows for n boards, each its row in solutions/<num_clues>
+        grp: clue_masks
+            grp: num_clues
+                dset: n rows of MASK_BYTES uint8 for n boards, the packed bits of its clues
+
     Notes:
         - Norvig's generator does not guarantee a single solution puzzle.
-        If single_solution==True, verify that a puzzle has only a single solution before including it.
+        If single_solution==True, random_puzzle() only removes a clue when the board still has exactly one
+        solution, so every included puzzle has a single solution.
         - An hdf5 file should contain boards of the same one_hot condition (ie all or none).
         dtypes should be as small as possible (int8/bool_)
         - What if n boards are requested for m clues, even though only n-1 boards are possible?
@@ -154,101 +438,477 @@ def make_dataset(num_boards, clues_enum, one_hot=False, name=None, dest=None, si
             - the code is dumping to the filesystem periodically (not building the entire thing in memory)
             - regular updates to the user at reasonable intervals for progress and expected time to completion
     """
+    if isinstance(num_boards, dict) and clues_enum is None:
+        clues_enum = list(num_boards)
+
     if isinstance(clues_enum, (tuple, list, set)):
-        clues_enum = [i for i, j in groupby(sorted(clues_enum))]
+        ## Command line entries come in as lists of lists (-c 20 30 -c 40).
+        clues_enum = [int(c) for entry in clues_enum for c in (entry if isinstance(entry, (tuple, list)) else [entry])]
+        if len(set(clues_enum)) != len(clues_enum):
+            raise ValueError('Each num_clues may appear only once in clues_enum, but %s were given.' % clues_enum)
+        clues_enum = sorted(clues_enum)
         if len(clues_enum) == 1:
-            clues_enum = int(clues_enum[0][0])
+            clues_enum = clues_enum[0]
 
     if isinstance(num_boards, (tuple, list, set)):
         num_boards = int(num_boards[0])
 
-    def check_duplicates(boards):
-        for i in range(0, len(boards), 1):
-            for j in range(0, len(boards), 1):
-                if i != j:
-                    if np.array_equal(boards[i], boards[j]):
-                        return True
-        return False
-
-    def generate_dataset(num_clues):
-        inc = 0
-        try:
-            while True:
-                boards = make_boards(num_boards=num_boards, num_clues=num_clues, one_hot=one_hot,
-                                     single_solution=single_solution)
-
-                unique_boards = []
-                unique_solutions = []
-                for i in range(0, boards.shape[0], 1):
-                    unique_boards.append(boards[i][0])
-                    unique_solutions.append(boards[i][1])
-
-                if check_duplicates(unique_boards) is False:
-                    return [unique_boards, unique_solutions]
-                else:
-                    inc += 1
-                    if inc is 20:
-                        raise GenerationLimit()
-        except GenerationLimit:
-            print("Failed 20 times trying to generate %s unique boards with %s clues. Skipping." % (
-                num_boards, clues_enum))
+    if shard is not None:
+        shard = parse_shard(shard)
+        if seed is None:
+            raise ValueError('Sharded datasets need a seed, so that every shard makes its own reproducible slice.')
+
+    if per_grid is not None:
+        per_grid = int(per_grid)
+        if per_grid < 1:
+            raise ValueError('per_grid must be at least 1, but %s was given.' % per_grid)
+        if minimal:
+            raise ValueError('Minimal boards are made one per grid, so per_grid cannot be given with minimal.')
+
+    def group_seed(num_clues):
+        if seed is None:
+            return None
+        if shard is None:
+            return [seed, num_clues, 0]
+        return [seed, num_clues, 0, shard[0], shard[1]]
+
+    def save_group(num_clues, dataset_boards, dataset_solutions):
+        if include_solutions is not True:
+            dataset_solutions = np.zeros((1,), dtype='uint8')
+        with h5py.File(path, 'a') as hdf5:
+            hdf5.create_dataset('boards/' + str(num_clues), data=dataset_boards)
+            hdf5.create_dataset('solutions/' + str(num_clues), data=dataset_solutions)
 
     if name is None:
         name = name_dataset(num_boards=num_boards, clues_enum=clues_enum, one_hot=one_hot)
+    if shard is not None:
+        name = shard_name(name, shard)
 
     if dest is None:
         dest = os.path.dirname(os.path.realpath('make_data.py'))
 
     if isinstance(clues_enum, int):
-        if os.path.exists(os.path.join(dest, name + '.hdf5')):
-            os.remove(os.path.join(dest, name + '.hdf5'))
-        hdf5 = h5py.File(os.path.join(dest, name + '.hdf5'))
+        clues_enum = [clues_enum]
+    elif not isinstance(clues_enum, (tuple, list, set)):
+        raise ValueError('Unknown type for clue_enum. Correct the query and try again.')
 
-        print('\rGenerating dataset 1 / 1 [Clues:%s]...' % (str(clues_enum)), end='')
-        dataset = generate_dataset(clues_enum)
+    if isinstance(num_boards, dict):
+        totals = dict((int(c), int(n)) for c, n in num_boards.items())
+        if set(totals) != set(clues_enum):
+            raise ValueError('num_boards has counts for clues %s, but clues_enum is %s.' % (sorted(totals), clues_enum))
+    else:
+        totals = dict((c, num_boards) for c in clues_enum)
+    if any(n < 0 for n in totals.values()):
+        raise ValueError('Board counts cannot be negative, but %s were given.' % totals)
+    group_sizes = dict((c, n if shard is None else shard_size(n, shard)) for c, n in totals.items())
+    if minimal:
+        for c in clues_enum:
+            check_minimal(c)
+
+    path = os.path.join(dest, name + '.hdf5')
+    if os.path.exists(path):
+        os.remove(path)
+    if per_grid is not None:
+        pool = multiprocessing.Pool(workers) if workers is not None and workers > 1 else None
+        try:
+            for i, num_clues in enumerate(clues_enum):
+                print('\rGenerating dataset %s / %s [Clues:%s]...' % (i + 1, len(clues_enum), num_clues), end='')
+                seed_list = group_seed(num_clues)
+                try:
+                    grids, ids, masks = make_masked(group_sizes[num_clues], num_clues, per_grid, single_solution,
+                                                    max_nodes, deadline, bank, seed_list, pool, workers)
+                except GenerationLimit as e:
+                    print("%s Skipping." % e)
+                    continue
+                print('\rSaving dataset %s / %s [Clues:%s]...' % (i + 1, len(clues_enum), num_clues), end='')
+                with h5py.File(path, 'a') as hdf5:
+                    hdf5.create_dataset('solutions/%d' % num_clues, data=grids)
+                    hdf5.create_dataset('grid_ids/%d' % num_clues, data=ids)
+                    hdf5.create_dataset('clue_masks/%d' % num_clues, data=masks)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        with h5py.File(path, 'a') as hdf5:
+            hdf5.attrs['layout'] = 'masked'
+            hdf5.attrs['one_hot'] = bool(one_hot)
+            hdf5.attrs['per_grid'] = per_grid
+    else:
+        ## Groups are made together, most expensive first, and saved as each one completes.  Each board comes from
+        ## its own slot's stream of seed, so the same seed gives the same boards with any number of workers.
+        done = 0
+        board_shape, dtype = board_layout(one_hot)
+        for num_clues in clues_enum:
+            if not group_sizes[num_clues]:
+                ## Nothing to make, but the group is still saved, as an empty one.
+                done += 1
+                save_group(num_clues, np.zeros((0,) + board_shape, dtype), np.zeros((0,) + board_shape, dtype))
+        pool = multiprocessing.Pool(workers) if workers is not None and workers > 1 else None
+        try:
+            print('\rGenerating dataset...', end='')
+            made = dict((c, n) for c, n in group_sizes.items() if n)
+            for num_clues, shared in make_groups(made, pool, workers if pool is not None else 1, one_hot,
+                                                 single_solution, max_nodes, deadline, seed,
+                                                 [] if shard is None else list(shard), minimal, bank):
+                done += 1
+                if isinstance(shared, GenerationLimit):
+                    print("%s Skipping." % shared)
+                    continue
+                print('\rSaving dataset %s / %s [Clues:%s]...' % (done, len(clues_enum), num_clues), end='')
+                ## Boards made in shared memory are written straight from the workers' output buffer.
+                with shared:
+                    save_group(num_clues, shared.array[0], shared.array[1])
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+
+    if shard is not None:
+        with h5py.File(path, 'a') as hdf5:
+            hdf5.attrs['shard'] = shard
+            hdf5.attrs['seed'] = seed
+            hdf5.attrs['clues'] = sorted(totals)
+            hdf5.attrs['num_boards'] = [totals[c] for c in sorted(totals)]
 
-        dataset_boards = dataset[0]
-        dataset_solutions = np.empty((1,), dtype='uint8')
+    return True
 
-        if include_solutions is True:
-            dataset_solutions = dataset[1]
 
-        print('\rSaving dataset 1 / 1 [Clues:%s]...' % (str(clues_enum)), end='')
-        sleep(1)
+# Rough seconds to make one single-solution board, measured on one core: a few ms above 26 clues,
+# then steeply more as ever more boards get stuck above num_clues and have to be repaired or started
+# over.  Only the ratios matter: they rank the groups and size their tasks.
+BOARD_COST = {21: 0.80, 22: 0.10, 23: 0.040, 24: 0.023, 25: 0.016, 26: 0.010}
+MINIMAL_COST = 0.017  # seconds per minimal_puzzle(), whatever number of clues it comes out with
+TASKS_PER_WORKER = 8  # tasks the whole dataset is split into, per worker
 
-        hdf5.create_dataset('boards/' + str(clues_enum), data=dataset_boards)
-        hdf5.create_dataset('solutions/' + str(clues_enum), data=dataset_solutions)
-        hdf5.close()
 
-    elif isinstance(clues_enum, (tuple, list, set)):
-        if os.path.exists(os.path.join(dest, name + '.hdf5')):
-            os.remove(os.path.join(dest, name + '.hdf5'))
-        for i in range(0, len(clues_enum), 1):
-            hdf5 = h5py.File(os.path.join(dest, name + '.hdf5'))
+def board_cost(num_clues, single_solution=True, minimal=False):
+    """
+    :return: float estimated seconds to make one board with num_clues
+    """
+    if minimal:
+        return MINIMAL_COST / MINIMAL_CLUES[num_clues]
+    if single_solution:
+        if num_clues in BOARD_COST:
+            return BOARD_COST[num_clues]
+        if num_clues < min(BOARD_COST):
+            return BOARD_COST[min(BOARD_COST)] * 10 ** (min(BOARD_COST) - num_clues)
+    return 0.0025 + 0.0002 * max(0, 60 - num_clues)
 
-            print('\rGenerating dataset %s / %s [Clues:%s]...' % (str(i + 1), str(len(clues_enum)), str(clues_enum[i])),
-                  end='')
 
-            dataset = generate_dataset(clues_enum[i])
+def plan_tasks(group_sizes, workers, single_solution=True, minimal=False):
+    """
+    Splits clue groups into tasks of about equal estimated cost, TASKS_PER_WORKER per worker overall,
+    so that a worker that runs out of work can take the next task of any group.
+    :param group_sizes: dict {num_clues: number of boards}
+    :param workers: int number of workers
+    :return: list of tuples (num_clues, first slot, end slot), the most expensive groups' tasks first
+    """
+    costs = dict((c, board_cost(c, single_solution, minimal)) for c in group_sizes)
+    total = sum(n * costs[c] for c, n in group_sizes.items())
+    target = total / (TASKS_PER_WORKER * max(1, workers))
+    tasks = []
+    for c in sorted(group_sizes, key=lambda c: (-group_sizes[c] * costs[c], c)):
+        n = group_sizes[c]
+        size = max(1, min(n, int(target / costs[c])))
+        tasks.extend((c, start, min(n, start + size)) for start in range(0, n, size))
+    return tasks
+
+
+def make_groups(group_sizes, pool, workers, one_hot=False, single_solution=True, max_nodes=None, deadline=None,
+                seed=None, salt=(), minimal=False, bank=None):
+    """
+    Makes several clue groups of boards on one pool, as the tasks of plan_tasks(), and yields each group
+    as soon as its last task is done.  A group whose boards repeat is remade at the repeated slots only,
+    up to 20 rounds.  Each slot draws from its own stream of seed, so the boards do not depend on workers.
+    :param group_sizes: dict {num_clues: number of boards}
+    :param pool: multiprocessing.Pool to run the tasks on, or None to run them in this process
+    :param workers: int number of processes in pool, 1 without one
+    :param salt: list of ints added to every task's seed, e.g. the shard
+    :param minimal: bool, if true make minimal boards (see make_board())
+    :param bank: str path of a grid bank to draw full grids from (see make_board()), or None
+    :return: generator of (num_clues, SharedArray of shape (2, boards) + board shape to be closed by the caller,
+             or the GenerationLimit the group failed with: 20 rounds of repeats, or BUDGET_TRIES boards in a
+             row out of budget)
+    """
+    if seed is None:
+        seed = random.getrandbits(64)
+    board_shape, dtype = board_layout(one_hot)
+    results = queue.Queue()
+    groups, left, rounds, failed = {}, {}, {}, {}
+    tasks = plan_tasks(group_sizes, workers, single_solution, minimal)
+    tasks.reverse()  # popped from the end
+    in_flight = 0
+    try:
+        while tasks or in_flight:
+            while tasks and in_flight < 2 * workers:
+                num_clues, start, stop = tasks.pop()
+                if num_clues not in groups:
+                    groups[num_clues] = SharedArray((2, group_sizes[num_clues]) + board_shape, dtype)
+                    left[num_clues], rounds[num_clues] = 0, 0
+                task = (start, stop, num_clues, one_hot, single_solution, max_nodes, deadline, minimal, bank,
+                        [seed, num_clues, rounds[num_clues]] + list(salt), groups[num_clues].spec)
+                if pool is None:
+                    try:
+                        make_slots(task)
+                        results.put((num_clues, None))
+                    except GenerationLimit as e:
+                        results.put((num_clues, e))
+                else:
+                    pool.apply_async(make_slots, (task,), callback=lambda count, c=num_clues: results.put((c, None)),
+                                     error_callback=lambda e, c=num_clues: results.put((c, e)))
+                left[num_clues] += 1
+                in_flight += 1
+            if not in_flight:
+                break
+            num_clues, error = results.get()
+            if error is not None and not isinstance(error, GenerationLimit):
+                raise error
+            in_flight -= 1
+            left[num_clues] -= 1
+            if error is not None and num_clues not in failed:
+                ## Give the group up, but keep its array until its tasks in flight are done with it.
+                failed[num_clues] = error
+                tasks = [task for task in tasks if task[0] != num_clues]
+            if left[num_clues]:
+                continue
+            if num_clues in failed:
+                groups.pop(num_clues).close()
+                yield num_clues, failed.pop(num_clues)
+                continue
+            repeated = np.flatnonzero(find_duplicates([groups[num_clues].array[0]])[0])
+            if not len(repeated):
+                yield num_clues, groups.pop(num_clues)
+                continue
+            rounds[num_clues] += 1
+            if rounds[num_clues] == 20:
+                groups.pop(num_clues).close()
+                yield num_clues, GenerationLimit("Failed 20 times trying to generate %s unique boards with %s clues."
+                                                 % (group_sizes[num_clues], num_clues))
+                continue
+            tasks.extend((num_clues, r, r + 1) for r in repeated[::-1])
+    finally:
+        for shared in groups.values():
+            shared.close()
+
+
+def shard_name(name, shard):
+    return '%s_shard%dof%d' % (name, shard[0], shard[1])
+
+
+def fingerprints(boards):
+    """
+    64-bit fingerprints of boards, equal for equal boards (and rarely for different ones).
+    :param boards: np.ndarray of boards stacked on axis 0
+    :return: np.ndarray shape=(N,) dtype='uint64'
+    """
+    rows = np.ascontiguousarray(boards).reshape(len(boards), -1).view('uint8')
+    words = np.zeros((len(boards), -(-rows.shape[1] // 8) * 8), dtype='uint8')
+    words[:, :rows.shape[1]] = rows
+    words = words.view('uint64')
+    multipliers = np.random.RandomState(words.shape[1]).randint(1, 2 ** 62, size=words.shape[1]).astype('uint64') | 1
+    with np.errstate(over='ignore'):
+        mixed = words * multipliers
+        return np.bitwise_xor.reduce(mixed ^ (mixed >> np.uint64(29)), axis=1) if len(boards) else mixed[:, 0]
 
-            dataset_boards = dataset[0]
-            dataset_solutions = np.empty((1,), dtype='uint8')
 
-            if include_solutions is True:
-                dataset_solutions = dataset[1]
+def find_duplicates(datasets, chunk_size=1 << 16):
+    """
+    Marks the boards that repeat an earlier board, in the order of datasets and of their rows.
+    Boards are compared by fingerprint in chunks, and boards with equal fingerprints by value.
+    :param datasets: list of h5py datasets (or np.ndarrays) of boards stacked on axis 0
+    :param chunk_size: int rows read at a time
+    :return: list of np.ndarray dtype='bool', one per dataset, True for rows to drop
+    """
+    owner, row, prints = [], [], []
+    for k, d in enumerate(datasets):
+        for start in range(0, len(d), chunk_size):
+            prints.append(fingerprints(d[start:start + chunk_size]))
+            owner.append(np.full(len(prints[-1]), k))
+            row.append(np.arange(start, start + len(prints[-1])))
+    if not prints:
+        return [np.zeros(len(d), dtype='bool') for d in datasets]
+    owner, row, prints = np.concatenate(owner), np.concatenate(row), np.concatenate(prints)
+    order = np.argsort(prints, kind='stable')
+    repeated = np.flatnonzero(prints[order][1:] == prints[order][:-1]) + 1
+    duplicate = [np.zeros(len(d), dtype='bool') for d in datasets]
+    kept = {}  # fingerprint -> boards kept with it, when some other board shares it
+    for first in np.unique(np.concatenate([repeated - 1, repeated])):
+        k, r = owner[order[first]], row[order[first]]
+        boards = kept.setdefault(prints[order[first]], [])
+        board = datasets[k][r]
+        if any(np.array_equal(board, other) for other in boards):
+            duplicate[k][r] = True
+        else:
+            boards.append(board)
+    return duplicate
 
-            print('\rSaving dataset %s / %s [Clues:%s]...' % (str(i + 1), str(len(clues_enum)), str(clues_enum[i])),
-                  end='')
-            sleep(1)
 
-            hdf5.create_dataset('boards/' + str(clues_enum[i]), data=dataset_boards)
-            hdf5.create_dataset('solutions/' + str(clues_enum[i]), data=dataset_solutions)
-            hdf5.close()
+def merge_shards(paths, name, dest=None, virtual=False, chunk_size=1 << 16):
+    """
+    Puts shard files made by make_dataset(shard=...) together into one file, in the boards/<num_clues> and
+    solutions/<num_clues> layout of make_dataset().  Boards found in more than one place are kept only the first
+    time, in the order of paths.
+    :raises ValueError if the shards mix one_hot and int boards, or two of them are the same shard
+    :param paths: list of str paths to shard files
+    :param name: str filename to save to
+    :param dest: str path to save to; use working directory if None
+    :param virtual: bool, if true make HDF5 virtual datasets that read the boards from the shard files
+                    (which must then stay where they are); else copy the boards in.  Shards made with per_grid
+                    are always copied, with merge_masked().
+    :param chunk_size: int boards read at a time
+    :return: str path of the merged file
+    """
+    if dest is None:
+        dest = os.getcwd()
+    path = os.path.join(dest, name + '.hdf5')
+    shards = [h5py.File(p, 'r') for p in paths]
+    try:
+        seen = [tuple(f.attrs['shard']) for f in shards if 'shard' in f.attrs]
+        if len(set(seen)) != len(seen):
+            raise ValueError('Shards %s are given more than once.' % sorted(set(s for s in seen if seen.count(s) > 1)))
+        if len(set(f.attrs.get('layout') == 'masked' for f in shards)) > 1:
+            raise ValueError('Shards made with and without per_grid cannot be merged.')
+        if shards[0].attrs.get('layout') == 'masked':
+            merge_masked(shards, path, chunk_size)
+            return path
+        if len(set(f[key].dtype for f in shards for key in ('boards/' + c for c in f['boards']))) > 1:
+            raise ValueError('Shards of one_hot and int boards cannot be merged.')
+        clues = sorted(set(int(c) for f in shards for c in f['boards']))
+
+        if os.path.exists(path):
+            os.remove(path)
+        with h5py.File(path, 'w') as hdf5:
+            for num_clues in clues:
+                groups = [f for f in shards if str(num_clues) in f['boards']]
+                boards = [f['boards/%d' % num_clues] for f in groups]
+                solutions = [f['solutions/%d' % num_clues] for f in groups]
+                with_solutions = all(len(s) == len(b) and s.ndim == b.ndim for s, b in zip(solutions, boards))
+                keep = [~d for d in find_duplicates(boards, chunk_size)]
+                tables = [('boards', boards)]
+                if with_solutions:
+                    tables.append(('solutions', solutions))
+                else:
+                    hdf5.create_dataset('solutions/%d' % num_clues, data=np.zeros((1,), dtype='uint8'))
+                for table, datasets in tables:
+                    total = sum(int(k.sum()) for k in keep)
+                    shape, dtype = (total,) + datasets[0].shape[1:], datasets[0].dtype
+                    key = '%s/%d' % (table, num_clues)
+                    if virtual:
+                        layout = h5py.VirtualLayout(shape=shape, dtype=dtype)
+                    else:
+                        out = hdf5.create_dataset(key, shape=shape, dtype=dtype)
+                    start = 0
+                    for f, dataset, k in zip(groups, datasets, keep):
+                        source = h5py.VirtualSource(os.path.realpath(f.filename), key, shape=dataset.shape) \
+                            if virtual else None
+                        ## Copy each run of kept rows: all of a shard, unless it repeats boards of another.
+                        edges = np.flatnonzero(np.diff(np.concatenate([[0], k.view('int8'), [0]])))
+                        for a, b in zip(edges[::2], edges[1::2]):
+                            if virtual:
+                                layout[start:start + b - a] = source[a:b]
+                                start += b - a
+                                continue
+                            for c in range(a, b, chunk_size):
+                                rows = dataset[c:min(b, c + chunk_size)]
+                                out[start:start + len(rows)] = rows
+                                start += len(rows)
+                    if virtual:
+                        hdf5.create_virtual_dataset(key, layout)
+    finally:
+        for f in shards:
+            f.close()
+    return path
+
+
+def merge_masked(shards, path, chunk_size=1 << 16):
+    """
+    Puts shard files made by make_dataset(shard=..., per_grid=...) together into one file at path, in the same
+    layout.  A board found in more than one place, the same clue mask on the same grid, is kept only the first time;
+    solutions/<num_clues> then holds each grid a kept board uses once, and grid_ids are mapped into it.
+    :raises ValueError if the shards mix one_hot and int boards
+    :param shards: list of open h5py.Files
+    :param chunk_size: int boards compared at a time (see find_duplicates())
+    """
+    if len(set(bool(f.attrs['one_hot']) for f in shards)) > 1:
+        raise ValueError('Shards of one_hot and int boards cannot be merged.')
+    clues = sorted(set(int(c) for f in shards for c in f['grid_ids']))
+    if os.path.exists(path):
+        os.remove(path)
+    with h5py.File(path, 'w') as hdf5:
+        for num_clues in clues:
+            groups = [f for f in shards if str(num_clues) in f['grid_ids']]
+            tables = [[f['%s/%d' % (t, num_clues)][:] for t in ('solutions', 'grid_ids', 'clue_masks')]
+                      for f in groups]
+            keep = [~d for d in find_duplicates([np.concatenate([grids[ids], masks], axis=1)
+                                                 for grids, ids, masks in tables], chunk_size)]
+            kept_ids = [ids[k] for (grids, ids, masks), k in zip(tables, keep)]
+            used = [np.unique(ids) for ids in kept_ids]
+            candidates = [grids[u] for (grids, ids, masks), u in zip(tables, used)]
+            repeats = find_duplicates(candidates, chunk_size)
+            merged = np.concatenate([c[~r] for c, r in zip(candidates, repeats)])
+            prints = fingerprints(merged)
+            new_ids, start = [], 0
+            for c, r, u, ids in zip(candidates, repeats, used, kept_ids):
+                rows = np.empty(len(c), dtype='int64')
+                rows[~r] = start + np.arange(len(c) - int(r.sum()))
+                start += len(c) - int(r.sum())
+                ## A repeated grid takes the row of its first copy, among the few with its fingerprint.
+                for j in np.flatnonzero(r):
+                    rows[j] = next(m for m in np.flatnonzero(prints == fingerprints(c[j:j + 1])[0])
+                                   if np.array_equal(merged[m], c[j]))
+                new_ids.append(rows[np.searchsorted(u, ids)].astype('uint32'))
+            hdf5.create_dataset('solutions/%d' % num_clues, data=merged)
+            hdf5.create_dataset('grid_ids/%d' % num_clues, data=np.concatenate(new_ids))
+            hdf5.create_dataset('clue_masks/%d' % num_clues,
+                                data=np.concatenate([masks[k] for (grids, ids, masks), k in zip(tables, keep)]))
+        for attr in ('layout', 'one_hot', 'per_grid'):
+            hdf5.attrs[attr] = shards[0].attrs[attr]
+
+
+def read_group(hdf5, num_clues, start=0, stop=None, one_hot=None):
+    """
+    Reads boards start:stop of a num_clues group of an open make_dataset() file as dense arrays, rebuilding them
+    from their grids and clue masks if it was made with per_grid.
+    :param hdf5: h5py.File
+    :param one_hot: bool, to rebuild per_grid boards as one_hot (True) or uint8 (False) boards; None rebuilds
+                    them as they were made.  Dense boards are returned as they were saved.
+    :return: tuple (boards, solutions) of np.ndarrays with stop - start rows; solutions is the saved
+             solutions table as it is if the file was made without include_solutions
+    """
+    if hdf5.attrs.get('layout') != 'masked':
+        boards, solutions = hdf5['boards/%d' % num_clues], hdf5['solutions/%d' % num_clues]
+        if solutions.ndim == boards.ndim:
+            return boards[start:stop], solutions[start:stop]
+        return boards[start:stop], solutions[:]
+    if one_hot is None:
+        one_hot = bool(hdf5.attrs['one_hot'])
+    ids = hdf5['grid_ids/%d' % num_clues][start:stop]
+    masks = hdf5['clue_masks/%d' % num_clues][start:stop]
+    ## Read each grid the boards use once, in increasing order as h5py needs, whatever order the ids are in.
+    used, rows = np.unique(ids, return_inverse=True)
+    grids = hdf5['solutions/%d' % num_clues][used] if len(used) else np.zeros((0, 81), dtype='uint8')
+    return unmask_boards(grids[rows], masks, one_hot)
+
+
+def read_boards(path, num_clues, start=0, stop=None, one_hot=None):
+    """
+    Reads boards start:stop of the num_clues group of the make_dataset() file at path; see read_group().
+    :return: tuple (boards, solutions) of np.ndarrays
+    """
+    with h5py.File(path, 'r') as hdf5:
+        return read_group(hdf5, num_clues, start, stop, one_hot)
 
-    else:
-        raise ValueError('Unknown type for clue_enum. Correct the query and try again.')
 
-    return True
+def iter_boards(path, num_clues, batch_size=4096, one_hot=None):
+    """
+    Reads the num_clues group of the make_dataset() file at path in batches of batch_size boards, each rebuilt
+    on demand as read_group() does, so a per_grid file is never held dense as a whole.
+    :return: generator of tuples (boards, solutions) of np.ndarrays
+    """
+    with h5py.File(path, 'r') as hdf5:
+        key = 'grid_ids/%d' if hdf5.attrs.get('layout') == 'masked' else 'boards/%d'
+        for start in range(0, len(hdf5[key % num_clues]), batch_size):
+            yield read_group(hdf5, num_clues, start, start + batch_size, one_hot)
 
 
 def name_dataset(num_boards, clues_enum, one_hot):
@@ -256,6 +916,9 @@ def name_dataset(num_boards, clues_enum, one_hot):
         l = 'one_hot'
     else:
         l = 'int'
+    if isinstance(num_boards, dict):
+        return ("[%s]_%s" % (','.join('%dx%d' % (int(c), int(num_boards[c])) for c in sorted(num_boards, key=int)),
+                             l)).replace(' ', '')
     return ("%sx%d_%s" % (str(clues_enum), int(num_boards), l)).replace(' ', '')
 
 
@@ -273,6 +936,55 @@ class TestMakeData(unittest.TestCase):
         self.assertEqual(test_board[1].shape, (9, 9))
         self.assertEqual(test_board[1].dtype, 'uint8')
 
+        test_board = make_board(25)
+        self.assertEqual(count_solutions(test_board[0].tobytes().decode(), limit=None), 1)
+
+        random.seed(22)
+        stats = {}
+        for num_clues in (22, 22, 30):
+            puzzle = random_puzzle(num_clues, repair=True, stats=stats)
+            self.assertEqual(81 - puzzle.count('0'), num_clues)
+            self.assertEqual(count_solutions(puzzle), 1)
+        self.assertEqual(stats[22]['boards'], 2)
+        self.assertGreaterEqual(stats[22]['grids'], 2)
+        self.assertEqual(stats[30]['boards'], 1)
+        ## Restarts without repair are counted too, so the two modes can be compared.
+        random_puzzle(30, stats=stats)
+        self.assertEqual(stats[30]['boards'], 2)
+        self.assertGreaterEqual(stats[30]['grids'], 2)
+        random_puzzle(22, repair=False, stats=stats)
+        self.assertEqual(stats[22]['boards'], 3)
+        restarts = {}
+        random_puzzle(30, stats=restarts)
+        self.assertEqual((restarts[30]['boards'], restarts[30]['repairs']), (1, 0))
+
+        import dlx_engine as dlx
+        for num_clues, single_solution, engine in [(23, True, 'bitmask'), (30, True, 'dict'), (20, False, 'bitmask')]:
+            puzzle, solution = random_puzzle_and_solution(num_clues, single_solution, engine)
+            self.assertEqual(81 - puzzle.count('0'), num_clues)
+            self.assertTrue(all(a == '0' or a == b for a, b in zip(puzzle, solution)))
+            if single_solution:
+                self.assertEqual(dlx.count_solutions(puzzle), 1)
+                self.assertEqual(dlx.solve(puzzle), solution)
+
+    def test_minimal(self):
+        import dlx_engine as dlx
+        random.seed(20)
+        for _ in range(5):
+            puzzle = minimal_puzzle()
+            self.assertEqual(dlx.count_solutions(puzzle), 1)
+            for s in range(81):
+                if puzzle[s] != '0':
+                    self.assertEqual(dlx.count_solutions(puzzle[:s] + '0' + puzzle[s + 1:]), 2)
+        test_board = make_board(24, minimal=True)
+        self.assertEqual(81 - test_board[0].tobytes().count(b'0'), 24)
+        self.assertEqual(test_board[1].tobytes().decode(), dlx.solve(test_board[0].tobytes().decode()))
+        self.assertIsInstance(minimal_puzzle(max_nodes=10), BudgetExceeded)
+        self.assertIsInstance(random_puzzle(21, minimal=True, deadline=0.05), BudgetExceeded)
+        self.assertRaises(ValueError, lambda: random_puzzle(30, minimal=True))
+        self.assertRaises(ValueError, lambda: make_dataset(2, [24, 40], minimal=True))
+        self.assertGreater(board_cost(22, minimal=True), board_cost(24, minimal=True))
+
     def test_make_one_hot(self):
         self.assertRaises(ValueError, lambda: make_one_hot(ref_board=None, num_clues=None))
         test_board_a = make_one_hot(num_clues=50)
@@ -302,6 +1014,27 @@ class TestMakeData(unittest.TestCase):
         self.assertEqual(test_b.shape, (10, 2, 9, 9, 9))
         self.assertEqual(test_b.dtype, 'bool')
 
+        ## Boards that cannot be made within the budget are given up on, not retried for ever.
+        self.assertRaises(GenerationLimit, lambda: make_boards(1, 17, max_nodes=20))
+        self.assertRaises(GenerationLimit, lambda: make_grid_slots((0, 1, 22, 2, True, 10, None, None, [1])))
+        for options in ({}, {'workers': 2}, {'per_grid': 2}):
+            self.assertTrue(make_dataset({22: 2, 50: 2}, None, name='test_budget', max_nodes=100, seed=3, **options))
+            with h5py.File('test_budget.hdf5', 'r') as hdf5:
+                self.assertEqual(sorted(hdf5['solutions']), ['50'])
+        os.remove('test_budget.hdf5')
+
+    def test_make_boards_workers(self):
+        test_a = make_boards(5, 40, workers=2, seed=3)
+        self.assertEqual(test_a.shape, (5, 2, 9, 9))
+        np.testing.assert_array_equal(test_a, make_boards(5, 40, workers=2, seed=3))
+        self.assertFalse(np.array_equal(test_a, make_boards(5, 40, workers=2, seed=4)))
+        with multiprocessing.Pool(2) as pool:
+            np.testing.assert_array_equal(test_a, make_boards(5, 40, workers=2, seed=3, pool=pool))
+            test_b = make_boards(3, 40, one_hot=True, workers=2, seed=3, pool=pool)
+        self.assertEqual(test_b.shape, (3, 2, 9, 9, 9))
+        self.assertEqual(test_b.dtype, 'bool')
+        np.testing.assert_array_equal(make_boards(3, 40, seed=3), make_boards(3, 40, workers=1, seed=3))
+
     def test_name_dataset(self):
         self.assertEqual(name_dataset(10, [20, 30, 40, 50], True),
                          '[20,30,40,50]x10_one_hot')
@@ -429,10 +1162,207 @@ class TestMakeData(unittest.TestCase):
 
         hdf5.close()
 
+        self.assertTrue(make_dataset(4, [40, 45], one_hot=True, name='test_data', workers=2, seed=1))
+        with h5py.File('test_data.hdf5', 'r') as hdf5:
+            pooled = hdf5['boards/45'][:], hdf5['solutions/40'][:]
+        self.assertTrue(make_dataset(4, [40, 45], one_hot=True, name='test_data', seed=1))
+
+        hdf5 = h5py.File('test_data.hdf5')
+
+        test_boards, test_solutions = hdf5['boards/45'][:], hdf5['solutions/45'][:]
+        self.assertEqual(test_boards.shape, (4, 9, 9, 9))
+        self.assertEqual(test_solutions.dtype, 'bool')
+        self.assertTrue((test_boards <= test_solutions).all())
+        self.assertEqual(test_boards.sum(), 4 * 45)
+        self.assertEqual(hdf5['solutions/40'].shape, (4, 9, 9, 9))
+        np.testing.assert_array_equal(test_boards, pooled[0])
+        np.testing.assert_array_equal(hdf5['solutions/40'][:], pooled[1])
+
+        hdf5.close()
+
         self.assertTrue(os.path.exists('test_data.hdf5'))
         if os.path.exists('test_data.hdf5'):
             os.remove('test_data.hdf5')
 
+    def test_clue_groups(self):
+        self.assertGreater(board_cost(17), board_cost(22))
+        self.assertGreater(board_cost(22), board_cost(30))
+        self.assertGreater(board_cost(30), board_cost(60))
+        tasks = plan_tasks({23: 4, 60: 40}, 2)
+        self.assertEqual(tasks[0][0], 23)
+        self.assertGreater(len(tasks), 2)
+        self.assertEqual(sorted((c, b) for c, a, b in tasks if b == {23: 4, 60: 40}[c]), [(23, 4), (60, 40)])
+        self.assertEqual(sum(b - a for c, a, b in tasks), 44)
+
+        with multiprocessing.Pool(2) as pool:
+            made = []
+            for num_clues, shared in make_groups({30: 6, 50: 12}, pool, 2, seed=4):
+                with shared:
+                    self.assertEqual(shared.array.shape, (2, {30: 6, 50: 12}[num_clues], 9, 9))
+                    self.assertTrue(((shared.array[0] == 48) | (shared.array[0] == shared.array[1])).all())
+                    self.assertEqual((shared.array[0] != 48).sum(), num_clues * len(shared.array[0]))
+                    made.append((num_clues, shared.array.copy()))
+            self.assertEqual(sorted(c for c, a in made), [30, 50])
+            again = {}
+            for num_clues, shared in make_groups({30: 6, 50: 12}, pool, 1, seed=4):
+                with shared:
+                    again[num_clues] = shared.array.copy()
+            for c, a in made:
+                np.testing.assert_array_equal(again[c], a)
+
+        self.assertTrue(make_dataset({40: 3, 50: 5}, None, name='test_groups', workers=2, seed=2))
+        with h5py.File('test_groups.hdf5', 'r') as hdf5:
+            self.assertEqual(hdf5['boards/40'].shape, (3, 9, 9))
+            self.assertEqual(hdf5['solutions/50'].shape, (5, 9, 9))
+        os.remove('test_groups.hdf5')
+        self.assertEqual(name_dataset({50: 5, 40: 3}, [40, 50], False), '[40x3,50x5]_int')
+        self.assertRaises(ValueError, lambda: make_dataset({40: 3}, [40, 50], name='test_groups'))
+        self.assertRaises(ValueError, lambda: make_dataset({40: -1}, None, name='test_groups'))
+        ## A group of no boards is saved empty rather than left out.
+        for options in ({}, {'workers': 2}, {'per_grid': 2}):
+            self.assertTrue(make_dataset({24: 0, 50: 2}, None, name='test_groups', seed=2, **options))
+            self.assertEqual(read_boards('test_groups.hdf5', 24)[0].shape, (0, 9, 9))
+            self.assertEqual(read_boards('test_groups.hdf5', 50)[1].shape, (2, 9, 9))
+        os.remove('test_groups.hdf5')
+
+    def test_shards(self):
+        self.assertEqual(parse_shard('1/3'), (1, 3))
+        self.assertRaises(ValueError, lambda: parse_shard('3/3'))
+        self.assertRaises(ValueError, lambda: parse_shard('a/b'))
+        self.assertRaises(ValueError, lambda: make_dataset(4, 40, name='test_shard', shard=(0, 2)))
+        self.assertEqual([shard_size(10, (i, 3)) for i in range(3)], [4, 3, 3])
+
+        paths = []
+        for i in range(3):
+            self.assertTrue(make_dataset(5, [40, 45], name='test_shard', shard='%d/3' % i, seed=7))
+            paths.append(shard_name('test_shard', (i, 3)) + '.hdf5')
+        with h5py.File(paths[1], 'r') as hdf5:
+            first = hdf5['boards/45'][:]
+            self.assertEqual(first.shape, (2, 9, 9))
+            self.assertEqual(tuple(hdf5.attrs['shard']), (1, 3))
+        self.assertTrue(make_dataset(5, [40, 45], name='test_shard', shard=(1, 3), seed=7))
+        with h5py.File(paths[1], 'r') as hdf5:
+            np.testing.assert_array_equal(hdf5['boards/45'][:], first)
+
+        ## A copy of some boards under another name must be dropped by the merge.
+        with h5py.File(paths[0], 'r') as hdf5, h5py.File('test_shard_extra.hdf5', 'w') as extra:
+            extra.create_dataset('boards/45', data=np.concatenate([hdf5['boards/45'][:1], first]))
+            extra.create_dataset('solutions/45', data=np.zeros((1,), dtype='uint8'))
+        paths.append('test_shard_extra.hdf5')
+
+        for virtual in (False, True):
+            path = merge_shards(paths, 'test_merged', virtual=virtual)
+            with h5py.File(path, 'r') as hdf5:
+                self.assertEqual(hdf5['boards/40'].shape, (5, 9, 9))
+                self.assertEqual(hdf5['solutions/40'].shape, (5, 9, 9))
+                self.assertTrue((hdf5['boards/40'][:] <= hdf5['solutions/40'][:]).all())
+                boards = hdf5['boards/45'][:]
+                self.assertEqual(boards.shape, (5, 9, 9))
+                self.assertEqual(len(np.unique(boards.reshape(5, -1), axis=0)), 5)
+                self.assertEqual(hdf5['solutions/45'].shape, (1,))
+                self.assertEqual(hdf5['boards/45'].is_virtual, virtual)
+            os.remove(path)
+
+        self.assertRaises(ValueError, lambda: merge_shards(paths[:2] + paths[1:2], 'test_merged'))
+        for path in paths:
+            os.remove(path)
+
+    def test_per_grid(self):
+        import shutil
+        import dlx_engine as dlx
+        self.assertRaises(ValueError, lambda: make_dataset(4, 24, name='test_masked', per_grid=0))
+        self.assertRaises(ValueError, lambda: make_dataset(4, 24, name='test_masked', per_grid=2, minimal=True))
+
+        random.seed(25)
+        puzzles, solution = grid_puzzles(30, 4)
+        self.assertEqual(len(set(puzzles)), len(puzzles))
+        for puzzle in puzzles:
+            self.assertEqual(81 - puzzle.count('0'), 30)
+            self.assertEqual(dlx.solve(puzzle), solution)
+        self.assertIsInstance(grid_puzzles(22, 4, max_nodes=10), BudgetExceeded)
+        boards, grids = unmask_boards(np.frombuffer((solution * 2).encode(), dtype='uint8').reshape(2, 81),
+                                      clue_masks(puzzles[:2]))
+        self.assertEqual([b.tobytes().decode() for b in boards], puzzles[:2])
+
+        self.assertTrue(make_dataset(10, [24, 40], one_hot=True, name='test_masked', seed=5, per_grid=3))
+        with h5py.File('test_masked.hdf5', 'r') as hdf5:
+            self.assertEqual(hdf5.attrs['layout'], 'masked')
+            self.assertEqual(hdf5['clue_masks/40'].shape, (10, MASK_BYTES))
+            self.assertLessEqual(hdf5['solutions/40'].shape[0], 10)
+            self.assertGreaterEqual(hdf5['solutions/40'].shape[0], 4)
+            self.assertNotIn('boards', hdf5)
+        for num_clues in (24, 40):
+            boards, solutions = read_boards('test_masked.hdf5', num_clues)
+            self.assertEqual((boards.shape, boards.dtype), ((10, 9, 9, 9), np.bool_))
+            self.assertTrue((boards <= solutions).all())
+            self.assertEqual(boards.sum(), 10 * num_clues)
+            ints, int_solutions = read_boards('test_masked.hdf5', num_clues, 2, 5, one_hot=False)
+            np.testing.assert_array_equal(ints[..., None] == np.arange(49, 58), boards[2:5])
+            self.assertEqual(len(np.unique(ints.reshape(3, -1), axis=0)), 3)
+            for board, grid in zip(ints, int_solutions):
+                self.assertEqual(dlx.solve(board.tobytes().decode()), grid.tobytes().decode())
+            batches = list(iter_boards('test_masked.hdf5', num_clues, batch_size=4))
+            self.assertEqual([len(b) for b, s in batches], [4, 4, 2])
+            np.testing.assert_array_equal(np.concatenate([b for b, s in batches]), boards)
+
+        ## Slots draw their own streams, so workers do not change the boards.
+        self.assertTrue(make_dataset(10, [24, 40], one_hot=True, name='test_masked_workers', seed=5, per_grid=3,
+                                     workers=2))
+        for num_clues in (24, 40):
+            for a, b in zip(read_boards('test_masked.hdf5', num_clues),
+                            read_boards('test_masked_workers.hdf5', num_clues)):
+                np.testing.assert_array_equal(a, b)
+        self.assertTrue(make_dataset(10, 40, one_hot=True, name='test_dense', seed=5))
+        with h5py.File('test_masked.hdf5', 'r') as masked, h5py.File('test_dense.hdf5', 'r') as dense:
+            tables = ((masked, ('solutions', 'grid_ids', 'clue_masks')), (dense, ('boards', 'solutions')))
+            stored = [sum(f[t + '/40'].id.get_storage_size() for t in keys) for f, keys in tables]
+            self.assertLess(10 * stored[0], stored[1])
+        for path in ('test_masked.hdf5', 'test_masked_workers.hdf5', 'test_dense.hdf5'):
+            os.remove(path)
+
+        paths = []
+        for i in range(2):
+            self.assertTrue(make_dataset(5, 40, name='test_masked', shard=(i, 2), seed=7, per_grid=2))
+            paths.append(shard_name('test_masked', (i, 2)) + '.hdf5')
+        ## A copy of a shard under another name must be dropped by the merge.
+        shutil.copy(paths[0], 'test_masked_extra.hdf5')
+        with h5py.File('test_masked_extra.hdf5', 'a') as hdf5:
+            del hdf5.attrs['shard']
+        paths.append('test_masked_extra.hdf5')
+        path = merge_shards(paths, 'test_merged')
+        with h5py.File(path, 'r') as hdf5:
+            self.assertEqual(hdf5['grid_ids/40'].shape, (5,))
+            self.assertFalse(hdf5.attrs['one_hot'])
+            ## The copied shard adds no grids: each grid is kept once, and only if a kept board uses it.
+            grids = hdf5['solutions/40'][:]
+            shard_grids = [h5py.File(p, 'r') for p in paths[:2]]
+            self.assertEqual(len(grids), sum(len(f['solutions/40']) for f in shard_grids))
+            for f in shard_grids:
+                f.close()
+            self.assertEqual(len(np.unique(grids, axis=0)), len(grids))
+            self.assertEqual(sorted(set(hdf5['grid_ids/40'][:])), list(range(len(grids))))
+        boards, solutions = read_boards(path, 40)
+        self.assertEqual(boards.shape, (5, 9, 9))
+        self.assertEqual(len(np.unique(boards.reshape(5, -1), axis=0)), 5)
+        self.assertTrue(((boards == 48) | (boards == solutions)).all())
+        os.remove(path)
+
+        ## New boards on the grids of shard 0 point at its rows instead of adding copies.
+        with h5py.File('test_masked_extra.hdf5', 'a') as hdf5:
+            masks = hdf5['clue_masks/40'][:]
+            masks[:, 0] ^= 0x80
+            hdf5['clue_masks/40'][:] = masks
+        path = merge_shards(paths, 'test_merged')
+        with h5py.File(path, 'r') as hdf5:
+            self.assertEqual(len(hdf5['solutions/40']), len(grids))
+            self.assertEqual(hdf5['grid_ids/40'].shape, (8,))
+        boards, solutions = read_boards(path, 40)
+        np.testing.assert_array_equal(solutions[5:], read_boards(paths[0], 40)[1])
+        self.assertTrue(((boards == 48) | (boards == solutions)).all())
+        os.remove(path)
+        for path in paths:
+            os.remove(path)
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,236 @@
+# Parallel search within one puzzle: split the search tree over worker processes.
+# The tree is first expanded breadth-first to a frontier of independent subtrees, which are
+# handed to a process pool. Each worker searches its subtrees depth-first on an explicit stack
+# of bitmask states. Whenever a worker sits idle with nothing left to hand it, the busy workers
+# notice (the shared hungry count) and give back the unexplored part of their stack, which is
+# split among the idle ones, so a lopsided frontier does not leave all but one worker waiting.
+# A first-solution search stops every worker as soon as one finds a solution; counting adds up
+# what each subtree counted.
+
+import multiprocessing
+import queue
+import time
+import unittest
+from collections import deque
+
+import bitmask_engine as bm
+from budget import BudgetExceeded, CHECK_EVERY
+
+FRONTIER_PER_WORKER = 8  # subtrees to start with per worker
+
+_stop = _hungry = _nodes = None  # shared flags, set in each worker by init_worker()
+
+
+def init_worker(stop, hungry, nodes):
+    global _stop, _hungry, _nodes
+    _stop, _hungry, _nodes = stop, hungry, nodes
+
+
+def children(state, level):
+    """The states one branch below state, in the order search() tries them, or the solved
+    state itself as a string. Branches that fail to propagate are left out."""
+    if level > bm.SINGLES and not bm.strengthen(state, level):
+        return []
+    s = bm.choose(state)
+    if s < 0:
+        return bm.to_string(state)
+    found = []
+    for d in bm.DIGITS[state[s]]:
+        child = state[:]
+        if bm.assign(child, s, d):
+            found.append(child)
+    return found
+
+
+def frontier(state, level, size, limit):
+    """Expand state breadth-first until there are at least size open subtrees (or none left).
+    :return: tuple (list of open states, solutions met on the way, the first of them or None)"""
+    open_states, count, solution = deque([state]), 0, None
+    while open_states and len(open_states) < size and (limit is None or count < limit):
+        below = children(open_states.popleft(), level)
+        if isinstance(below, str):
+            count += 1
+            solution = solution or below
+        else:
+            open_states.extend(below)
+    return list(open_states), count, solution
+
+
+def explore(task):
+    """Pool worker: depth-first search of a stack of states until it is empty, limit solutions
+    are found, the search is stopped, or another worker is hungry for work.
+    :param task: tuple (stack of states, level, limit or None, max_nodes or None)
+    :return: tuple (solutions counted, the first solution or None, the states left unexplored, nodes)"""
+    stack, level, limit, max_nodes = task
+    count, solution, nodes = 0, None, 0
+    while stack:
+        nodes += 1
+        if not nodes % CHECK_EVERY:
+            with _nodes.get_lock():
+                _nodes.value += CHECK_EVERY
+                spent = _nodes.value
+            if _stop.value or (max_nodes is not None and spent > max_nodes):
+                break
+            if _hungry.value > 0 and len(stack) > 1:
+                break  # Give the rest back to be shared out
+        below = children(stack.pop(), level)
+        if isinstance(below, str):
+            count += 1
+            solution = solution or below
+            if count == limit:
+                break
+        else:
+            stack.extend(reversed(below))
+    with _nodes.get_lock():
+        _nodes.value += nodes % CHECK_EVERY
+    return count, solution, stack, nodes
+
+
+def split(states, pieces):
+    "Deal states out into at most pieces stacks, keeping each one's depth-first order."
+    pieces = min(max(1, pieces), len(states))
+    return [states[i::pieces] for i in range(pieces)]
+
+
+def stop_workers(stop, results, running):
+    "Stop the running workers and return the solutions they counted before stopping."
+    stop.value = 1
+    count = 0
+    for _ in range(running):
+        result = results.get()
+        if not isinstance(result, BaseException):
+            count += result[0]
+    return count
+
+
+def search(state, limit, workers, level=bm.SINGLES, max_nodes=None, deadline=None):
+    """Search state with workers processes for up to limit solutions (None for all).
+    :return: tuple (solutions found, capped at limit, the first solution string or None),
+             or a BudgetExceeded with the count so far as partial"""
+    started = time.time()
+    if state is False:
+        return 0, None
+    workers = workers or multiprocessing.cpu_count()
+    pending, total, solution = frontier(state, level, FRONTIER_PER_WORKER * workers, limit)
+    pending = [[s] for s in reversed(pending)]  # popped from the end: first subtree first
+    stop, hungry, nodes = multiprocessing.RawValue('b', 0), multiprocessing.RawValue('i', 0), \
+        multiprocessing.Value('q', 0)
+    results = queue.Queue()
+    running = 0
+    pool = multiprocessing.Pool(workers, init_worker, (stop, hungry, nodes))
+    try:
+        while limit is None or total < limit:
+            while pending and running < workers:
+                remaining = None if limit is None else limit - total
+                pool.apply_async(explore, ((pending.pop(), level, remaining, max_nodes),),
+                                 callback=results.put, error_callback=results.put)
+                running += 1
+            hungry.value = 0 if pending else workers - running
+            if not running:
+                break
+            wait = None if deadline is None else max(0.0, started + deadline - time.time())
+            try:
+                result = results.get(timeout=wait)
+            except queue.Empty:
+                total += stop_workers(stop, results, running)
+                running = 0
+                return BudgetExceeded('deadline', nodes.value, time.time() - started, total)
+            running -= 1
+            if isinstance(result, BaseException):
+                raise result
+            count, found, left, spent = result
+            total += count
+            solution = solution or found
+            if max_nodes is not None and nodes.value > max_nodes and (limit is None or total < limit):
+                total += stop_workers(stop, results, running)
+                running = 0
+                return BudgetExceeded('nodes', nodes.value, time.time() - started, total)
+            pending.extend(reversed(split(left, workers - running)))
+    finally:
+        ## Let the running tasks stop and hand back their results before the pool goes: terminate() with tasks
+        ## still out can deadlock on the pool's task queue.
+        stop_workers(stop, results, running)
+        pool.close()
+        pool.join()
+    return total if limit is None else min(total, limit), solution
+
+
+def solve(grid, workers=None, level=bm.SINGLES, max_nodes=None, deadline=None):
+    """Solve grid with workers processes: an 81-char solution string, or False if it has none.
+    max_nodes caps the nodes of all workers together (checked every budget.CHECK_EVERY nodes of each)
+    and deadline the seconds; when either runs out the result is a falsy BudgetExceeded."""
+    bm.check_level(level)
+    result = search(bm.parse_grid(grid), 1, workers, level, max_nodes, deadline)
+    if isinstance(result, BudgetExceeded):
+        result.partial = None
+        return result
+    return result[1] or False
+
+
+def count_solutions(grid, limit=2, workers=None, level=bm.SINGLES, max_nodes=None, deadline=None):
+    """Count the solutions of grid with workers processes, stopping once limit are found (None counts all).
+    A BudgetExceeded result has the count so far as partial."""
+    bm.check_level(level)
+    result = search(bm.parse_grid(grid), limit, workers, level, max_nodes, deadline)
+    if isinstance(result, BudgetExceeded):
+        return result
+    return result[0]
+
+
+class TestParallelSearch(unittest.TestCase):
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    pathological = '.....6....59.....82....8....45........3........6..3.54...325..6..................'
+
+    def setUp(self):
+        pass
+
+    def test_solve(self):
+        import dlx_engine as dlx
+        self.assertEqual(solve(self.hard, workers=2), dlx.solve(self.hard))
+        self.assertEqual(solve(self.hard, workers=2, level=bm.LOCKED), dlx.solve(self.hard))
+        solution = solve(self.pathological, workers=2)
+        self.assertEqual(dlx.count_solutions(solution), 1)
+        self.assertTrue(all(a == '.' or a == b for a, b in zip(self.pathological, solution)))
+        self.assertFalse(solve('11' + '.' * 79, workers=2))
+        self.assertEqual(solve(dlx.solve(self.hard), workers=2), dlx.solve(self.hard))
+
+    def test_count(self):
+        import dlx_engine as dlx
+        sparse = dlx.solve(self.hard)[:45] + '.' * 36
+        expected = dlx.count_solutions(sparse, limit=None)
+        self.assertGreater(expected, 1000)
+        self.assertEqual(count_solutions(sparse, limit=None, workers=3), expected)
+        self.assertEqual(count_solutions(sparse, limit=100, workers=2), 100)
+        self.assertEqual(count_solutions(self.pathological, workers=2), 2)
+        self.assertEqual(count_solutions(self.hard, limit=None, workers=2), 1)
+        self.assertEqual(count_solutions('11' + '.' * 79, workers=2), 0)
+        counted = count_solutions('.' * 81, limit=None, workers=2, deadline=0.5)
+        self.assertIsInstance(counted, BudgetExceeded)
+        self.assertGreater(counted.partial, 0)
+        counted = count_solutions('.' * 81, limit=None, workers=2, max_nodes=5000)
+        self.assertEqual(counted.reason, 'nodes')
+        self.assertRaises(ValueError, lambda: solve(self.hard, level=7))
+
+    def test_repeated(self):
+        ## The pool of every call must shut down cleanly however the search ends; a regression hangs here.
+        import dlx_engine as dlx
+        for _ in range(10):
+            self.assertEqual(solve(self.hard, workers=2), dlx.solve(self.hard))
+            self.assertEqual(count_solutions(self.pathological, workers=2), 2)
+            self.assertIsInstance(count_solutions('.' * 81, limit=None, workers=2, max_nodes=2000), BudgetExceeded)
+
+    def test_entry_points(self):
+        import sudoku_generator as sg
+        self.assertEqual(sg.solve(self.hard, workers=2), sg.solve(self.hard))
+        self.assertEqual(sg.search(sg.parse_grid(self.hard), workers=2), sg.solve(self.hard))
+        self.assertFalse(sg.solve('11' + '.' * 79, engine='dict', workers=2))
+        self.assertEqual(sg.count_solutions(self.pathological, workers=2), 2)
+        self.assertIsInstance(sg.solve(self.pathological, workers=2, deadline=0), BudgetExceeded)
+        self.assertRaises(ValueError, lambda: sg.solve(self.hard, engine='dlx', workers=2))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,227 @@
+# Solver portfolio: race several strategies on the same puzzle, one worker process each,
+# and take the first answer. A slow run of one strategy is usually a fast run of another,
+# so the race cuts the heavy tail of solve times. The workers are started once and kept;
+# the losers of each race are cancelled through their Budget (see budget.Budget(cancel=)).
+
+import multiprocessing
+import queue
+import random
+import time
+import unittest
+from collections import Counter
+
+import bitmask_engine as bm
+import cdcl_engine as cdcl
+import dlx_engine as dlx
+from budget import Budget, BudgetExceeded, OutOfBudget
+from cdcl_engine import luby
+
+RESTART_BASE = 32  # search nodes per unit of the Luby sequence in random_restarts()
+
+
+def random_search(state, rng, budget, restart):
+    """Depth-first search like bitmask_engine.search(), but picking at random among the squares
+    with the fewest candidates and trying their digits in random order. Every node is charged
+    to budget (may be None) and to restart."""
+    if budget is not None:
+        budget.spend()
+    restart.spend()
+    best = min(bm.POPCOUNT[m] if m & (m - 1) else 10 for m in state[:bm.N_SQUARES])
+    if best == 10:
+        return state  # Solved!
+    s = rng.choice([i for i in range(bm.N_SQUARES) if bm.POPCOUNT[state[i]] == best])
+    digits = list(bm.DIGITS[state[s]])
+    rng.shuffle(digits)
+    for d in digits:
+        child = state[:]
+        if bm.assign(child, s, d):
+            child = random_search(child, rng, budget, restart)
+            if child:
+                return child
+    return False
+
+
+def random_restarts(grid, budget=None, rng=random):
+    """Solve grid by randomized search, restarting after RESTART_BASE * luby(i) nodes on the i-th try.
+    The allowance grows without bound, so the search is complete: False means no solution."""
+    state = bm.parse_grid(grid)
+    if state is False:
+        return False
+    i = 0
+    while True:
+        restart = Budget(max_nodes=RESTART_BASE * luby(i))
+        try:
+            solution = random_search(state[:], rng, budget, restart)
+            return solution and bm.to_string(solution)
+        except OutOfBudget:
+            if restart.nodes <= restart.max_nodes:
+                raise  # budget ran out, not the restart
+        i += 1
+
+
+def solve_bitmask(grid, budget=None, rng=None):
+    solution = bm.solve(grid, budget=budget)
+    return solution and bm.to_string(solution)
+
+
+def solve_probing(grid, budget=None, rng=None):
+    solution = bm.solve(grid, level=bm.PROBING, budget=budget)
+    return solution and bm.to_string(solution)
+
+
+def solve_dlx(grid, budget=None, rng=None):
+    return dlx.solve(grid, budget)
+
+
+def solve_cdcl(grid, budget=None, rng=None):
+    return cdcl.solve(grid, budget)
+
+
+# Each strategy maps (grid, budget, rng) to an 81-char solution string, or False if there is none.
+STRATEGIES = {'bitmask': solve_bitmask,
+              'probing': solve_probing,
+              'dlx': solve_dlx,
+              'cdcl': solve_cdcl,
+              'luby': random_restarts}
+DEFAULT_STRATEGIES = ('bitmask', 'dlx', 'cdcl', 'luby')
+
+
+def run_strategy(name, seed, tasks, results, done):
+    "Worker loop: solve each (job, grid, max_nodes) from tasks until None, unless job is already done."
+    strategy, rng = STRATEGIES[name], random.Random(seed)
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        job, grid, max_nodes = task
+        if done.value >= job:
+            continue  # Another strategy already answered
+        budget = Budget(max_nodes, cancel=lambda: done.value >= job)
+        try:
+            results.put((job, name, strategy(grid, budget, rng)))
+        except OutOfBudget as e:
+            if e.reason == 'nodes':
+                results.put((job, name, None))
+
+
+class Portfolio(object):
+    """A set of strategy worker processes racing on every puzzle given to solve().
+    wins counts the races each strategy won. Use it as a context manager, or call close()."""
+
+    def __init__(self, strategies=DEFAULT_STRATEGIES, seed=None):
+        for name in strategies:
+            if name not in STRATEGIES:
+                raise ValueError('Unknown strategy %r; expected some of %s' % (name, ', '.join(sorted(STRATEGIES))))
+        self.strategies = tuple(strategies)
+        self.wins = Counter()
+        self.job = 0
+        self.done = multiprocessing.RawValue('q', 0)
+        self.results = multiprocessing.Queue()
+        self.tasks = []
+        self.workers = []
+        seeds = random.Random(seed)
+        for name in self.strategies:
+            tasks = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=run_strategy, name='portfolio-' + name,
+                                             args=(name, seeds.getrandbits(64), tasks, self.results, self.done))
+            worker.daemon = True
+            worker.start()
+            self.tasks.append(tasks)
+            self.workers.append(worker)
+
+    def solve(self, grid, max_nodes=None, deadline=None):
+        """The first answer to grid from any strategy: an 81-char solution string, or False if it has none.
+        max_nodes caps each strategy's search; if every strategy runs out, or deadline seconds pass
+        first, the losers are cancelled and the result is a falsy budget.BudgetExceeded."""
+        grid = ''.join(c for c in grid if c in '0123456789.')
+        self.job += 1
+        job, started = self.job, time.time()
+        for tasks in self.tasks:
+            tasks.put((job, grid, max_nodes))
+        out_of_nodes = 0
+        try:
+            while True:
+                wait = None if deadline is None else max(0.0, started + deadline - time.time())
+                try:
+                    answer_job, name, solution = self.results.get(timeout=wait)
+                except queue.Empty:
+                    return BudgetExceeded('deadline', 0, time.time() - started)
+                if answer_job != job:
+                    continue  # A late answer to an earlier puzzle
+                if solution is None:
+                    out_of_nodes += 1
+                    if out_of_nodes == len(self.strategies):
+                        return BudgetExceeded('nodes', max_nodes * out_of_nodes, time.time() - started)
+                    continue
+                self.wins[name] += 1
+                return solution
+        finally:
+            self.done.value = job  # Cancel the strategies still running
+
+    def win_rates(self):
+        "The fraction of races each strategy won."
+        total = sum(self.wins.values())
+        return dict((name, self.wins[name] / total if total else 0.0) for name in self.strategies)
+
+    def close(self):
+        self.done.value = self.job
+        for tasks in self.tasks:
+            tasks.put(None)
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TestPortfolio(unittest.TestCase):
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+    pathological = '.....6....59.....82....8....45........3........6..3.54...325..6..................'
+
+    def setUp(self):
+        pass
+
+    def test_random_restarts(self):
+        import sudoku_generator as sg
+        rng = random.Random(5)
+        random.seed(5)
+        for _ in range(20):
+            puzzle = sg.random_puzzle(24)
+            self.assertEqual(random_restarts(puzzle, rng=rng), dlx.solve(puzzle))
+        self.assertEqual(random_restarts(self.hard, rng=rng), dlx.solve(self.hard))
+        self.assertFalse(random_restarts('11' + '.' * 79, rng=rng))
+        self.assertFalse(random_restarts('12345678.' + '........9' + '.' * 63, rng=rng))
+        self.assertRaises(OutOfBudget, lambda: random_restarts(self.pathological, Budget(max_nodes=0), rng))
+
+    def test_race(self):
+        import numpy as np
+        from brute_force_solver import brute_force_solve
+        with Portfolio(seed=1) as portfolio:
+            solution = portfolio.solve(self.pathological)
+            self.assertEqual(dlx.count_solutions(solution), 1)
+            self.assertTrue(all(a == '.' or a == b for a, b in zip(self.pathological, solution)))
+            self.assertEqual(portfolio.solve(self.hard), dlx.solve(self.hard))
+            self.assertFalse(portfolio.solve('11' + '.' * 79))
+            board = np.frombuffer(self.hard.replace('.', '0').encode(), dtype='uint8').reshape(9, 9)
+            solved = brute_force_solve(board, portfolio=portfolio)
+            self.assertEqual(solved.tobytes().decode(), dlx.solve(self.hard))
+            self.assertEqual(sum(portfolio.wins.values()), 4)
+            self.assertAlmostEqual(sum(portfolio.win_rates().values()), 1.0)
+        with Portfolio(('bitmask',)) as portfolio:
+            self.assertIsInstance(portfolio.solve(self.pathological, deadline=0.2), BudgetExceeded)
+            self.assertIsInstance(portfolio.solve(self.pathological, max_nodes=100), BudgetExceeded)
+            self.assertEqual(portfolio.solve(self.hard), dlx.solve(self.hard))
+        self.assertRaises(ValueError, lambda: Portfolio(('bitmask', 'guess')))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
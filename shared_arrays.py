@@ -0,0 +1,91 @@
+# NumPy arrays in multiprocessing.shared_memory blocks, for pool workers to write results into.
+# The parent creates a SharedArray and sends its small, picklable spec along with each task;
+# a worker attaches by spec, writes its slots in place and returns only a short completion
+# message, so no result array is pickled back. The parent then uses the array directly.
+# brute_force_solver.solve_many() does not use it: its results are 81-char strings, still pickled.
+
+import unittest
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+def _no_register(name, rtype):
+    pass
+
+
+class SharedArray(object):
+    """A NumPy array (self.array) in a named shared memory block.
+    Made with a shape and dtype it creates and owns the block, which close() unlinks;
+    made from a spec with attach() it maps an existing block. Drop every view of
+    self.array before close(), since the block cannot be unmapped while views exist."""
+
+    def __init__(self, shape, dtype, name=None):
+        shape, dtype = tuple(shape), np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(1, int(np.prod(shape)) * dtype.itemsize)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+
+            except TypeError:
+                # Older Pythons register every attach with the resource tracker, which then
+                # warns of leaks and unlinks blocks the owner still uses. Unregistering
+                # afterwards would drop the owner's own entry when both share a tracker,
+                # so skip the registration instead, as track=False does.
+                register, resource_tracker.register = resource_tracker.register, _no_register
+                try:
+                    self.shm = shared_memory.SharedMemory(name=name)
+                finally:
+                    resource_tracker.register = register
+        self.array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+        self.spec = (self.shm.name, shape, dtype.str)
+
+    @classmethod
+    def attach(cls, spec):
+        "Map the SharedArray described by spec, e.g. in a pool worker."
+        name, shape, dtype = spec
+        return cls(shape, dtype, name)
+
+    def close(self):
+        self.array = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def fill_slots(task):
+    "Test worker: write value into slots start:stop of the SharedArray spec; return the slot count."
+    spec, start, stop, value = task
+    with SharedArray.attach(spec) as shared:
+        shared.array[start:stop] = value
+    return stop - start
+
+
+class TestSharedArrays(unittest.TestCase):
+    def setUp(self):
+        pass
+
+    def test_workers_write_slots(self):
+        import multiprocessing
+        with SharedArray((6, 9, 9), 'uint8') as shared, multiprocessing.Pool(2) as pool:
+            done = pool.map(fill_slots, [(shared.spec, 0, 2, 49), (shared.spec, 2, 6, 50)])
+            self.assertEqual(done, [2, 4])
+            self.assertTrue((shared.array[:2] == 49).all())
+            self.assertTrue((shared.array[2:] == 50).all())
+        with SharedArray((0, 2, 9, 9, 9), 'bool') as empty:
+            self.assertEqual(empty.array.shape, (0, 2, 9, 9, 9))
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,415 @@
+# Solve server: a long-running asyncio service answering puzzle requests from a warm process pool.
+# Clients send one JSON request per line over TCP (localhost) or a Unix socket and get one JSON
+# response per line back, tagged with the request's id. Requests are queued and taken off in
+# micro-batches, each batch going to one pool worker: a batch closes when it has max_batch requests
+# or window seconds after its first one arrived. At most one batch per worker is out at a time, so
+# while the workers are busy requests pile up and the next batches come out bigger; when the
+# server is idle a lone request waits at most window seconds.
+#
+# A request is {"id": any, "op": "solve" | "count" | "unique", "puzzle": "81 chars"} with optional
+# "limit" (count only: stop after this many solutions; all if omitted), "engine", "max_nodes" and
+# "deadline" (seconds). Responses are {"id": ..., "solution": "81 digits" or null}, {"id": ...,
+# "count": n}, {"id": ..., "unique": bool}, or {"id": ..., "error": "message"}. The server caps
+# every request's max_nodes and deadline at its own, so that no request (say, counting all the
+# solutions of an empty grid) holds a worker for good; a request that runs out gets an
+# "out of budget" error. A request that fails in the solver gets an error of its own, and the
+# rest of its batch is answered as usual.
+
+import asyncio
+import itertools
+import json
+import time
+import unittest
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import sudoku_generator as sg
+from brute_force_solver import board_to_string
+from budget import BudgetExceeded
+
+OPS = ('solve', 'count', 'unique')
+DEADLINE = 10.0  # default seconds a server allows any one request
+
+
+def answer(op, puzzle, limit=None, engine=sg.DEFAULT_ENGINE, max_nodes=None, deadline=None):
+    "The response fields for one request, puzzle already checked by board_to_string()."
+    if op == 'solve':
+        result = sg.solve(puzzle, engine, max_nodes=max_nodes, deadline=deadline)
+        if result and not isinstance(result, BudgetExceeded):
+            return {'solution': ''.join(result[s] for s in sg.squares)}
+    elif op == 'count':
+        result = sg.count_solutions(puzzle, limit, engine, max_nodes=max_nodes, deadline=deadline)
+        if not isinstance(result, BudgetExceeded):
+            return {'count': result}
+    else:
+        result = sg.count_solutions(puzzle, 2, engine, max_nodes=max_nodes, deadline=deadline)
+        if not isinstance(result, BudgetExceeded):
+            return {'unique': result == 1}
+    if isinstance(result, BudgetExceeded):
+        return {'error': 'out of budget (%s)' % result.reason}
+    return {'solution': None}
+
+
+def answer_batch(batch):
+    "Pool worker: the response fields for each (op, puzzle, limit, engine, max_nodes, deadline) in batch."
+    responses = []
+    for request in batch:
+        try:
+            responses.append(answer(*request))
+        except Exception as e:
+            responses.append({'error': 'solver failed: %s' % e})
+    return responses
+
+
+def warm_up():
+    "Run once in every pool worker at start, so the first real batch finds the engines loaded."
+    sg.solve('.' * 81)
+
+
+def check_option(request, key, types):
+    "The value of an optional non-negative number in request, or None; bools are not numbers here."
+    value = request.get(key)
+    if value is not None and (isinstance(value, bool) or not isinstance(value, types) or value < 0):
+        raise ValueError('"%s" must be a non-negative %s or null, not %r'
+                         % (key, 'integer' if types is int else 'number', value))
+    return value
+
+
+def capped(value, cap):
+    "value, or cap if that is smaller or value is None."
+    return cap if value is None else value if cap is None else min(value, cap)
+
+
+def parse_request(request, engine, max_nodes=None, deadline=None):
+    """The request tuple for answer_batch() from a decoded JSON request, its max_nodes and deadline
+    capped at the given ones (None for no cap).
+    :raises ValueError if it is not a well-formed request"""
+    if not isinstance(request, dict):
+        raise ValueError('request must be a JSON object')
+    op = request.get('op', 'solve')
+    if op not in OPS:
+        raise ValueError('unknown op %r; expected one of %s' % (op, ', '.join(OPS)))
+    if not isinstance(request.get('puzzle'), str):
+        raise ValueError('request needs a "puzzle" string')
+    engine = request.get('engine', engine)
+    sg.check_engine(engine)
+    limit = check_option(request, 'limit', int)
+    max_nodes = capped(check_option(request, 'max_nodes', int), max_nodes)
+    deadline = capped(check_option(request, 'deadline', (int, float)), deadline)
+    return op, board_to_string(request['puzzle']), limit, engine, max_nodes, deadline
+
+
+class SolveServer(object):
+    """The server. start() it on a TCP port or a Unix socket path inside a running event loop,
+    then serve_forever() or close(). batch_sizes counts the batches sent to the pool by size.
+    max_nodes and deadline are the most any one request may spend (None for no limit)."""
+
+    def __init__(self, workers=None, max_batch=64, window=0.002, engine=sg.DEFAULT_ENGINE, max_nodes=None,
+                 deadline=DEADLINE):
+        sg.check_engine(engine)
+        self.pool = ProcessPoolExecutor(workers)
+        self.workers = self.pool._max_workers
+        self.max_batch = max_batch
+        self.window = window
+        self.engine = engine
+        self.max_nodes = max_nodes
+        self.deadline = deadline
+        self.batch_sizes = Counter()
+        self.server = None
+        self.address = None
+
+    async def start(self, host='127.0.0.1', port=0, path=None):
+        """Listen on path (a Unix socket) if given, else on host:port; port 0 picks a free one.
+        self.address is then the path or the (host, port) actually bound."""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, warm_up) for _ in range(self.workers)])
+        self.requests = asyncio.Queue()
+        self.free_workers = asyncio.Semaphore(self.workers)
+        self.batcher = asyncio.ensure_future(self.make_batches())
+        if path is not None:
+            self.server = await asyncio.start_unix_server(self.handle, path)
+            self.address = path
+        else:
+            self.server = await asyncio.start_server(self.handle, host, port)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        return self.address
+
+    async def serve_forever(self):
+        try:
+            await self.server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.batcher.cancel()
+            self.server = None
+        self.pool.shutdown()
+
+    async def submit(self, request):
+        "Queue one request tuple and wait for its response fields."
+        done = asyncio.get_running_loop().create_future()
+        await self.requests.put((request, done))
+        return await done
+
+    async def make_batches(self):
+        "Take requests off the queue in batches of up to max_batch, at most window seconds apart."
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.free_workers.acquire()
+            batch = [await self.requests.get()]
+            closes = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                if self.requests.empty():
+                    wait = closes - loop.time()
+                    if wait <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.requests.get(), wait))
+                    except asyncio.TimeoutError:
+                        break
+                else:
+                    batch.append(self.requests.get_nowait())
+            self.batch_sizes[len(batch)] += 1
+            asyncio.ensure_future(self.run_batch(batch))
+
+    async def run_batch(self, batch):
+        try:
+            responses = await asyncio.get_running_loop().run_in_executor(
+                self.pool, answer_batch, [request for request, done in batch])
+        except Exception as e:
+            responses = [{'error': 'solver failed: %s' % e}] * len(batch)
+        finally:
+            self.free_workers.release()
+        for (request, done), response in zip(batch, responses):
+            if not done.cancelled():
+                done.set_result(response)
+
+    async def handle(self, reader, writer):
+        "Answer each request line on one connection, in whatever order the answers come back."
+        lock = asyncio.Lock()
+
+        async def reply(request_id, request):
+            response = await self.submit(request)
+            response['id'] = request_id
+            async with lock:
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+
+        replies = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request_id = None
+                try:
+                    request = json.loads(line)
+                    if isinstance(request, dict):
+                        request_id = request.get('id')
+                    request = parse_request(request, self.engine, self.max_nodes, self.deadline)
+                except ValueError as e:
+                    async with lock:
+                        writer.write(json.dumps({'id': request_id, 'error': str(e)}).encode() + b'\n')
+                    continue
+                task = asyncio.ensure_future(reply(request_id, request))
+                replies.add(task)
+                task.add_done_callback(replies.discard)
+            if replies:
+                await asyncio.gather(*replies, return_exceptions=True)
+        except ConnectionError:
+            pass
+        finally:
+            for task in replies:
+                task.cancel()
+            writer.close()
+
+
+class SolveClient(object):
+    """An asyncio client for one connection to a SolveServer. Calls may be made concurrently
+    on the same client; their requests are pipelined and the responses matched by id."""
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.ids = itertools.count()
+        self.waiting = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, address):
+        "Connect to address: a Unix socket path, or a (host, port) pair."
+        if isinstance(address, str):
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(*address)
+        return cls(reader, writer)
+
+    async def receive(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            done = self.waiting.pop(response.pop('id'), None)
+            if done is not None and not done.done():
+                done.set_result(response)
+        for done in self.waiting.values():
+            done.set_exception(ConnectionError('solve server closed the connection'))
+
+    async def request(self, op, puzzle, **options):
+        """Send one request and return its response fields.
+        :raises ValueError with the server's message if it answered with an error"""
+        request_id = next(self.ids)
+        done = self.waiting[request_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(json.dumps(dict(options, id=request_id, op=op, puzzle=puzzle)).encode() + b'\n')
+        await self.writer.drain()
+        response = await done
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    async def solve(self, puzzle, **options):
+        "The solution of puzzle as an 81-char string, or None if it has none."
+        return (await self.request('solve', puzzle, **options))['solution']
+
+    async def count(self, puzzle, limit=None, **options):
+        return (await self.request('count', puzzle, limit=limit, **options))['count']
+
+    async def unique(self, puzzle, **options):
+        return (await self.request('unique', puzzle, **options))['unique']
+
+    async def close(self):
+        self.writer.close()
+        self.receiver.cancel()
+
+
+async def load_test(address, puzzles, requests=1000, connections=4, concurrency=16, op='solve'):
+    """Load generator: send requests for puzzles (cycled) over connections, keeping concurrency
+    requests in flight on each one, and time the responses.
+    :return: dict with the requests answered, errors, seconds, requests per second and
+             p50/p90/p99/max latency in seconds"""
+    puzzles = itertools.cycle(puzzles)
+    remaining = [requests]
+    latencies, errors = [], [0]
+
+    async def send(client):
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            started = time.perf_counter()
+            try:
+                await client.request(op, next(puzzles))
+            except ValueError:
+                errors[0] += 1
+            latencies.append(time.perf_counter() - started)
+
+    clients = [await SolveClient.connect(address) for _ in range(connections)]
+    started = time.perf_counter()
+    await asyncio.gather(*[send(client) for client in clients for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    for client in clients:
+        await client.close()
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else 0.0
+
+    return {'requests': len(latencies), 'errors': errors[0], 'seconds': elapsed,
+            'requests_per_second': len(latencies) / elapsed if elapsed else 0.0,
+            'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': percentile(1.0)}
+
+
+class TestSolveServer(unittest.TestCase):
+    easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+
+    def setUp(self):
+        pass
+
+    def test_requests(self):
+        import dlx_engine as dlx
+
+        async def run():
+            server = SolveServer(workers=2, window=0.01)
+            address = await server.start()
+            try:
+                client = await SolveClient.connect(address)
+                self.assertEqual(await client.solve(self.easy), dlx.solve(self.easy))
+                self.assertEqual(await client.solve(self.hard, engine='dlx'), dlx.solve(self.hard))
+                self.assertIsNone(await client.solve('11' + '.' * 79))
+                self.assertEqual(await client.count('.' * 81, limit=5), 5)
+                self.assertTrue(await client.unique(self.easy))
+                self.assertFalse(await client.unique('.' * 81))
+                with self.assertRaises(ValueError):
+                    await client.solve('123')
+                with self.assertRaises(ValueError):
+                    await client.request('guess', self.easy)
+                with self.assertRaises(ValueError):
+                    await client.count('.' * 81, max_nodes=10)
+                for options in ({'max_nodes': 'lots'}, {'limit': -1}, {'limit': 2.5}, {'deadline': '1'},
+                                {'max_nodes': True}):
+                    with self.assertRaises(ValueError):
+                        await client.count(self.easy, **options)
+                self.assertEqual(await client.count(self.easy, deadline=1, max_nodes=None), 1)
+                answers = await asyncio.gather(*[client.solve(self.easy) for _ in range(20)])
+                self.assertEqual(answers, [dlx.solve(self.easy)] * 20)
+                self.assertGreater(max(server.batch_sizes), 1)
+                await client.close()
+                report = await load_test(address, [self.easy, self.hard], requests=50, connections=2, concurrency=4)
+                self.assertEqual((report['requests'], report['errors']), (50, 0))
+                self.assertLessEqual(report['p50'], report['max'])
+            finally:
+                await server.close()
+
+        asyncio.run(run())
+
+    def test_limits(self):
+        import dlx_engine as dlx
+        ## A request that fails in the solver spoils only its own response.
+        bad, good = answer_batch([('count', self.easy, None, 'bitmask', 'lots', None),
+                                  ('solve', self.easy, None, 'bitmask', None, None)])
+        self.assertIn('solver failed', bad['error'])
+        self.assertEqual(good, {'solution': dlx.solve(self.easy)})
+        self.assertEqual(parse_request({'puzzle': self.easy, 'max_nodes': 50}, 'bitmask', 10)[4], 10)
+        self.assertEqual(parse_request({'puzzle': self.easy}, 'bitmask', None, 2.0)[5], 2.0)
+        self.assertEqual(parse_request({'puzzle': self.easy, 'deadline': 0.5}, 'bitmask', None, 2.0)[5], 0.5)
+
+        async def run():
+            server = SolveServer(workers=1, deadline=0.2)
+            address = await server.start()
+            try:
+                client = await SolveClient.connect(address)
+                with self.assertRaisesRegex(ValueError, 'out of budget'):
+                    await client.count('.' * 81)
+                self.assertEqual(await client.count(self.easy), 1)
+                await client.close()
+            finally:
+                await server.close()
+
+        asyncio.run(run())
+
+    def test_unix_socket(self):
+        import os
+        import tempfile
+
+        async def run():
+            server = SolveServer(workers=1)
+            path = os.path.join(tempfile.mkdtemp(), 'solve.sock')
+            await server.start(path=path)
+            try:
+                client = await SolveClient.connect(path)
+                self.assertEqual(await client.count(self.easy), 1)
+                await client.close()
+            finally:
+                await server.close()
+                os.remove(path)
+
+        asyncio.run(run())
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,235 @@
+# Solver counters: an instrumented copy of the bitmask engine's propagation and search.
+# The plain engine in bitmask_engine carries no counters at all; callers that pass a SolveStats
+# to sudoku_generator.solve/search or brute_force_solve run through this module instead, which
+# visits the same nodes in the same order and fills in the counters as it goes.
+
+import unittest
+from time import perf_counter
+
+import bitmask_engine as bm
+from bitmask_engine import BIT, CELL_COUNTS, COUNT_UNITS, DIGITS, PEERS, POPCOUNT, SINGLES
+
+
+class SolveStats(object):
+    """Counters for one or more solves. Pass the same SolveStats to several calls, or add
+    SolveStats together (a + b, sum(list_of_stats)), to aggregate them over a batch.
+        solves: solve or search calls counted
+        assign_calls: digits assigned, as givens or as search branches
+        eliminate_calls: (square, digit) candidates eliminated
+        singles: squares propagation fixed, by naked singles (one digit left in the square)
+                 or hidden singles (one place left for a digit in a unit)
+        nodes: search nodes visited; backtracks: branches that failed
+        max_depth: deepest search level reached
+        propagate_time, total_time: seconds in propagation, and in the whole call;
+                 branch_time is the rest (choosing squares, copying states)"""
+
+    FIELDS = ('solves', 'assign_calls', 'eliminate_calls', 'singles', 'nodes', 'backtracks', 'max_depth',
+              'propagate_time', 'total_time')
+
+    def __init__(self, **counts):
+        for field in self.FIELDS:
+            setattr(self, field, counts.pop(field, 0))
+        if counts:
+            raise TypeError('Unknown SolveStats fields: %s' % ', '.join(sorted(counts)))
+
+    @property
+    def branch_time(self):
+        return self.total_time - self.propagate_time
+
+    def as_dict(self):
+        counts = dict((field, getattr(self, field)) for field in self.FIELDS)
+        counts['branch_time'] = self.branch_time
+        return counts
+
+    def __iadd__(self, other):
+        for field in self.FIELDS:
+            if field == 'max_depth':
+                self.max_depth = max(self.max_depth, other.max_depth)
+            else:
+                setattr(self, field, getattr(self, field) + getattr(other, field))
+        return self
+
+    def __add__(self, other):
+        total = SolveStats()
+        total += self
+        total += other
+        return total
+
+    def __radd__(self, other):
+        if other == 0:
+            return self + SolveStats()  # so that sum() works
+        return NotImplemented
+
+    def __eq__(self, other):
+        return isinstance(other, SolveStats) and self.as_dict() == other.as_dict()
+
+    def __repr__(self):
+        return 'SolveStats(%s)' % ', '.join('%s=%r' % (field, getattr(self, field)) for field in self.FIELDS)
+
+
+def propagate(state, todo, stats):
+    "bitmask_engine.propagate(), counting eliminations, singles and time into stats."
+    pop, push = todo.pop, todo.append
+    digits_of, bits, cell_counts, count_units, peers = DIGITS, BIT, CELL_COUNTS, COUNT_UNITS, PEERS
+    eliminated = singles = 0
+    start = perf_counter()
+    try:
+        while todo:
+            s, rem = pop()
+            m = state[s]
+            rem &= m
+            if not rem:
+                continue  # Already eliminated
+            eliminated += POPCOUNT[rem]
+            m ^= rem
+            if not m:
+                return False  # Contradiction: removed last value
+            state[s] = m
+            for d in digits_of[rem]:
+                for k in cell_counts[s]:
+                    k += d
+                    n = state[k] - 1
+                    if n == 1:
+                        state[k] = 1
+                        bit = bits[d]
+                        for s2 in count_units[k]:
+                            if state[s2] & bit:
+                                break
+                        if state[s2] != bit:
+                            push((s2, state[s2] ^ bit))
+                    elif n:
+                        state[k] = n
+                    else:
+                        return False  # Contradiction: no place for this value
+            if not m & (m - 1):
+                singles += 1
+                for s2 in peers[s]:
+                    if state[s2] & m:
+                        push((s2, m))
+        return True
+    finally:
+        stats.eliminate_calls += eliminated
+        stats.singles += singles
+        stats.propagate_time += perf_counter() - start
+
+
+def parse_grid(grid, stats):
+    "bitmask_engine.parse_grid(), counting the givens as assignments and what their setup eliminated."
+    setup = bm.givens_state(grid)
+    if not setup:
+        return False
+    state, todo = setup
+    givens = sum(d >= 0 for d in bm.grid_digits(grid))
+    stats.assign_calls += givens
+    stats.singles += sum(POPCOUNT[m] == 1 for m in state[:bm.N_SQUARES]) - givens
+    stats.eliminate_calls += 9 * bm.N_SQUARES - sum(POPCOUNT[m] for m in state[:bm.N_SQUARES])
+    if not propagate(state, todo, stats):
+        return False
+    return state
+
+
+def search(state, level=SINGLES, stats=None, budget=None, depth=0):
+    "bitmask_engine.search(), counting into stats."
+    if state is False:
+        return False  # Failed earlier
+    if budget is not None:
+        budget.spend()
+    stats.nodes += 1
+    if depth > stats.max_depth:
+        stats.max_depth = depth
+    if level > SINGLES:
+        start = perf_counter()
+        strong = bm.strengthen(state, level)
+        stats.propagate_time += perf_counter() - start
+        if not strong:
+            return False
+    s = bm.choose(state)
+    if s < 0:
+        return state  # Solved!
+    for d in DIGITS[state[s]]:
+        child = state[:]
+        stats.assign_calls += 1
+        if propagate(child, [(s, child[s] & ~BIT[d])], stats):
+            child = search(child, level, stats, budget, depth + 1)
+            if child:
+                return child
+        stats.backtracks += 1
+    return False
+
+
+def run(state, level, stats, budget=None):
+    "search() from state, timing the call and counting it as one solve."
+    start = perf_counter()
+    try:
+        return search(state, level, stats, budget)
+    finally:
+        stats.solves += 1
+        stats.total_time += perf_counter() - start
+
+
+def solve(grid, level=SINGLES, stats=None, budget=None):
+    "bitmask_engine.solve() in copy mode, counting the parse and the search into stats."
+    start = perf_counter()
+    try:
+        return search(parse_grid(grid, stats), level, stats, budget)
+    finally:
+        stats.solves += 1
+        stats.total_time += perf_counter() - start
+
+
+class TestSolveStats(unittest.TestCase):
+    easy = '003020600900305001001806400008102900700000008006708200002609500800203009005010300'
+    hard = '4.....8.5.3..........7......2.....6.....8.4......1.......6.3.7.5..2.....1.4......'
+
+    def setUp(self):
+        pass
+
+    def test_counts(self):
+        stats = SolveStats()
+        self.assertEqual(bm.to_string(solve(self.easy, stats=stats)), bm.to_string(bm.solve(self.easy)))
+        self.assertEqual((stats.solves, stats.nodes, stats.backtracks, stats.max_depth), (1, 1, 0, 0))
+        self.assertEqual(stats.assign_calls, 32)
+        self.assertEqual(stats.eliminate_calls, 81 * 9 - 81)
+        self.assertEqual(stats.singles, 81 - 32)
+        hard = SolveStats()
+        self.assertEqual(solve(self.hard, stats=hard), bm.solve(self.hard))
+        self.assertGreater(hard.backtracks, 0)
+        self.assertLessEqual(hard.nodes, hard.assign_calls - 17 + 1)  # a node per branch that propagated
+        self.assertGreater(hard.max_depth, 0)
+        self.assertGreaterEqual(hard.branch_time, 0)
+        self.assertFalse(solve('11' + '.' * 79, stats=SolveStats()))
+
+    def test_aggregate(self):
+        a, b = SolveStats(), SolveStats()
+        solve(self.easy, stats=a)
+        solve(self.hard, stats=b)
+        total = sum([a, b])
+        self.assertEqual(total.nodes, a.nodes + b.nodes)
+        self.assertEqual(total.max_depth, b.max_depth)
+        self.assertEqual(total.solves, 2)
+        a += b
+        self.assertEqual(a, total)
+        self.assertRaises(TypeError, lambda: SolveStats(calls=1))
+
+    def test_entry_points(self):
+        import numpy as np
+        import sudoku_generator as sg
+        import brute_force_solver as bfs
+        stats = SolveStats()
+        for engine in ('dict', 'bitmask'):
+            self.assertEqual(sg.solve(self.hard, engine=engine, stats=stats), sg.solve(self.hard))
+        self.assertEqual(sg.search(sg.parse_grid(self.hard), mode='trail', stats=stats), sg.solve(self.hard))
+        board = np.frombuffer(self.hard.replace('.', '0').encode(), dtype='uint8').reshape(9, 9)
+        bfs.brute_force_solve(board, stats=stats)
+        self.assertEqual(stats.solves, 4)
+        self.assertRaises(ValueError, lambda: sg.solve(self.hard, engine='dlx', stats=stats))
+        limited = SolveStats()
+        self.assertFalse(sg.solve(self.hard, max_nodes=5, stats=limited))
+        self.assertEqual(limited.nodes, 5)
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
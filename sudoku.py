@@ -2,19 +2,230 @@
 
 import argparse
 import datetime
+import sys
+import time
 
 from make_data import *
+from brute_force_solver import solve_lines
+
+IO_BUFFER = 1 << 20  # bytes of buffering on the solve command's input and output
+
+
+def solve_command(argv):
+    """sudoku.py solve: read puzzles one per line from files or stdin, write solutions to stdout."""
+    parser = argparse.ArgumentParser(
+        prog='sudoku.py solve',
+        description='Solves puzzles given one per line as 81 digits, with 0 or . for blanks, '
+                    'and writes one line per puzzle to stdout: its solution, or the puzzle itself if it has '
+                    'no solution or runs out of budget. Those puzzles are reported to stderr, and malformed '
+                    'lines are reported there and skipped.')
+
+    parser.add_argument('input', help="Files to read puzzles from; stdin if none, or for '-'.", nargs='*')
+
+    parser.add_argument('-w', '--workers', help="Specifies how many worker processes solve puzzles.",
+                        action="store", type=int, default=multiprocessing.cpu_count())
+
+    parser.add_argument('--chunk_size', help="Specifies how many puzzles are sent to a worker at a time.",
+                        action="store", type=int, default=256)
+
+    parser.add_argument('-u', '--unordered',
+                        help="Specifies that solutions are written as soon as they are ready instead of in input "
+                             "order. Faster when solve times vary a lot.",
+                        action="store_true")
+
+    parser.add_argument('-e', '--engine', help="Specifies the solver engine.", action="store",
+                        choices=ENGINES, default=DEFAULT_ENGINE)
+
+    parser.add_argument('--max_nodes', help="Specifies the most search nodes spent on a puzzle.",
+                        action="store", type=int)
+
+    parser.add_argument('--deadline', help="Specifies the most seconds spent on a puzzle.",
+                        action="store", type=float)
+
+    parser.add_argument('-s', '--stats', help="Specifies that counts and throughput are reported to stderr at the end.",
+                        action="store_true")
+
+    args = parser.parse_args(argv)
+
+    def lines():
+        for path in args.input or ['-']:
+            if path == '-':
+                yield from open(sys.stdin.fileno(), 'r', buffering=IO_BUFFER, closefd=False)
+            else:
+                with open(path, 'r', buffering=IO_BUFFER) as f:
+                    yield from f
+
+    start_time = time.time()
+    with open(sys.stdout.fileno(), 'w', buffering=IO_BUFFER, closefd=False) as out:
+        counts = solve_lines(lines(), out, sys.stderr, workers=args.workers, chunk_size=args.chunk_size,
+                             ordered=not args.unordered, engine=args.engine, max_nodes=args.max_nodes,
+                             deadline=args.deadline)
+    elapsed = time.time() - start_time
+    if args.stats:
+        sys.stderr.write('%d puzzles: %d solved, %d unsolved, %d malformed lines in %.2f seconds (%.0f puzzles/s)\n'
+                         % (counts['puzzles'], counts['solved'], counts['unsolved'], counts['malformed'], elapsed,
+                            counts['puzzles'] / elapsed if elapsed else 0.0))
+    return 1 if counts['unsolved'] or counts['malformed'] else 0
+
+
+def server_address(args):
+    "The address given by the serve and load commands' --unix or --host/--port options."
+    return args.unix if args.unix else (args.host, args.port)
+
+
+def serve_command(argv):
+    """sudoku.py serve: run a solve_server.SolveServer until interrupted."""
+    import asyncio
+    from solve_server import DEADLINE, SolveServer
+
+    parser = argparse.ArgumentParser(
+        prog='sudoku.py serve',
+        description='Runs a solve server answering JSON-lines solve, count and unique requests '
+                    'from a warm pool of worker processes.')
+    parser.add_argument('--host', help="Specifies the address to listen on.", action="store", default='127.0.0.1')
+    parser.add_argument('-p', '--port', help="Specifies the TCP port to listen on.", action="store", type=int,
+                        default=8181)
+    parser.add_argument('--unix', help="Specifies a Unix socket path to listen on instead of TCP.", action="store")
+    parser.add_argument('-w', '--workers', help="Specifies how many worker processes solve puzzles.",
+                        action="store", type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--max_batch', help="Specifies the most requests sent to a worker at a time.",
+                        action="store", type=int, default=64)
+    parser.add_argument('--window', help="Specifies the most seconds a request waits for its batch to fill.",
+                        action="store", type=float, default=0.002)
+    parser.add_argument('-e', '--engine', help="Specifies the default solver engine.", action="store",
+                        choices=ENGINES, default=DEFAULT_ENGINE)
+    parser.add_argument('--max_nodes', help="Specifies the most search nodes any one request may spend.",
+                        action="store", type=int)
+    parser.add_argument('--deadline', help="Specifies the most seconds any one request may spend.",
+                        action="store", type=float, default=DEADLINE)
+    args = parser.parse_args(argv)
+
+    async def serve():
+        server = SolveServer(workers=args.workers, max_batch=args.max_batch, window=args.window, engine=args.engine,
+                             max_nodes=args.max_nodes, deadline=args.deadline)
+        print('Serving on %s' % (server_address(args),))
+        await server.start(args.host, args.port, args.unix)
+        await server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def load_command(argv):
+    """sudoku.py load: send puzzles from files or stdin to a solve server and report its throughput."""
+    import asyncio
+    from solve_server import OPS, load_test
+
+    parser = argparse.ArgumentParser(prog='sudoku.py load', description='Load generator for sudoku.py serve.')
+    parser.add_argument('input', help="Files to read puzzles from; stdin if none, or for '-'.", nargs='*')
+    parser.add_argument('--host', help="Specifies the server's address.", action="store", default='127.0.0.1')
+    parser.add_argument('-p', '--port', help="Specifies the server's TCP port.", action="store", type=int,
+                        default=8181)
+    parser.add_argument('--unix', help="Specifies the server's Unix socket path instead of TCP.", action="store")
+    parser.add_argument('-r', '--requests', help="Specifies how many requests to send.", action="store", type=int,
+                        default=10000)
+    parser.add_argument('--connections', help="Specifies how many connections to send them over.",
+                        action="store", type=int, default=4)
+    parser.add_argument('--concurrency', help="Specifies how many requests are in flight on each connection.",
+                        action="store", type=int, default=16)
+    parser.add_argument('--op', help="Specifies the request op.", action="store", choices=OPS, default='solve')
+    args = parser.parse_args(argv)
+
+    puzzles = []
+    for path in args.input or ['-']:
+        with (open(sys.stdin.fileno(), closefd=False) if path == '-' else open(path)) as f:
+            puzzles.extend(line.strip() for line in f if line.strip())
+    report = asyncio.run(load_test(server_address(args), puzzles, args.requests, args.connections,
+                                   args.concurrency, args.op))
+    print('%(requests)d requests, %(errors)d errors in %(seconds).2f seconds (%(requests_per_second).0f requests/s)'
+          % report)
+    print('latency p50 %.1f ms, p90 %.1f ms, p99 %.1f ms, max %.1f ms'
+          % tuple(1000 * report[p] for p in ('p50', 'p90', 'p99', 'max')))
+    return 0
+
+
+def merge_command(argv):
+    """sudoku.py merge: put the shard files of a --shard build together into one HDF5 file."""
+    parser = argparse.ArgumentParser(
+        prog='sudoku.py merge',
+        description='Merges the HDF5 files made with --shard into one file with the same boards/<clues> and '
+                    'solutions/<clues> layout. Boards found in more than one shard are kept once.')
+    parser.add_argument('shards', help="Shard files to merge, in order.", nargs='+')
+    parser.add_argument('-n', '--name', help="Specifies what name the merged HDF5 file will have.", action="store",
+                        required=True)
+    parser.add_argument('-d', '--destination', help="Specifies what directory the merged HDF5 file will be in.",
+                        action="store")
+    parser.add_argument('-v', '--virtual',
+                        help="Specifies that the merged file reads the boards from the shard files through HDF5 "
+                             "virtual datasets instead of holding a copy of them.",
+                        action="store_true")
+    args = parser.parse_args(argv)
+    path = merge_shards(args.shards, args.name, dest=args.destination, virtual=args.virtual)
+    print('Merged %d shards into %s' % (len(args.shards), path))
+    return 0
+
+
+def bank_command(argv):
+    """sudoku.py bank: build a grid bank file for --bank."""
+    from grid_bank import build_bank
+
+    parser = argparse.ArgumentParser(
+        prog='sudoku.py bank',
+        description='Builds a bank of solved grids, saved as a memory-mapped .npy file. Given to the generator '
+                    'with --bank, every board is dug from a random transform of one of its grids instead of a '
+                    'grid built from scratch.')
+    parser.add_argument('path', help="The .npy file to write.")
+    parser.add_argument('-g', '--grids', help="Specifies how many grids the bank holds.", action="store", type=int,
+                        default=10000)
+    parser.add_argument('-s', '--seed', help="Specifies the seed the grids are built from.", action="store", type=int)
+    args = parser.parse_args(argv)
+    build_bank(args.path, args.grids, seed=args.seed)
+    print('Saved %d grids to %s' % (args.grids, args.path))
+    return 0
+
+
+BOARDS_ERROR = 'Give -b one count, or clues:count pairs, not %s.'
+
+
+def parse_boards(entries):
+    """The generator's -b entries: one count, used for every clue group, or clues:count pairs such as 24:100 40:1000.
+    :raises ValueError if they are neither"""
+    if entries is None:
+        return None
+    if not any(':' in entry for entry in entries):
+        if len(entries) != 1:
+            raise ValueError(BOARDS_ERROR % ' '.join(entries))
+        return int(entries[0])
+    try:
+        return dict((int(c), int(n)) for c, n in (entry.split(':') for entry in entries))
+    except ValueError:
+        raise ValueError(BOARDS_ERROR % ' '.join(entries))
+
+
+COMMANDS = {'solve': solve_command, 'serve': serve_command, 'load': load_command, 'merge': merge_command,
+            'bank': bank_command}
 
 if __name__ == '__main__':
+    if sys.argv[1:2] and sys.argv[1] in COMMANDS:
+        sys.exit(COMMANDS[sys.argv[1]](sys.argv[2:]))
+
     parser = argparse.ArgumentParser(
-        description='Sudoku Generator in Python by Keith Fernandez and Ryan Giarusso.', )
+        description='Sudoku Generator in Python by Keith Fernandez and Ryan Giarusso. '
+                    'Run "sudoku.py solve -h", "sudoku.py serve -h" or "sudoku.py load -h" for the solver commands, '
+                    '"sudoku.py merge -h" to merge the files of a --shard build, and "sudoku.py bank -h" to build '
+                    'a --bank file.', )
 
-    parser.add_argument('-b', '--boards', help="Specifies how many boards are to be generated.", action="store",
-                        nargs=1, required=False)
+    parser.add_argument('-b', '--boards',
+                        help="Specifies how many boards are to be generated: one count, used for every clue group, or "
+                             "clues:count pairs (-b 24:100 40:1000), in which case -c may be left out.",
+                        action="store", nargs='+', required=False)
 
     parser.add_argument('-c', '--clues',
                         help="Specifies how many clues per board are to be generated. Supports multiple arguments.",
-                        action="append", nargs='+', required=True)
+                        action="append", nargs='+')
 
     parser.add_argument('-o', '--one_hot',
                         help="Specifies that program should generate in one_hot bool format instead of uint8 format.",
@@ -33,21 +244,57 @@ if __name__ == '__main__':
                              "Boards with single solutions and low numbers of clues will take much longer to generate!",
                         action="store_true")
 
+    parser.add_argument('-m', '--minimal',
+                        help="Specifies that boards will be minimal: single solution, and no clue can be removed "
+                             "without losing it. Clues must be 21-28.",
+                        action="store_true")
+
+    parser.add_argument('--bank',
+                        help="Specifies a grid bank file (see \"sudoku.py bank\") to dig boards from, which saves "
+                             "building a full grid for each board.",
+                        action="store")
+
+    parser.add_argument('-K', '--per_grid',
+                        help="Specifies that up to K different boards are dug from each solution grid, and that each "
+                             "board is saved as its grid's row in solutions/<clues> and a clue mask; read them back "
+                             "with make_data.read_boards() or iter_boards().",
+                        action="store", type=int)
+
     parser.add_argument('-iS', '--include_solutions',
                         help="Specifies that solution boards will be included in the resulting HDF5 file.",
                         action="store_true")
 
+    parser.add_argument('-w', '--workers', help="Specifies how many worker processes generate boards.",
+                        action="store", type=int)
+
+    parser.add_argument('-s', '--seed',
+                        help="Specifies the master seed; the same seed, workers and shard make the same boards.",
+                        action="store", type=int)
+
+    parser.add_argument('--shard',
+                        help="Specifies that only shard i/N (0 <= i < N) of the dataset is made, into its own file, "
+                             "e.g. on machine i of N. Needs --seed; see \"sudoku.py merge\".",
+                        action="store")
+
     # gen_parser.add_argument('-S')
 
     args = parser.parse_args()
+    try:
+        boards = parse_boards(args.boards)
+    except ValueError as e:
+        parser.error(str(e))
+    if args.clues is None and not isinstance(boards, dict):
+        parser.error('-c is required unless -b gives clues:count pairs.')
 
     print('==================================================')
     print("=   Giarusso/Fernandez/Norvig Sudoku Generator   =")
     print('==================================================')
 
     start_time = datetime.datetime.now()
-    make_dataset(num_boards=args.boards, clues_enum=args.clues, one_hot=args.one_hot, name=args.name,
-                 dest=args.destination, single_solution=args.single_solution, include_solutions=args.include_solutions)
+    make_dataset(num_boards=boards, clues_enum=args.clues, one_hot=args.one_hot, name=args.name and args.name[0],
+                 dest=args.destination and args.destination[0], single_solution=args.single_solution,
+                 include_solutions=args.include_solutions, workers=args.workers, seed=args.seed, shard=args.shard,
+                 minimal=args.minimal, bank=args.bank, per_grid=args.per_grid)
 
     end_time = datetime.datetime.now() - start_time
     print('\nFinished in ' + str(end_time) + ' seconds.')
@@ -1,10 +1,20 @@
 # This code was made/adapted from Peter Norvig's Sudoku. http://norvig.com/sudoku.html
 
 import random
+from collections import Counter
 
 import unittest
 import numpy as np
 
+import bitmask_engine as bm
+import dlx_engine as dlx
+import cdcl_engine as cdcl
+from budget import BudgetExceeded, OutOfBudget, make_budget
+import grid_bank
+import parallel_search
+import solve_stats
+import unavoidable
+
 
 class TheoreticalLimit(Exception):
     pass
@@ -26,10 +36,34 @@ units = dict((s, [u for u in unitlist if s in u])
 peers = dict((s, set(sum(units[s], [])) - set([s]))
              for s in squares)
 
+# Engines: 'dict' keeps {square: digits} strings, 'bitmask' keeps 9-bit masks (see bitmask_engine),
+# 'dlx' solves and counts by exact cover (see dlx_engine) and 'cdcl' by clause learning (see cdcl_engine);
+# those two keep no candidate state of their own.
+ENGINES = ('dict', 'bitmask', 'dlx', 'cdcl')
+SOLVER_ENGINES = {'dlx': dlx, 'cdcl': cdcl}
+DEFAULT_ENGINE = 'bitmask'
+# Search modes: 'copy' branches on copies of the state, 'trail' backtracks in place with an undo trail.
+SEARCH_MODES = ('copy', 'trail')
+
+
+def check_engine(engine):
+    if engine not in ENGINES:
+        raise ValueError('Unknown engine %r; expected one of %s' % (engine, ', '.join(ENGINES)))
+
 
-def parse_grid(grid):
+def check_mode(mode):
+    if mode not in SEARCH_MODES:
+        raise ValueError('Unknown search mode %r; expected one of %s' % (mode, ', '.join(SEARCH_MODES)))
+
+
+def parse_grid(grid, engine=DEFAULT_ENGINE):
     """Convert grid to a dict of possible values, {square: digits}, or
     return False if a contradiction is detected."""
+    check_engine(engine)
+    if engine in SOLVER_ENGINES:
+        raise ValueError("The %r engine keeps no candidate state; use 'dict' or 'bitmask'" % engine)
+    if engine == 'bitmask':
+        return bm.to_values(bm.parse_grid(grid), squares)
     ## To start, every square can be any digit; then assign values from the grid.
     values = dict((s, digits) for s in squares)
     for s, d in grid_values(grid).items():
@@ -91,20 +125,137 @@ def display(values):
             print(line)
 
 
-def solve(grid): return search(parse_grid(grid))
-
-
-def search(values):
-    "Using depth-first search and propagation, try all possible values."
+def solve(grid, engine=DEFAULT_ENGINE, mode='copy', level=bm.SINGLES, max_nodes=None, deadline=None, stats=None,
+          workers=None):
+    """Solve grid, returning {square: digit} or False if it has no solution.
+    max_nodes caps the search nodes and deadline the seconds the call may take; when either
+    runs out the result is a falsy budget.BudgetExceeded instead, with the nodes and time spent.
+    Given a solve_stats.SolveStats, the solve adds its counters to it; that runs the instrumented
+    copy of the bitmask search (same nodes, same order) whatever the mode or propagation engine.
+    workers > 1 splits the search tree over that many processes (see parallel_search)."""
+    check_engine(engine)
+    check_mode(mode)
+    bm.check_level(level)
+    if stats is not None and engine in SOLVER_ENGINES:
+        raise ValueError("SolveStats are collected by the 'dict' and 'bitmask' engines, not %r" % engine)
+    if workers is not None and workers > 1:
+        check_parallel(engine, stats)
+        return parallel_solve(bm.parse_grid(grid), workers, level, max_nodes, deadline)
+    budget = make_budget(max_nodes, deadline)
+    try:
+        if stats is not None:
+            return bm.to_values(solve_stats.solve(grid, level, stats, budget), squares)
+        if engine in SOLVER_ENGINES:
+            if level != bm.SINGLES:
+                raise ValueError("The %r engine has no propagation levels; level must be %d" % (engine, bm.SINGLES))
+            solution = SOLVER_ENGINES[engine].solve(grid, budget)
+            return solution and dict(zip(squares, solution))
+        if engine == 'bitmask':
+            return bm.to_values(bm.solve(grid, mode, level, budget), squares)
+        return budgeted_search(parse_grid(grid, engine='dict'), mode, level, budget)
+    except OutOfBudget as e:
+        return budget.exceeded(e)
+
+
+def search(values, mode='copy', level=bm.SINGLES, max_nodes=None, deadline=None, stats=None, workers=None):
+    """Using depth-first search and propagation, try all possible values.
+    mode='trail' runs the iterative in-place search of bitmask_engine instead of
+    copying values at every branch; it visits the same nodes in the same order.
+    level > 1 adds the stronger techniques of bitmask_engine.LEVELS at every node,
+    which also runs on the bitmask engine. max_nodes, deadline, stats and workers work as in solve()."""
+    check_mode(mode)
+    bm.check_level(level)
+    if workers is not None and workers > 1:
+        check_parallel(DEFAULT_ENGINE, stats)
+        return parallel_solve(values and bm.from_values(values, squares), workers, level, max_nodes, deadline)
+    budget = make_budget(max_nodes, deadline)
+    try:
+        if stats is not None:
+            state = values and bm.from_values(values, squares)
+            return bm.to_values(solve_stats.run(state, level, stats, budget), squares)
+        return budgeted_search(values, mode, level, budget)
+    except OutOfBudget as e:
+        return budget.exceeded(e)
+
+
+def budgeted_search(values, mode, level, budget):
+    "search(), charging every node to budget (a budget.Budget or None); raises OutOfBudget when it runs out."
     if values is False:
         return False  ## Failed earlier
+    if mode == 'trail' or level > bm.SINGLES:
+        state = bm.from_values(values, squares)
+        if mode == 'trail':
+            return bm.to_values(bm.search_trail(state, level, budget), squares)
+        return bm.to_values(bm.search(state, level, budget), squares)
+    if budget is not None:
+        budget.spend()
     if all(len(values[s]) == 1 for s in squares):
         return values  ## Solved!
     ## Chose the unfilled square s with the fewest possibilities
     n, s = min((len(values[s]), s) for s in squares if len(values[s]) > 1)
-    display(values)
-    input('hi')
-    return some(search(assign(values.copy(), s, d)) for d in values[s])
+    return some(budgeted_search(assign(values.copy(), s, d), mode, level, budget) for d in values[s])
+
+
+def check_parallel(engine, stats):
+    if engine in SOLVER_ENGINES:
+        raise ValueError("Parallel search runs on the 'dict' and 'bitmask' engines, not %r" % engine)
+    if stats is not None:
+        raise ValueError('SolveStats are not collected by parallel search')
+
+
+def parallel_solve(state, workers, level, max_nodes, deadline):
+    "solve() on a bitmask state with parallel_search, as {square: digit}, False or BudgetExceeded."
+    result = parallel_search.search(state, 1, workers, level, max_nodes, deadline)
+    if isinstance(result, BudgetExceeded):
+        result.partial = None
+        return result
+    return result[1] and dict(zip(squares, result[1])) or False
+
+
+def count_solutions(grid, limit=2, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None, workers=None):
+    """Count the solutions of grid, stopping as soon as limit of them are found.
+    limit=None counts them all; count_solutions(grid) == 1 means the solution is unique.
+    max_nodes and deadline bound it as in solve(); a BudgetExceeded result has the count so far as partial.
+    workers > 1 splits the search tree over that many processes (see parallel_search)."""
+    check_engine(engine)
+    if workers is not None and workers > 1:
+        check_parallel(engine, None)
+        return parallel_search.count_solutions(grid, limit, workers, max_nodes=max_nodes, deadline=deadline)
+    budget = make_budget(max_nodes, deadline)
+    try:
+        return budgeted_count(grid, limit, engine, budget)
+    except OutOfBudget as e:
+        return budget.exceeded(e)
+
+
+def budgeted_count(grid, limit, engine, budget):
+    "count_solutions(), charging every node to budget; raises OutOfBudget when it runs out."
+    if engine in SOLVER_ENGINES:
+        return SOLVER_ENGINES[engine].count_solutions(grid, limit, budget)
+    if engine == 'bitmask':
+        return bm.count_solutions(bm.parse_grid(grid), limit, budget=budget)
+    return count(parse_grid(grid, engine='dict'), limit, budget)
+
+
+def count(values, limit=None, budget=None):
+    "Count the solutions reachable from values by depth-first search, up to limit."
+    if values is False:
+        return 0
+    if budget is not None:
+        budget.spend()
+    if all(len(values[s]) == 1 for s in squares):
+        return 1
+    n, s = min((len(values[s]), s) for s in squares if len(values[s]) > 1)
+    total = 0
+    for d in values[s]:
+        try:
+            total += count(assign(values.copy(), s, d), None if limit is None else limit - total, budget)
+        except OutOfBudget as e:
+            e.partial = total + (e.partial or 0)
+            raise
+        if total == limit:
+            break
+    return total
 
 
 def some(seq):
@@ -120,10 +271,20 @@ def shuffled(seq):
     random.shuffle(seq)
     return seq
 
-def random_board():
+def random_board(engine=DEFAULT_ENGINE):
     """Make a random puzzle with N or more assignments. Restart on contradictions.
     Note the resulting puzzle is not guaranteed to be solvable, but empirically
-    about 99.8% of them are solvable. Some have multiple solutions."""
+    about 99.8% of them are solvable. Some have multiple solutions.
+    The 'dlx' and 'cdcl' engines have no candidate state to assign into, so they build boards with 'bitmask'."""
+    check_engine(engine)
+    if engine != 'dict':
+        state = bm.empty_state()
+        for s in shuffled(range(81)):
+            if not bm.assign(state, s, random.choice(bm.DIGITS[state[s]])):
+                break
+            if bm.solved(state):
+                return bm.to_string(state)
+        return random_board(engine)
     values = dict((s, digits) for s in squares)
     for s in shuffled(squares):
         if not assign(values, s, random.choice(values[s])):
@@ -131,49 +292,270 @@ def random_board():
         ds = [values[s] for s in squares if len(values[s]) == 1]
         if len(ds) == 81 and len(set(ds)) >= 8:
             return ''.join(values[s] if len(values[s]) == 1 else '.' for s in squares)
-    return random_board()
-
-
-def random_puzzle(N=17, single_solution=True):
+    return random_board(engine)
+
+
+# How often minimal_puzzle() makes each number of clues, out of 2000 puzzles.  Minimal puzzles with
+# other numbers of clues exist but are too rare to wait for.
+MINIMAL_CLUES = {21: 0.002, 22: 0.037, 23: 0.167, 24: 0.342, 25: 0.293, 26: 0.129, 27: 0.027, 28: 0.004}
+
+
+def full_grid(engine=DEFAULT_ENGINE, bank=None):
+    """A random full grid to dig a puzzle from: a fresh transform of a grid_bank.sample_grid() of bank
+    (a bank array or the path of one) if given, else built by random_board(), which is far slower."""
+    if bank is not None:
+        return grid_bank.sample_grid(bank)
+    return random_board(engine)
+
+
+def check_minimal(N):
+    if N not in MINIMAL_CLUES:
+        raise ValueError('Minimal puzzles can be made with %s-%s clues, but %s were given.'
+                         % (min(MINIMAL_CLUES), max(MINIMAL_CLUES), N))
+
+
+def random_puzzle(N=17, single_solution=True, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None, minimal=False,
+                  bank=None, repair=None, stats=None):
+    """Make a puzzle with N clues, with a unique solution if single_solution.
+    If minimal, the puzzle is also minimal (see minimal_puzzle()), and N must be one of MINIMAL_CLUES;
+    minimal puzzles are made until one has N clues. Full grids are drawn from bank if given (see full_grid()).
+    If repair, boards stuck above N clues are repaired rather than started over (see repair_dig()); None
+    repairs for N up to REPAIR_FOR, below which it pays off. stats collects its counters per N (see
+    random_puzzle_and_solution()).
+    max_nodes caps the search nodes of the uniqueness checks and clue removals, and deadline the
+    seconds the call may take; when either runs out the result is a falsy budget.BudgetExceeded
+    whose partial is the board reached so far (with more than N clues)."""
+    result = random_puzzle_and_solution(N, single_solution, engine, max_nodes, deadline, minimal, bank, repair, stats)
+    return result if isinstance(result, BudgetExceeded) else result[0]
+
+
+def random_puzzle_and_solution(N=17, single_solution=True, engine=DEFAULT_ENGINE, max_nodes=None, deadline=None,
+                               minimal=False, bank=None, repair=None, stats=None):
+    """Like random_puzzle(), but return a tuple (puzzle, solution), where solution is the full grid the
+    puzzle was dug from: its only solution if single_solution, so there is no need to solve it again.
+    Unique puzzles are dug by dig(), with the 'dict' engine by dig_puzzle(); with repair, a board that
+    gets stuck above N clues is repaired before its grid is given up (see repair_dig()). Either way the
+    uniqueness checks run on engine.
+    Given a dict stats, stats[N] (a collections.Counter) gets the grids dug and the boards made, whether
+    or not with repair, and the counters of repair_dig()."""
+    if not 16 < N < 82:
+        raise TheoreticalLimit("17-81 is the theoretical range of clues, but %s were given." %  N)
+    check_engine(engine)
+    if minimal:
+        check_minimal(N)
+    if repair is None:
+        repair = N <= REPAIR_FOR
+    budget = make_budget(max_nodes, deadline)
+    board = []
+    counts = Counter()
+    try:
+        while True:
+            ## A board stuck above N clues, or a minimal one with another count, starts over from a new grid.
+            solution = full_grid(engine, bank)
+            allowance = REPAIR_BASE * cdcl.luby(counts['grids'])
+            counts['grids'] += 1
+            if minimal:
+                puzzle = dig(solution, budget, board, engine=engine)
+                if 81 - puzzle.count('0') != N:
+                    continue
+            elif repair and single_solution:
+                puzzle = repair_dig(N, solution, budget, board, allowance, counts, engine=engine)
+            elif single_solution and engine != 'dict':
+                puzzle = dig(solution, budget, board, N, engine=engine)
+            else:
+                puzzle = dig_puzzle(N, solution, single_solution, engine, budget, board)
+            if puzzle:
+                counts['boards'] += 1
+                return puzzle, solution
+    except OutOfBudget as e:
+        e.partial = ''.join(board).replace('.', '0')
+        return budget.exceeded(e)
+    finally:
+        if stats is not None:
+            stats.setdefault(N, Counter()).update(counts)
+
+
+REPAIR_FOR = 23  # random_puzzle() repairs stuck boards by default for puzzles of up to this many clues
+REPAIR_BASE = 8  # repairs allowed on a grid per unit of the Luby sequence, before digging a new one
+REPAIR_CLUES = 4  # removed clues a repair puts back
+
+
+def repair_dig(N, solution, budget, board, allowance, counts, sets=None, engine='bitmask'):
+    """Dig solution down to N clues with dig(); while the board gets stuck above N, repair it up to
+    allowance times: put back REPAIR_CLUES of its removed clues at random and dig it again in a new order,
+    which keeps most of the work done on the grid. random_puzzle_and_solution() escalates to a new grid
+    when the repairs run out, allowing REPAIR_BASE times the Luby sequence (1, 1, 2, 1, 1, 2, 4, ...)
+    for successive grids: mostly quick restarts, with ever longer runs of repairs among them.
+    counts (a Counter) gets the repairs made and the boards repaired; sets are the unavoidable sets of solution,
+    if already found; engine checks the removals (see dig()).
+    :return: the puzzle, with '0' for blanks, or None if the repairs ran out"""
+    if sets is None and N <= SETS_FOR:
+        sets = unavoidable.unavoidable_sets(solution)
+    puzzle = dig(solution, budget, board, N, sets=sets, engine=engine)
+    repairs = 0
+    while not puzzle and repairs < allowance:
+        repairs += 1
+        counts['repairs'] += 1
+        blanks = [s for s in range(81) if board[s] == '0']
+        squares = [s for s in range(81) if board[s] != '0'] + random.sample(blanks, min(REPAIR_CLUES, len(blanks)))
+        puzzle = dig(solution, budget, board, N, squares, sets, engine)
+    if puzzle:
+        counts['repaired'] += repairs > 0
+    return puzzle
+
+
+def grid_puzzles(N, K, single_solution=True, max_nodes=None, deadline=None, bank=None, repair=None):
+    """Make up to K different puzzles with N clues from one full grid, each dug along its own random order,
+    which spreads the cost of making the grid over them. A grid stops giving puzzles at the first one that
+    gets stuck for good (such grids tend to do so again), and a grid that gives none is replaced by another.
+    single_solution, max_nodes, deadline, bank and repair work as in random_puzzle().
+    :return: tuple (list of puzzles, with '0' for blanks, solution), or a falsy budget.BudgetExceeded"""
     if not 16 < N < 82:
         raise TheoreticalLimit("17-81 is the theoretical range of clues, but %s were given." %  N)
-    board_string = random_board()
-    while len(board_string) != 81:
-        board_string = random_board()
-    board = list(random_board())
+    if repair is None:
+        repair = N <= REPAIR_FOR
+    budget = make_budget(max_nodes, deadline)
+    board = []
+    counts = Counter()
+    try:
+        while True:
+            solution = full_grid('bitmask', bank)
+            sets = unavoidable.unavoidable_sets(solution) if single_solution and N <= SETS_FOR else None
+            allowance = REPAIR_BASE * cdcl.luby(counts['grids']) if repair else 0
+            counts['grids'] += 1
+            puzzles = []
+            for _ in range(2 * K):  # room for digs that repeat an earlier puzzle
+                if single_solution:
+                    puzzle = repair_dig(N, solution, budget, board, allowance, counts, sets)
+                else:
+                    puzzle = dig_puzzle(N, solution, False, 'bitmask', budget, board)
+                if not puzzle:
+                    break
+                if puzzle not in puzzles:
+                    puzzles.append(puzzle)
+                    if len(puzzles) == K:
+                        break
+            if puzzles:
+                return puzzles, solution
+    except OutOfBudget as e:
+        e.partial = ''.join(board).replace('.', '0')
+        return budget.exceeded(e)
+
+
+def minimal_puzzle(max_nodes=None, deadline=None, bank=None):
+    """Make a minimal puzzle: its solution is unique, and removing any one of its clues would break that.
+    max_nodes and deadline bound it as in random_puzzle(); a BudgetExceeded result's partial is the board
+    reached so far (unique, but perhaps not yet minimal)."""
+    budget = make_budget(max_nodes, deadline)
+    board = []
+    try:
+        return dig(full_grid('bitmask', bank), budget, board)
+    except OutOfBudget as e:
+        e.partial = ''.join(board)
+        return budget.exceeded(e)
+
+
+# dig() checks removals against unavoidable sets first for puzzles of up to SETS_FOR clues, once the board
+# is down to SETS_BELOW clues; above that, finding the sets costs more than the searches they save.
+SETS_FOR = 24
+SETS_BELOW = 35
+
+
+def dig(solution, budget, board, N=None, squares=None, sets=None, engine='bitmask'):
+    """Dig a unique puzzle out of the full grid solution, or out of its unique subpuzzle with clues at
+    squares if given: try to remove each clue once, in random order, until N are left. A clue can go
+    unless the board without it has a solution with another digit there. A clue that has to stay stays
+    needed as more clues go, so with N None every clue is tried and the board left is minimal.
+    Each test starts from the state already propagated for the clues after it in the order, plus the
+    clues kept so far, so it neither parses the board afresh nor re-propagates clues that the removal
+    cannot affect; then it looks for one other solution, rather than counting to two. Any other engine
+    instead counts the solutions of the board without the clue, up to two.
+    For N up to SETS_FOR, once the board is down to SETS_BELOW clues, the grid's unavoidable sets (sets, or
+    found here; see unavoidable.py) keep a clue without a search when removing it would leave a set empty,
+    and give up on a board that could never get down to N clues before the rest of its clues are tried.
+    board is filled in and dug in place so a caller can see how far it got.
+    :return: the puzzle, with '0' for blanks, or None if the board got stuck above N clues"""
+    digits = bm.grid_digits(solution)
+    order = shuffled(range(81) if squares is None else squares)
+    clues = len(order)
+    board[:] = solution if squares is None else ['0'] * 81
+    for s in order:
+        board[s] = solution[s]
+    ## after[i] is the state of the clues tried after order[i], all still on the board when order[i] is tried.
+    after = [None] * clues
+    state = bm.empty_state()
+    for i in range(clues - 1, -1, -1) if engine == 'bitmask' else ():
+        after[i] = state[:]
+        bm.assign(state, order[i], digits[order[i]])
+    kept, kept_mask, clue_mask = [], 0, sum(1 << s for s in order)
+    for i, s in enumerate(order):
+        if clues == N:
+            break
+        if budget is not None:
+            budget.spend()
+        if N is not None and N <= SETS_FOR and clues <= SETS_BELOW:
+            if sets is None:
+                sets = unavoidable.unavoidable_sets(solution)
+            empties, bound = unavoidable.check_removal(sets, kept_mask, clue_mask, 1 << s)
+            if bound > N:
+                return None
+            if empties:
+                kept.append(s)
+                kept_mask |= 1 << s
+                continue
+        if engine == 'bitmask':
+            state = after[i]
+            after[i] = None
+            for k in kept:
+                bm.assign(state, k, digits[k])
+            needed = bm.eliminate(state, s, digits[s]) and bm.search(state, budget=budget)
+        else:
+            board[s] = '0'
+            needed = budgeted_count(''.join(board), 2, engine, budget) > 1
+            board[s] = solution[s]
+        if needed:
+            kept.append(s)  ## Without it the board has another solution
+            kept_mask |= 1 << s
+        else:
+            board[s] = '0'
+            clues -= 1
+            clue_mask ^= 1 << s
+    if N is not None and clues > N:
+        return None
+    return ''.join(board)
+
+
+def dig_puzzle(N, solution, single_solution, engine, budget, board):
+    """Dig a puzzle with N clues out of the full grid solution by removing clues in random order,
+    counting the solutions of the whole board after each removal if single_solution; the digger for
+    the 'dict' engine, and for puzzles that need not be unique.
+    board is filled in and dug in place so a caller can see how far it got.
+    :return: the puzzle, with '0' for blanks, or None if it is stuck above N clues"""
+    board[:] = solution
 
     squares = shuffled(list(range(0, 81, 1)))
+    squares.reverse()  # popped from the end: tried in the same order as dig()
     success = 0
-    iterations = 0
-
-    while True:
-        for i in range(0, len(squares), 1):
-            backup = board[squares[i]]
-            board[squares[i]] = '.'
-            if max(list(map(int, parse_grid(board).values()))) > 9:
-                board[squares[i]] = backup
-            else:
-                success += 1
-                squares.pop(i)
-                break
 
-        if single_solution:
-            if success >= (81 - N) and len(max(list(parse_grid(board).values()))) == 1:
-                break
-            elif success >= (81 - N) or iterations >= 81:
-                board_string = random_board()
-                while len(board_string) != 81:
-                    board_string = random_board()
-                board = list(random_board())
-
-                squares = shuffled(list(range(0, 81, 1)))
-                success = 0
-                iterations = 0
-            iterations += 1
+    while success < (81 - N):
+        if not squares:
+            ## Every remaining clue is needed for uniqueness: the board is stuck above N clues.
+            return None
+
+        if budget is not None:
+            budget.spend()
+        square = squares.pop()
+        backup = board[square]
+        board[square] = '.'
+        try:
+            needed = single_solution and budgeted_count(board, 2, engine, budget) != 1
+        except OutOfBudget:
+            board[square] = backup
+            raise
+        if needed:
+            ## Removing more clues can only add solutions, so this clue stays needed; don't retry it.
+            board[square] = backup
         else:
-            if success >= (81 - N):
-                break
+            success += 1
 
-    # print(board)
-    # display(parse_grid(board))
     return ''.join(board).replace('.', '0')
\ No newline at end of file
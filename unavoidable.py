@@ -0,0 +1,118 @@
+# Unavoidable sets of a solution grid, to cut clue-removal searches short while digging puzzles.
+# An unavoidable set is a set of squares whose digits can be rearranged into another valid grid
+# while every other square stays put, so a puzzle with no clue in it has a second solution.
+# The smallest ones hold just two digits: swapping digits a and b in a set of rows keeps each
+# column right only if the rows close up into cycles (the a of one row sits under the b of the
+# next), and keeps each box right only if the cycles move as many a's into a box as out of it.
+# Every puzzle must keep a clue in every set, which gives two checks that need no search: a removal
+# that would leave some set without a clue is wrong, and a board whose unhit sets need more
+# distinct clues than it may keep can be dropped. Passing them proves nothing, since these are far
+# from all the unavoidable sets of the grid, so the digger still searches to accept a removal.
+
+import itertools
+import unittest
+
+import bitmask_engine as bm
+
+BOX = tuple(3 * (s // 27) + s % 9 // 3 for s in range(81))
+
+
+def unavoidable_sets(solution):
+    """The minimal unavoidable sets of solution that hold two digits, smallest first.
+    :param solution: 81-char solved grid
+    :return: list of int masks, bit s set for each square s in the set"""
+    values = bm.grid_digits(solution)
+    columns = [[0] * 9 for _ in range(9)]  # columns[d][r] is the column of digit d in row r
+    for s in range(81):
+        columns[values[s]][s // 9] = s % 9
+    found = []
+    for a, b in itertools.combinations(range(9), 2):
+        ca, cb = columns[a], columns[b]
+        row_of_a = [0] * 9
+        for r in range(9):
+            row_of_a[ca[r]] = r
+        ## Row r's b moves to where the a of the next row in its cycle was.
+        cycles, seen = [], set()
+        for r in range(9):
+            cycle = []
+            while r not in seen:
+                seen.add(r)
+                cycle.append(r)
+                r = row_of_a[cb[r]]
+            if cycle:
+                cycles.append(cycle)
+        sets = []
+        for n in range(1, len(cycles) + 1):
+            for chosen in itertools.combinations(cycles, n):
+                rows = [r for cycle in chosen for r in cycle]
+                if sorted(BOX[9 * r + ca[r]] for r in rows) != sorted(BOX[9 * r + cb[r]] for r in rows):
+                    continue
+                mask = 0
+                for r in rows:
+                    mask |= 1 << 9 * r + ca[r] | 1 << 9 * r + cb[r]
+                if not any(m & mask == m for m in sets):
+                    sets.append(mask)
+        found.extend(sets)
+    return sorted(found, key=lambda m: bin(m).count('1'))
+
+
+def check_removal(sets, kept, clues, bit):
+    """Check the removal of the clue at bit against sets, while digging a board.
+    :param sets: list of masks from unavoidable_sets(), smallest first
+    :param kept: mask of the clues that have to stay
+    :param clues: mask of the clues on the board, kept or still to try (bit among them)
+    :return: tuple (whether the removal would leave a set without a clue,
+                    a lower bound on the clues any puzzle dug from the board keeps)"""
+    empties, used, bound = False, 0, bin(kept).count('1')
+    for m in sets:
+        if m & kept:
+            continue
+        m &= clues
+        if m == bit:
+            empties = True
+        if not m & used:
+            ## Disjoint from the sets counted so far, so it needs a clue of its own.
+            used |= m
+            bound += 1
+    return empties, bound
+
+
+class TestUnavoidable(unittest.TestCase):
+    solution = '417369825632158947958724316825437169791586432346912758289643571573291684164875293'
+
+    def setUp(self):
+        pass
+
+    def test_sets(self):
+        import random
+        import dlx_engine as dlx
+        import sudoku_generator as sg
+        random.seed(23)
+        for solution in [self.solution] + [sg.random_board('bitmask') for _ in range(5)]:
+            sets = unavoidable_sets(solution)
+            self.assertGreater(len(sets), 20)
+            self.assertEqual(min(bin(m).count('1') for m in sets), 4)
+            for m in sets:
+                ## Blanking a minimal two-digit set leaves just the one other solution: its digits swapped.
+                holes = ''.join('.' if m >> s & 1 else solution[s] for s in range(81))
+                self.assertEqual(dlx.count_solutions(holes), 2)
+                self.assertFalse(any(k != m and k & m == k for k in sets))
+        puzzle = sg.random_puzzle(24)
+        clues = sum(1 << s for s in range(81) if puzzle[s] != '0')
+        sets = unavoidable_sets(dlx.solve(puzzle))
+        self.assertTrue(all(m & clues for m in sets))
+        empties, bound = check_removal(sets, clues, clues, 1)
+        self.assertFalse(empties)
+        self.assertEqual(bound, 24)
+        full, m = (1 << 81) - 1, sets[0]
+        empties, bound = check_removal(sets, 0, full, m & -m)
+        self.assertFalse(empties)
+        self.assertGreater(bound, 5)
+        self.assertTrue(check_removal(sets, 0, full & ~m | m & -m, m & -m)[0])
+
+    def tearDown(self):
+        pass
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)